@@ -0,0 +1,451 @@
+#!/usr/bin/env python3
+# vim: set sts=0 noet :
+#
+# Benchmarks for the THPS PSX/TRG writers.
+#
+# Builds a synthetic level, times each stage of the exporter and records
+# throughput and peak memory, optionally against a saved JSON baseline:
+#
+#   python bench_thps_psx.py --save before.json
+#   (change things)
+#   python bench_thps_psx.py --compare before.json
+#
+# Runs without Blender; export_trg is driven through a small stub bpy.
+
+import argparse
+import contextlib
+import io
+import json
+import math
+import os
+import platform
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy
+
+import io_thps_psx_tools as thps
+
+#
+# Synthetic scenes
+#
+
+def synth_heightfield(rng, *, verts):
+	# Returns (co (V,3), loop_vidxs, loop_uvs, quads) for a bumpy grid
+	g = max(2, int(round(math.sqrt(verts))))
+	gx, gy, = numpy.meshgrid(numpy.arange(g), numpy.arange(g))
+	co = numpy.empty((g*g, 3), dtype=numpy.float64)
+	co[:, 0] = gx.reshape(-1)*0.5
+	co[:, 1] = gy.reshape(-1)*0.5
+	co[:, 2] = rng.uniform(-0.25, 0.25, g*g)
+	co = co.astype(numpy.float32).astype(numpy.float64)
+
+	q = (gy[:-1, :-1]*g+gx[:-1, :-1]).reshape(-1)
+	loop_vidxs = numpy.stack([q, q+1, q+g+1, q+g], axis=1).reshape(-1)
+	loop_uvs = co[loop_vidxs, :2]/(0.5*(g-1))
+	return co, loop_vidxs, loop_uvs.astype(numpy.float32).astype(numpy.float64), len(q)
+
+def synth_image(rng, *, size, ncolours):
+	pal = rng.uniform(0.0, 1.0, (ncolours, 4))
+	pal[:, 3] = 1.0
+	return pal[rng.integers(0, ncolours, (size, size))].astype(numpy.float32)
+
+def synth_rail(rng, *, points, span):
+	# A wandering polyline, as scene_from_blender samples it from a curve
+	steps = rng.uniform(-1.0, 1.0, (points, 3))
+	steps[:, 2] *= 0.1
+	points = rng.uniform(-span, span, 3)+numpy.cumsum(steps, axis=0)
+	return points.astype(numpy.float32).astype(numpy.float64)
+
+def synth_scene(*, seed, objects, verts, textures, texture_size, lamps, rails=0, rail_points=64):
+	rng = numpy.random.default_rng(seed)
+	scene = thps.Scene()
+	for i in range(textures):
+		scene.images["tex%d" % (i,)] = thps.texture_fit(
+			synth_image(rng, size=texture_size, ncolours=(12 if i%2 == 0 else 64)))
+
+	span = 8.0*math.sqrt(objects)
+	for i in range(objects):
+		co, loop_vidxs, loop_uvs, nquads, = synth_heightfield(rng, verts=verts)
+		marr = thps.MeshArrays(
+			co=co,
+			poly_normals=numpy.tile([0.0, 0.0, 1.0], (nquads, 1)),
+			loop_start=numpy.arange(nquads, dtype=numpy.int64)*4,
+			loop_total=numpy.full(nquads, 4, dtype=numpy.int64),
+			loop_vidxs=loop_vidxs.astype(numpy.int64),
+			loop_uvs=loop_uvs)
+		scene.mesh(
+			name="obj%d" % (i,),
+			marr=marr,
+			scale=(1.0, 1.0, 1.0,),
+			location=tuple(float(v) for v in numpy.float32(rng.uniform(-span, span, 3))),
+			slots=(["tex%d" % (i%textures,)] if textures != 0 else []))
+
+	for i in range(lamps):
+		scene.lamps.append({
+			"pos": tuple(rng.uniform(-span, span, 3).tolist()),
+			"dir": (0.0, 0.0, -1.0,),
+			"type": ("POINT", "SPOT", "SUN", "HEMI",)[i%4],
+			"energy": 1.0,
+			"distance": 25.0,
+			"spot_size": 1.0,
+		})
+
+	# Chain every fourth rail onto the one before, like connected rails
+	for i in range(rails):
+		points = synth_rail(rng, points=rail_points, span=span)
+		if i%4 != 0:
+			points = (points+scene.rails[-1].points[-1]-points[0]).astype(numpy.float32).astype(numpy.float64)
+		scene.rail(name="rail%d" % (i,), points=points)
+	return scene
+
+def synth_psx(scene):
+	# PSX with one editable model per mesh, as the exporter would build it
+	psx = thps.PSX()
+	for name in sorted(scene.images.keys()):
+		bpp, pal, idx, = thps.texture_quantise(scene.images[name])
+		psx.texture(iw=idx.shape[1], ih=idx.shape[0], bpp=bpp, pal=pal,
+			data=thps.texture_pack(idx, bpp=bpp))
+	for mesh in scene.meshes:
+		verts = thps.mesh_fix12_vertices(mesh.marr.co, scale=mesh.scale, location=(0.0, 0.0, 0.0,))
+		for fsel in thps.mesh_split_faces(verts, mesh.marr.loop_vidxs.reshape((-1, 4))):
+			vsel, fvidxs, = thps.mesh_subset(mesh.marr.loop_vidxs.reshape((-1, 4))[fsel])
+			pverts = verts[vsel]
+			centre = (pverts.min(axis=0)+pverts.max(axis=0)+1)>>1
+			mdl = psx.thing(px=0, py=0, pz=0)
+			for v in (pverts-centre).tolist():
+				mdl.vertex(*v)
+			for fv in fvidxs.tolist():
+				mdl.face(rflags=0x1803, sflags=0, vidxs=[fv[0], fv[1], fv[3], fv[2]],
+					cmd=[128, 128, 128, 128], tidx=0, tpoints=[(0, 0), (7, 0), (0, 7), (7, 7)])
+	return psx
+
+def synth_trg(*, nodes):
+	trg = thps.TRG()
+	trg.new_autoexec(ops=[thps.SetRestart("Start"), thps.EndCommandList()])
+	trg.new_restart(px=0, py=0, pz=0, sx=0, sy=0, sz=0, name="Start",
+		ops=[thps.SendPulse(), thps.EndCommandList()])
+	prev = None
+	for i in range(nodes):
+		node = trg.new_railpoint(px=i<<12, py=0, pz=(i*7)<<12)
+		if prev is not None and i%32 != 0:
+			prev.add_link(other=node)
+		prev = node
+	return trg
+
+#
+# Stub bpy
+#
+
+class StubCollection(object):
+	# Just enough of bpy_prop_collection for mesh_extract()
+	def __init__(self, length, **attrs):
+		self.length = length
+		self.attrs = attrs
+
+	def __len__(self):
+		return self.length
+
+	def foreach_get(self, attr, out):
+		out[:] = self.attrs[attr].reshape(-1)
+
+class StubPixels(object):
+	# Image.pixels, which Blender stores bottom row first
+	def __init__(self, rgba):
+		self.rgba = rgba[::-1]
+
+	def foreach_get(self, out):
+		out[:] = self.rgba.reshape(-1)
+
+class StubBpy(object):
+	class types(object):
+		class Mesh(object):
+			pass
+
+		class Lamp(object):
+			pass
+
+		class Curve(object):
+			pass
+
+	class Namespace(object):
+		def __init__(self, **attrs):
+			self.__dict__.update(attrs)
+
+	def __init__(self, scene):
+		# Turns a Scene back into the objects export_trg walks over
+		images = {}
+		for (name, rgba,) in scene.images.items():
+			h, w, = rgba.shape[:2]
+			images[name] = StubBpy.Namespace(name=name, size=(w, h,),
+				pixels=StubPixels(rgba))
+
+		objects = []
+		for mesh in scene.meshes:
+			marr = mesh.marr
+			data = StubBpy.types.Mesh()
+			data.vertices = StubCollection(len(marr.co), co=marr.co)
+			data.polygons = StubCollection(len(marr.loop_start),
+				normal=marr.poly_normals,
+				loop_start=marr.loop_start,
+				loop_total=marr.loop_total,
+				material_index=marr.poly_materials)
+			data.loops = StubCollection(len(marr.loop_vidxs), vertex_index=marr.loop_vidxs)
+			active = None
+			if marr.loop_uvs is not None:
+				active = StubBpy.Namespace(data=StubCollection(len(marr.loop_uvs), uv=marr.loop_uvs))
+			data.uv_layers = StubBpy.Namespace(active=active)
+			slots = [StubBpy.Namespace(material=StubBpy.Namespace(
+					use_nodes=True,
+					node_tree=StubBpy.Namespace(nodes=[
+						StubBpy.Namespace(type="TEX_IMAGE", image=images[name])]))
+				if name is not None else None)
+				for name in mesh.slots]
+			objects.append(StubBpy.Namespace(name=mesh.name, data=data,
+				scale=mesh.scale, location=mesh.location, material_slots=slots))
+		for lamp in scene.lamps:
+			data = StubBpy.types.Lamp()
+			data.type = lamp["type"]
+			data.color = (1.0, 1.0, 1.0,)
+			data.energy = lamp["energy"]
+			data.distance = lamp["distance"]
+			data.spot_size = lamp["spot_size"]
+			x, y, z, = lamp["pos"]
+			dx, dy, dz, = lamp["dir"]
+			objects.append(StubBpy.Namespace(name="lamp", data=data,
+				location=StubBpy.Namespace(x=x, y=y, z=z),
+				matrix_world=[[1.0, 0.0, -dx, x], [0.0, 1.0, -dy, y], [0.0, 0.0, -dz, z], [0.0, 0.0, 0.0, 1.0]]))
+		for rail in scene.rails:
+			data = StubBpy.types.Curve()
+			co = numpy.ones((len(rail.points), 4), dtype=numpy.float64)
+			co[:, :3] = rail.points
+			data.splines = [StubBpy.Namespace(type="POLY", use_cyclic_u=rail.cyclic,
+				points=StubCollection(len(rail.points), co=co))]
+			objects.append(StubBpy.Namespace(name=rail.name, data=data,
+				matrix_world=[[1.0, 0.0, 0.0, 0.0], [0.0, 1.0, 0.0, 0.0], [0.0, 0.0, 1.0, 0.0], [0.0, 0.0, 0.0, 1.0]]))
+		self.data = StubBpy.Namespace(objects=objects)
+
+#
+# Measurements
+#
+
+def measure(fn, *, repeat):
+	# Best wall time of several runs, then one more under tracemalloc
+	best = None
+	for i in range(repeat):
+		with contextlib.redirect_stdout(io.StringIO()):
+			t = time.perf_counter()
+			fn()
+			t = time.perf_counter()-t
+		best = (t if best is None else min(best, t))
+
+	tracemalloc.start()
+	try:
+		with contextlib.redirect_stdout(io.StringIO()):
+			fn()
+		peak = tracemalloc.get_traced_memory()[1]
+	finally:
+		tracemalloc.stop()
+	return best, peak
+
+def file_size(fname):
+	return os.stat(fname).st_size
+
+def run_benchmarks(args, tmpdir):
+	scene = synth_scene(
+		seed=args.seed,
+		objects=args.objects,
+		verts=args.verts,
+		textures=args.textures,
+		texture_size=args.texture_size,
+		lamps=args.lamps,
+		rails=args.rails)
+	nfaces = sum(len(mesh.marr.loop_start) for mesh in scene.meshes)
+	results = {}
+
+	def record(name, fn, *, items=None, unit=None, nbytes=None):
+		seconds, peak, = measure(fn, repeat=args.repeat)
+		entry = {"seconds": seconds, "peak_bytes": peak}
+		if items is not None:
+			entry[unit+"_per_s"] = items/seconds
+		if nbytes is not None:
+			entry["bytes"] = nbytes() if callable(nbytes) else nbytes
+			entry["mb_per_s"] = entry["bytes"]/seconds/(1<<20)
+		results[name] = entry
+		print("%-16s %9.4f s  %8.1f MiB peak  %s" % (name, seconds, peak/float(1<<20),
+			"  ".join("%s %.4g" % (k, v,) for (k, v,) in sorted(entry.items())
+				if k.endswith("_per_s"))))
+
+	# Model encoding, on fresh editable models each run
+	psx = synth_psx(scene)
+	mdls = list(psx.mdls)
+	mfaces = sum(mdl.face_count() for mdl in mdls)
+	def pmodel_write():
+		fp = thps.SectionWriter()
+		for mdl in mdls:
+			mdl.write(fp=fp)
+		pmodel_write.nbytes = fp.tell()
+	record("pmodel_write", pmodel_write, items=mfaces, unit="faces",
+		nbytes=lambda: pmodel_write.nbytes)
+
+	# Physdata grid over the encoded models
+	psx.encode_models()
+	ox0 = numpy.array([o.px+(m.xmin<<12) for (o, m,) in zip(psx.objs, psx.mdls)], dtype=numpy.int64)
+	oz0 = numpy.array([o.pz+(m.zmin<<12) for (o, m,) in zip(psx.objs, psx.mdls)], dtype=numpy.int64)
+	ox1 = numpy.array([o.px+(m.xmax<<12) for (o, m,) in zip(psx.objs, psx.mdls)], dtype=numpy.int64)
+	oz1 = numpy.array([o.pz+(m.zmax<<12) for (o, m,) in zip(psx.objs, psx.mdls)], dtype=numpy.int64)
+	def physgrid():
+		physgrid.nbytes = len(thps.PhysGrid.auto(ox0=ox0, oz0=oz0, ox1=ox1, oz1=oz1).encode())
+	record("physgrid", physgrid, items=len(psx.objs), unit="objects",
+		nbytes=lambda: physgrid.nbytes)
+
+	# Texture and palette tables
+	def textures():
+		fp = thps.SectionWriter()
+		for tex in psx.intern_palettes():
+			if tex.bpp == 4:
+				tex.write_palette_4bpp(fp=fp)
+			else:
+				tex.write_palette_8bpp(fp=fp)
+		for tex in psx.texs:
+			tex.write_data(fp=fp)
+		textures.nbytes = fp.tell()
+	record("textures", textures, items=len(psx.texs), unit="textures",
+		nbytes=lambda: textures.nbytes)
+
+	# Whole .psx file
+	psx_fname = os.path.join(tmpdir, "bench.psx")
+	record("psx_write", lambda: psx.write(fname=psx_fname), items=mfaces, unit="faces",
+		nbytes=lambda: file_size(psx_fname))
+
+	# Trigger file
+	trg = synth_trg(nodes=args.nodes)
+	trg_fname = os.path.join(tmpdir, "bench_t.trg")
+	record("trg_write", lambda: trg.write(fname=trg_fname), items=len(trg.chunks), unit="nodes",
+		nbytes=lambda: file_size(trg_fname))
+
+	# Densely linked graph: bulk nodes, links, checks and renumbering
+	rng = numpy.random.default_rng(args.seed)
+	graph_points = rng.integers(-0x10000, 0x10000, (args.nodes, 3))
+	graph_links = rng.integers(0, args.nodes, (args.nodes*8, 2))
+	def trg_build():
+		trg = thps.TRG()
+		trg.link_nodes(trg.new_railpoints(graph_points), graph_links)
+		trg.validate()
+		trg.renumber()
+	record("trg_build", trg_build, items=len(graph_links), unit="links")
+
+	# Rail network from the scene's curves
+	rail_count = sum(len(rail.points) for rail in scene.rails)
+	def rail_nodes():
+		trg = thps.TRG()
+		points, links, = thps.rail_network(scene.rails, tolerance=thps.fix12(0.01/thps.BLEND_PER_THPS))
+		trg.link_nodes(trg.new_railpoints(points<<12), links)
+	record("rail_nodes", rail_nodes, items=rail_count, unit="points")
+
+	# Occlusion: BVH over every triangle, rays from the first few meshes
+	ao_verts = []
+	ao_fvidxs = []
+	for mesh in scene.meshes:
+		verts = thps.mesh_fix12_vertices(mesh.marr.co, scale=mesh.scale, location=mesh.location)
+		floops, _, = thps.mesh_fan_faces(mesh.marr, verts)
+		ao_verts.append(verts)
+		ao_fvidxs.append(numpy.where(floops >= 0, mesh.marr.loop_vidxs[floops], -1))
+	ao_tris = numpy.concatenate([thps.mesh_triangles(v, f) for (v, f,) in zip(ao_verts, ao_fvidxs)])
+	ao_probe = [(v, thps.mesh_vertex_normals(v, f)) for (v, f,) in list(zip(ao_verts, ao_fvidxs))[:16]]
+	ao_rays = 16*sum(len(v) for (v, _,) in ao_probe)
+	def ao_bake():
+		bvh = thps.TriangleBVH(ao_tris)
+		for (verts, normals,) in ao_probe:
+			thps.bake_occlusion(bvh, verts, normals, distance=1024, rays=16)
+	record("ao_bake", ao_bake, items=ao_rays, unit="rays")
+
+	# Pre-flight checks over the whole scene
+	record("preflight", lambda: thps.preflight_scene(scene,
+		mesh_parts=numpy.zeros(len(scene.meshes), dtype=numpy.int64)),
+		items=nfaces, unit="faces")
+
+	# Full pipeline, headless and through the stub bpy
+	lvl_fname = os.path.join(tmpdir, "lvl_t.trg")
+	record("export_scene", lambda: thps.export_scene(scene, lvl_fname, workers=args.workers),
+		items=nfaces, unit="faces",
+		nbytes=lambda: file_size(os.path.join(tmpdir, "lvl.psx")))
+
+	real_bpy = thps.bpy
+	thps.bpy = StubBpy(scene)
+	try:
+		record("export_trg", lambda: thps.export_trg(lvl_fname, workers=args.workers),
+			items=nfaces, unit="faces",
+			nbytes=lambda: file_size(os.path.join(tmpdir, "lvl.psx")))
+	finally:
+		thps.bpy = real_bpy
+
+	return results
+
+def compare(results, baseline, *, threshold):
+	# Returns the names of the benchmarks that got slower than the threshold allows
+	slower = []
+	print("")
+	print("%-16s %10s %10s %8s %10s" % ("benchmark", "seconds", "baseline", "ratio", "peak ratio"))
+	for (name, entry,) in sorted(results.items()):
+		base = baseline["results"].get(name)
+		if base is None:
+			print("%-16s %10.4f %10s" % (name, entry["seconds"], "-"))
+			continue
+		ratio = entry["seconds"]/base["seconds"]
+		peak_ratio = entry["peak_bytes"]/float(max(base["peak_bytes"], 1))
+		flag = ""
+		if ratio > 1.0+threshold:
+			slower.append(name)
+			flag = "  SLOWER"
+		print("%-16s %10.4f %10.4f %8.3f %10.3f%s" % (name, entry["seconds"], base["seconds"],
+			ratio, peak_ratio, flag,))
+	return slower
+
+def main(argv=None):
+	parser = argparse.ArgumentParser(description="Benchmark the THPS PSX/TRG writers on a synthetic level.")
+	parser.add_argument("--objects", type=int, default=200, help="meshes in the level")
+	parser.add_argument("--verts", type=int, default=225, help="vertices per mesh")
+	parser.add_argument("--textures", type=int, default=16, help="distinct images")
+	parser.add_argument("--texture-size", type=int, default=64, help="image width and height")
+	parser.add_argument("--lamps", type=int, default=8, help="lamps to bake")
+	parser.add_argument("--nodes", type=int, default=2000, help="TRG rail nodes")
+	parser.add_argument("--rails", type=int, default=64, help="curves in the level")
+	parser.add_argument("--workers", type=int, default=1, help="model encoding processes")
+	parser.add_argument("--repeat", type=int, default=3, help="timed runs per benchmark")
+	parser.add_argument("--seed", type=int, default=1)
+	parser.add_argument("--save", metavar="JSON", help="write the results here")
+	parser.add_argument("--compare", metavar="JSON", help="compare against a saved baseline")
+	parser.add_argument("--threshold", type=float, default=0.2,
+		help="fail a comparison when this much slower (0.2 is 20%%)")
+	args = parser.parse_args(argv)
+
+	config = {k: getattr(args, k) for k in ("objects", "verts", "textures", "texture_size",
+		"lamps", "nodes", "rails", "workers", "seed",)}
+	with tempfile.TemporaryDirectory() as tmpdir:
+		results = run_benchmarks(args, tmpdir)
+
+	report = {
+		"config": config,
+		"python": platform.python_version(),
+		"numpy": numpy.__version__,
+		"machine": platform.machine(),
+		"results": results,
+	}
+	if args.save is not None:
+		with open(args.save, "w") as fp:
+			json.dump(report, fp, indent=1, sort_keys=True)
+
+	if args.compare is not None:
+		with open(args.compare, "r") as fp:
+			baseline = json.load(fp)
+		if baseline.get("config") != config:
+			print("warning: baseline was run with %s" % (baseline.get("config"),))
+		if compare(results, baseline, threshold=args.threshold):
+			return 1
+	return 0
+
+if __name__ == "__main__":
+	sys.exit(main())
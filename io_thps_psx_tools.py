@@ -11,11 +11,28 @@ bl_info = {
 	"category": "Import-Export",
 }
 
+import array
+import collections
+import concurrent.futures
+import contextlib
+import hashlib
+import io
+import json
 import math
+import mmap
+import os
 import random
 import struct
+import tempfile
+import time
+import tracemalloc
 
-import bpy
+try:
+	import bpy
+except ImportError:
+	# Running headless, see the command line interface at the bottom
+	bpy = None
+import numpy
 
 #
 # Helpers
@@ -31,6 +48,201 @@ def pad32(fp):
 	if skipme != 0:
 		fp.write(b"\x00"*skipme)
 
+class SectionWriter(object):
+	# File-like buffer for a whole output file.
+	# Pointers and lengths are written as placeholders against symbolic
+	# labels, then resolved in one pass when the file is committed.
+	def __init__(self):
+		self.data = bytearray()
+		self.labels = {}
+		self.relocs = []
+
+	def tell(self):
+		return len(self.data)
+
+	def write(self, b):
+		self.data += b
+
+	def label(self, name):
+		assert name not in self.labels
+		self.labels[name] = self.tell()
+
+	def pointer(self, name, *, base=None):
+		# u32 holding labels[name], or labels[name]-labels[base]
+		self.relocs.append((self.tell(), name, base,))
+		self.write(b"\x00\x00\x00\x00")
+
+	def resolve(self):
+		for (pos, name, base,) in self.relocs:
+			v = self.labels[name]
+			if base is not None:
+				v -= self.labels[base]
+			struct.pack_into("<I", self.data, pos, v)
+		self.relocs = []
+
+	def commit(self, fname):
+		self.resolve()
+		write_file_atomic(fname, self.data)
+
+	def abort(self):
+		pass
+
+class StreamSectionWriter(SectionWriter):
+	# SectionWriter that goes straight to a temporary file next to fname,
+	# so only the labels and relocations stay in memory.
+	def __init__(self, fname):
+		self.fp, self.tmp_fname, = open_file_atomic(fname)
+		self.pos = 0
+		self.labels = {}
+		self.relocs = []
+
+	def tell(self):
+		return self.pos
+
+	def write(self, b):
+		self.fp.write(b)
+		self.pos += len(b)
+
+	def resolve(self):
+		for (pos, name, base,) in self.relocs:
+			v = self.labels[name]
+			if base is not None:
+				v -= self.labels[base]
+			self.fp.seek(pos)
+			self.fp.write(struct.pack("<I", v))
+		self.fp.seek(self.pos)
+		self.relocs = []
+
+	def commit(self, fname):
+		self.resolve()
+		finish_file_atomic(self.fp, self.tmp_fname, fname)
+
+	def abort(self):
+		abort_file_atomic(self.fp, self.tmp_fname)
+
+def open_file_atomic(fname):
+	# Returns (fp, temporary name) for a file that finish_file_atomic()
+	# later moves over fname
+	dname = os.path.dirname(os.path.abspath(fname))
+	fd, tmp_fname = tempfile.mkstemp(dir=dname, prefix=".", suffix=".tmp")
+	return os.fdopen(fd, "w+b"), tmp_fname
+
+def finish_file_atomic(fp, tmp_fname, fname, *, sync=True):
+	try:
+		with fp:
+			if sync:
+				fp.flush()
+				os.fsync(fp.fileno())
+		# Keep the mode of a file being replaced, as writing over it would.
+		# mkstemp() makes files 0600, so new ones get the umask default.
+		try:
+			mode = os.stat(fname).st_mode & 0o7777
+		except FileNotFoundError:
+			umask = os.umask(0)
+			os.umask(umask)
+			mode = 0o666 & ~umask
+		os.chmod(tmp_fname, mode)
+		os.replace(tmp_fname, fname)
+	except BaseException:
+		os.unlink(tmp_fname)
+		raise
+
+def abort_file_atomic(fp, tmp_fname):
+	fp.close()
+	os.unlink(tmp_fname)
+
+def write_file_atomic(fname, data, *, sync=True):
+	# Never leave a half-written file behind for the game to load
+	fp, tmp_fname, = open_file_atomic(fname)
+	try:
+		fp.write(data)
+	except BaseException:
+		abort_file_atomic(fp, tmp_fname)
+		raise
+	finish_file_atomic(fp, tmp_fname, fname, sync=sync)
+
+#
+# On-disk cache
+#
+
+BLOB_CACHE_MAX_BYTES = 256<<20
+
+def default_cache_dir():
+	base = os.environ.get("XDG_CACHE_HOME",
+		os.path.join(os.path.expanduser("~"), ".cache"))
+	return os.path.join(base, "thps_psx_tools")
+
+def cache_key(*parts):
+	h = hashlib.sha1()
+	for part in parts:
+		if isinstance(part, numpy.ndarray):
+			part = numpy.ascontiguousarray(part)
+			h.update(repr((part.dtype.str, part.shape,)).encode("utf-8"))
+			h.update(part.tobytes())
+		elif isinstance(part, (bytes, bytearray,)):
+			h.update(part)
+		else:
+			h.update(repr(part).encode("utf-8"))
+		h.update(b"\x00")
+	return h.hexdigest()
+
+class BlobCache(object):
+	# Content-addressed blobs, one file per key.
+	# The mtime doubles as the LRU timestamp.
+	def __init__(self, *, path, max_bytes=BLOB_CACHE_MAX_BYTES):
+		self.path = path
+		self.max_bytes = max_bytes
+		self.hits = 0
+		self.misses = 0
+
+	def blob_fname(self, key):
+		return os.path.join(self.path, key[:2], key[2:])
+
+	def get(self, key):
+		fname = self.blob_fname(key)
+		try:
+			with open(fname, "rb") as fp:
+				data = fp.read()
+			os.utime(fname, None)
+		except OSError:
+			self.misses += 1
+			return None
+		self.hits += 1
+		return data
+
+	def put(self, key, data):
+		fname = self.blob_fname(key)
+		os.makedirs(os.path.dirname(fname), exist_ok=True)
+		write_file_atomic(fname, data, sync=False)
+
+	def trim(self):
+		# Evict least recently used blobs until we fit
+		entries = []
+		for dname in os.listdir(self.path) if os.path.isdir(self.path) else []:
+			dpath = os.path.join(self.path, dname)
+			if not os.path.isdir(dpath):
+				continue
+			for fname in os.listdir(dpath):
+				# Skip blobs that another exporter is still writing
+				if fname.startswith("."):
+					continue
+				fpath = os.path.join(dpath, fname)
+				try:
+					st = os.stat(fpath)
+				except OSError:
+					continue
+				entries.append((st.st_mtime, st.st_size, fpath,))
+
+		total = sum(e[1] for e in entries)
+		for (mtime, size, fpath,) in sorted(entries):
+			if total <= self.max_bytes:
+				break
+			try:
+				os.unlink(fpath)
+			except OSError:
+				continue
+			total -= size
+
 def rgb15(r,g,b):
 	r >>= 3
 	g >>= 3
@@ -39,6 +251,103 @@ def rgb15(r,g,b):
 	v = (b<<10)|(g<<5)|(r)#|0x8000
 	return v
 
+#
+# Export statistics
+#
+
+class ExportStats(object):
+	# Wall time per phase, counters and output section sizes for one export.
+	# Phases accumulate over repeated entries, and a nested phase's time is
+	# not counted again in the phase around it.
+	# With trace_memory, each phase also records its tracemalloc peak.
+	def __init__(self, *, trace_memory=False):
+		self.trace_memory = trace_memory
+		self.phases = {}
+		self.counters = {}
+		self.sections = {}
+		# Objects per Physdata cell, (gdivz, gdivx)
+		self.grid_occupancy = None
+		self.stack = []
+		self.started_tracing = False
+
+	def traced_peak(self):
+		if not self.trace_memory:
+			return 0
+		return tracemalloc.get_traced_memory()[1]
+
+	@contextlib.contextmanager
+	def phase(self, name):
+		entry = self.phases.setdefault(name, {"seconds": 0.0, "calls": 0})
+		if self.trace_memory and not tracemalloc.is_tracing():
+			tracemalloc.start()
+			self.started_tracing = True
+		if len(self.stack) != 0:
+			self.stack[-1]["peak"] = max(self.stack[-1]["peak"], self.traced_peak())
+		if self.trace_memory and hasattr(tracemalloc, "reset_peak"):
+			tracemalloc.reset_peak()
+		frame = {
+			"base": (tracemalloc.get_traced_memory()[0] if self.trace_memory else 0),
+			"peak": 0,
+			"nested": 0.0,
+		}
+		self.stack.append(frame)
+		t = time.perf_counter()
+		try:
+			yield entry
+		finally:
+			elapsed = time.perf_counter()-t
+			self.stack.pop()
+			entry["seconds"] += elapsed-frame["nested"]
+			entry["calls"] += 1
+			peak = max(frame["peak"], self.traced_peak())
+			if self.trace_memory:
+				entry["peak_bytes"] = max(entry.get("peak_bytes", 0), peak-frame["base"])
+			if len(self.stack) != 0:
+				self.stack[-1]["nested"] += elapsed
+				self.stack[-1]["peak"] = max(self.stack[-1]["peak"], peak)
+
+	def count(self, name, n=1):
+		self.counters[name] = self.counters.get(name, 0)+n
+
+	def section(self, name, nbytes):
+		self.sections[name] = self.sections.get(name, 0)+nbytes
+
+	def close(self):
+		if self.started_tracing:
+			tracemalloc.stop()
+			self.started_tracing = False
+
+	def report_lines(self):
+		lines = []
+		total = sum(entry["seconds"] for entry in self.phases.values())
+		for (name, entry,) in self.phases.items():
+			line = "%s: %.3f s (%.0f%%)" % (name, entry["seconds"],
+				entry["seconds"]*100.0/max(total, 1e-9),)
+			if "peak_bytes" in entry:
+				line += ", peak %.1f MiB" % (entry["peak_bytes"]/float(1<<20),)
+			lines.append(line)
+		if len(self.counters) != 0:
+			lines.append(", ".join("%s %s" % (name, value,)
+				for (name, value,) in sorted(self.counters.items())))
+		if len(self.sections) != 0:
+			lines.append("bytes: " + ", ".join("%s %d" % (name, value,)
+				for (name, value,) in self.sections.items()))
+		if self.grid_occupancy is not None:
+			occ = self.grid_occupancy
+			lines.append("grid: %dx%d cells, %d empty, %.2f objects per cell, %d at most" % (
+				occ.shape[1], occ.shape[0], int((occ == 0).sum()), float(occ.mean()), int(occ.max()),))
+		return lines
+
+	def save(self, fname):
+		data = {
+			"phases": self.phases,
+			"counters": self.counters,
+			"sections": self.sections,
+		}
+		if self.grid_occupancy is not None:
+			data["grid_occupancy"] = self.grid_occupancy.tolist()
+		write_file_atomic(fname, json.dumps(data, indent=1, sort_keys=True).encode("utf-8"))
+
 #
 # TRG pickup types
 #
@@ -111,10 +420,13 @@ class TRG(object):
 		def __init__(self, *, idx, typ):
 			self.idx = idx
 			self.typ = typ
+			# Ordered for writing, with a set so that linking stays O(1)
 			self.links = []
+			self.link_set = set()
 
 		def add_link(self, *, other):
-			if other not in self.links:
+			if other not in self.link_set:
+				self.link_set.add(other)
 				self.links.append(other)
 
 		def write_links(self, *, fp):
@@ -274,33 +586,386 @@ class TRG(object):
 		self.chunks.append(node)
 		return node
 
+	def new_railpoints(self, points, *, unk1=16):
+		# Bulk version of new_railpoint(), takes (N,3) positions
+		idx = len(self.chunks)
+		nodes = [TRG.RailPointNode(idx=idx+i, px=px, py=py, pz=pz, unk1=unk1)
+			for (i, (px, py, pz,),) in enumerate(points.tolist())]
+		self.chunks.extend(nodes)
+		return nodes
+
+	def link_nodes(self, nodes, links):
+		# Links nodes[a] -> nodes[b] for each (a, b) row of links
+		for (a, b,) in links.tolist():
+			nodes[a].add_link(other=nodes[b])
+
+	def validate(self):
+		# Links are written as 16-bit chunk indices
+		if len(self.chunks) > 0xFFFF:
+			raise Exception("too many TRG nodes: %d" % (len(self.chunks),))
+		for (i, chunk,) in enumerate(self.chunks):
+			if chunk.idx != i:
+				raise Exception("TRG node %d thinks it is node %d" % (i, chunk.idx,))
+			if len(chunk.links) > 0xFFFF:
+				raise Exception("TRG node %d has too many links: %d" % (i, len(chunk.links),))
+			for link in chunk.links:
+				if link.idx >= len(self.chunks) or self.chunks[link.idx] is not link:
+					raise Exception("TRG node %d links to a node that is not in this file" % (i,))
+
+	def renumber(self):
+		# Reorder the chunks breadth first along the links, in either
+		# direction, so that linked nodes end up close together.
+		# Node 0 stays first, as the game starts from there.
+		index = {id(chunk): i for (i, chunk,) in enumerate(self.chunks)}
+		adjacent = [[] for chunk in self.chunks]
+		for (i, chunk,) in enumerate(self.chunks):
+			for link in chunk.links:
+				j = index[id(link)]
+				adjacent[i].append(j)
+				adjacent[j].append(i)
+
+		order = []
+		seen = [False]*len(self.chunks)
+		for start in range(len(self.chunks)):
+			if seen[start]:
+				continue
+			seen[start] = True
+			queue = collections.deque([start])
+			while queue:
+				i = queue.popleft()
+				order.append(i)
+				for j in adjacent[i]:
+					if not seen[j]:
+						seen[j] = True
+						queue.append(j)
+
+		self.chunks = [self.chunks[i] for i in order]
+		for (i, chunk,) in enumerate(self.chunks):
+			chunk.idx = i
+
 	def write(self, *, fname):
-		fp = open(fname, "wb")
+		self.validate()
+		fp = SectionWriter()
 
 		# Header
 		fp.write(b"_TRG\x02\x00\x00\x00")
 		fp.write(struct.pack("<I",len(self.chunks)))
 
-		# Chunk pointer table prefill
-		chunk_ptrtab_pos = fp.tell()
-		chunk_ptrtab = []
-		fp.write(b"\x00"*4*len(self.chunks))
+		# Chunk pointer table
+		for (i, chunk,) in enumerate(self.chunks):
+			fp.pointer(("chunk", i,))
 
 		# Chunks
-		for chunk in self.chunks:
-			chunk_ptrtab.append(fp.tell())
+		for (i, chunk,) in enumerate(self.chunks):
+			fp.label(("chunk", i,))
 			chunk.write(fp=fp)
 			pad16(fp)
 
-		# Chunk pointer table postfill
-		ptr_tmp0 = fp.tell()
-		fp.seek(chunk_ptrtab_pos)
-		for ptr in chunk_ptrtab:
-			fp.write(struct.pack("<I", ptr))
-		fp.seek(ptr_tmp0)
-
 		# Done
-		fp.close()
+		fp.commit(fname)
+
+#
+# PSX model encoding
+#
+
+PSX_VERTEX_DTYPE = numpy.dtype([
+	("x", "<i2"),
+	("y", "<i2"),
+	("z", "<i2"),
+	("pad", "<i2"),
+])
+
+PSX_PLANE_DTYPE = PSX_VERTEX_DTYPE
+
+PSX_FACE_DTYPE = numpy.dtype([
+	("rflags", "<u2"),
+	("length", "<u2"),
+	("vidxs", "u1", (4,)),
+	("cmd", "u1", (4,)),
+	("idx", "<u2"),
+	("sflags", "<u2"),
+	# Textured faces only from here on
+	("tidx", "<u4"),
+	("tpoints", "u1", (4, 2,)),
+])
+
+PSX_FACE_UNTEXTURED_LEN = 0x0010
+PSX_FACE_TEXTURED_LEN = 0x001C
+assert PSX_FACE_DTYPE.itemsize == PSX_FACE_TEXTURED_LEN
+
+def pmodel_bounds(verts):
+	# verts is an (N,3+) int64 array
+	xyz = verts[:, :3]
+	lo = xyz.min(axis=0)
+	hi = xyz.max(axis=0)
+	if lo.min() < -0x8000 or hi.max() > 0x7FFF:
+		raise Exception("vertex out of 16-bit range")
+
+	# Same float path as math.sqrt on a Python int, so this is bit-exact
+	dist2 = (xyz*xyz).sum(axis=1)
+	radius = numpy.ceil(numpy.sqrt((dist2<<24).astype(numpy.float64)))
+	radius = int(radius.max())&~0xFFF
+
+	return (radius,
+		int(lo[0]), int(hi[0]),
+		int(lo[1]), int(hi[1]),
+		int(lo[2]), int(hi[2]),)
+
+def pmodel_planes(verts, vidxs):
+	# Returns an (F,) PSX_PLANE_DTYPE array, one plane per face
+	v0 = verts[vidxs[:, 0], :3]
+	d1 = verts[vidxs[:, 1], :3] - v0
+	d2 = verts[vidxs[:, 2], :3] - v0
+	fx = ((d2[:, 1]*d1[:, 2])-(d2[:, 2]*d1[:, 1])).astype(numpy.float64)
+	fy = ((d2[:, 2]*d1[:, 0])-(d2[:, 0]*d1[:, 2])).astype(numpy.float64)
+	fz = ((d2[:, 0]*d1[:, 1])-(d2[:, 1]*d1[:, 0])).astype(numpy.float64)
+	fx /= 4096.0
+	fy /= 4096.0
+	fz /= 4096.0
+	norm = 1.0/numpy.maximum(numpy.sqrt(fx*fx+fy*fy+fz*fz), 0.0001)
+	planes = numpy.zeros(len(vidxs), dtype=PSX_PLANE_DTYPE)
+	planes["x"] = numpy.rint(fx*norm*4096)
+	planes["y"] = numpy.rint(fy*norm*4096)
+	planes["z"] = numpy.rint(fz*norm*4096)
+	return planes
+
+def pmodel_share_planes(planes):
+	# Returns (unique planes in order of first use, plane index per face).
+	# Planes are only normals, so coplanar and parallel faces can share one.
+	uniq, first, inv, = numpy.unique(planes.view(numpy.uint64),
+		return_index=True, return_inverse=True)
+	order = numpy.argsort(first, kind="stable")
+	rank = numpy.empty(len(order), dtype=numpy.int64)
+	rank[order] = numpy.arange(len(order))
+	return planes[first[order]], rank[inv.reshape(-1)]
+
+def pmodel_face_bytes(recs):
+	# Untextured faces only get the first 16 bytes of their record
+	is_textured = ((recs["rflags"] & 0x0003) != 0)
+	recs["length"] = numpy.where(is_textured,
+		PSX_FACE_TEXTURED_LEN,
+		PSX_FACE_UNTEXTURED_LEN)
+	raw = recs.view(numpy.uint8).reshape((-1, PSX_FACE_TEXTURED_LEN))
+	mask = numpy.empty(raw.shape, dtype=bool)
+	mask[:, :PSX_FACE_UNTEXTURED_LEN] = True
+	mask[:, PSX_FACE_UNTEXTURED_LEN:] = is_textured[:, None]
+	return raw[mask].tobytes()
+
+def encode_pmodel(desc):
+	# Returns (blob, bounds) for a PModel.describe() tuple.
+	# This is a plain function so that it can run in a worker process.
+	unk1, gunkl2, verts, recs, share_planes, = desc
+	bounds = pmodel_bounds(verts)
+
+	# Faces point at their plane through their idx field
+	planes = pmodel_planes(verts, recs["vidxs"].astype(numpy.int64))
+	if share_planes:
+		planes, recs["idx"], = pmodel_share_planes(planes)
+	else:
+		recs["idx"] = numpy.arange(len(recs))
+	radius, xmin, xmax, ymin, ymax, zmin, zmax, = bounds
+
+	vtxs = numpy.zeros(len(verts), dtype=PSX_VERTEX_DTYPE)
+	vtxs["x"] = verts[:, 0]
+	vtxs["y"] = verts[:, 1]
+	vtxs["z"] = verts[:, 2]
+	vtxs["pad"] = verts[:, 3]
+
+	blob = b"".join([
+		struct.pack("<HHHHIhhhhhhI"
+			, unk1
+			, len(verts)
+			, len(planes)
+			, len(recs)
+			, radius
+			, xmax, xmin
+			, ymax, ymin
+			, zmax, zmin
+			, gunkl2),
+		vtxs.tobytes(),
+		planes.tobytes(),
+		pmodel_face_bytes(recs),
+	])
+	return blob, bounds
+
+def pmodel_blob_face_offsets(blob):
+	# Byte offsets of each face record in an encoded model
+	nverts, nplanes, nfaces, = struct.unpack_from("<HHH", blob, 2)
+	return face_chain_offsets(blob, 28 + 8*nverts + 8*nplanes, len(blob), nfaces)
+
+def pmodel_blob_remap_textures(blob, tmap):
+	# tmap maps old tidx -> (new tidx, u offset, v offset).
+	# Hands back blob itself when none of its textures moved.
+	raw = numpy.frombuffer(blob, dtype=numpy.uint8)
+	offs = pmodel_blob_face_offsets(blob)
+	textured = (raw[offs] & 0x03) != 0
+	offs = offs[textured]
+	if len(offs) == 0:
+		return blob
+	recs = gather_records(raw, offs, PSX_FACE_DTYPE)
+	old, inv, = numpy.unique(recs["tidx"], return_inverse=True)
+	new = numpy.array([tmap[tidx] for tidx in old.tolist()], dtype=numpy.int64).reshape((-1, 3))
+	if (new[:, 0] == old).all() and not new[:, 1:].any():
+		return blob
+	inv = inv.reshape(-1)
+	tpoints = recs["tpoints"].astype(numpy.int64) + new[inv, None, 1:]
+	if len(tpoints) != 0 and (tpoints.min() < 0 or tpoints.max() > 0xFF):
+		raise Exception("texture points out of range after remap")
+	recs["tidx"] = new[inv, 0]
+	recs["tpoints"] = tpoints
+	out = numpy.frombuffer(bytearray(blob), dtype=numpy.uint8)
+	out[offs[:, None] + numpy.arange(PSX_FACE_DTYPE.itemsize)] = \
+		recs.view(numpy.uint8).reshape((-1, PSX_FACE_DTYPE.itemsize))
+	return out.tobytes()
+
+#
+# PSX texture sets
+#
+
+TEXTURE_PAGE_SIZE = 256
+
+def texture_unpack(data, *, iw, ih, bpp):
+	raw = numpy.frombuffer(bytes(data), dtype=numpy.uint8)
+	if bpp == 4:
+		idx = numpy.empty(len(raw)*2, dtype=numpy.uint8)
+		idx[0::2] = raw & 0xF
+		idx[1::2] = raw >> 4
+		raw = idx
+	return raw.reshape((ih, iw))
+
+def shelf_pack(sizes, *, page_w=TEXTURE_PAGE_SIZE, page_h=TEXTURE_PAGE_SIZE):
+	# Returns (page, x, y) for each (w, h), tallest first onto shelves
+	order = sorted(range(len(sizes)), key=lambda i: (-sizes[i][1], -sizes[i][0], i))
+	places = [None]*len(sizes)
+	pages = [] # lists of [y, height, next x]
+	for i in order:
+		w, h, = sizes[i]
+		assert w <= page_w and h <= page_h
+		placed = False
+		for (pi, shelves,) in enumerate(pages):
+			for shelf in shelves:
+				if h <= shelf[1] and shelf[2]+w <= page_w:
+					places[i] = (pi, shelf[2], shelf[0],)
+					shelf[2] += w
+					placed = True
+					break
+			if not placed:
+				y = shelves[-1][0]+shelves[-1][1]
+				if y+h <= page_h:
+					shelves.append([y, h, w])
+					places[i] = (pi, 0, y,)
+					placed = True
+			if placed:
+				break
+		if not placed:
+			pages.append([[0, h, w]])
+			places[i] = (len(pages)-1, 0, 0,)
+	return places
+
+#
+# PSX physics grid
+#
+
+PHYS_GRID_DEFAULT_DIVS = (20, 20,)
+PHYS_GRID_AUTO_MAX_CELLS = 0x1000
+PHYS_GRID_MAX_DIVS = 0xFFFF
+
+class PhysGrid(object):
+	def __init__(self, *, ox0, oz0, ox1, oz1, gdivx, gdivz):
+		# ox0..oz1 are the XZ bounds of each object in world space
+		assert 1 <= gdivx <= PHYS_GRID_MAX_DIVS
+		assert 1 <= gdivz <= PHYS_GRID_MAX_DIVS
+		self.gdivx = gdivx
+		self.gdivz = gdivz
+
+		# With no objects the grid just covers the origin, with every cell empty
+		empty = (len(ox0) == 0)
+		self.g_xmin = (0 if empty else int(ox0.min()))-0x20000
+		self.g_zmin = (0 if empty else int(oz0.min()))-0x20000
+		g_xmax = (0 if empty else int(ox1.max()))+0x20000
+		g_zmax = (0 if empty else int(oz1.max()))+0x20000
+		g_xlen = (g_xmax-self.g_xmin+gdivx-1)//gdivx
+		g_zlen = (g_zmax-self.g_zmin+gdivz-1)//gdivz
+		self.g_len = max(g_xlen, g_zlen) # grid must be regular!
+		self.g_xmax = self.g_xmin + self.g_len*gdivx
+		self.g_zmax = self.g_zmin + self.g_len*gdivz
+
+		# Inclusive cell ranges covered by each object.
+		# Something touching a cell edge goes into both cells.
+		self.cx0 = numpy.clip(-((self.g_xmin-ox0)//self.g_len)-1, 0, gdivx-1)
+		self.cz0 = numpy.clip(-((self.g_zmin-oz0)//self.g_len)-1, 0, gdivz-1)
+		self.cx1 = numpy.clip((ox1-self.g_xmin)//self.g_len, 0, gdivx-1)
+		self.cz1 = numpy.clip((oz1-self.g_zmin)//self.g_len, 0, gdivz-1)
+
+	def occupancy(self):
+		# Objects per cell, via a 2D difference array
+		diff = numpy.zeros((self.gdivz+1, self.gdivx+1), dtype=numpy.int64)
+		numpy.add.at(diff, (self.cz0, self.cx0), 1)
+		numpy.add.at(diff, (self.cz0, self.cx1+1), -1)
+		numpy.add.at(diff, (self.cz1+1, self.cx0), -1)
+		numpy.add.at(diff, (self.cz1+1, self.cx1+1), 1)
+		return diff.cumsum(axis=0).cumsum(axis=1)[:self.gdivz, :self.gdivx]
+
+	def encode(self):
+		head = struct.pack("<iiiiHH"
+			, self.g_xmin
+			, self.g_zmin
+			, self.g_xmax
+			, self.g_zmax
+			, self.gdivx
+			, self.gdivz)
+
+		# Bin every (object, cell) pair directly.
+		# Pairs are made in object order and the sort is stable,
+		# so each cell lists its objects in ascending order.
+		nx = self.cx1-self.cx0+1
+		nz = self.cz1-self.cz0+1
+		npairs = nx*nz
+		pobj = numpy.repeat(numpy.arange(len(npairs)), npairs)
+		k = numpy.arange(len(pobj)) - numpy.repeat(numpy.cumsum(npairs)-npairs, npairs)
+		pcell = ((self.cz0[pobj] + k//nx[pobj])*self.gdivx
+			+ (self.cx0[pobj] + k%nx[pobj]))
+		order = numpy.argsort(pcell, kind="mergesort")
+		pobj = pobj[order]
+		pcell = pcell[order]
+
+		# Each cell is 0, 0, count, objects..., 0
+		ncells = self.gdivx*self.gdivz
+		counts = numpy.bincount(pcell, minlength=ncells)
+		before = numpy.cumsum(counts)-counts
+		cellpos = 4*numpy.arange(ncells) + before
+		words = numpy.zeros(4*ncells+len(pobj), dtype="<u4")
+		words[cellpos+2] = counts
+		words[cellpos[pcell] + 3 + (numpy.arange(len(pcell)) - before[pcell])] = pobj
+
+		return head + words.tobytes()
+
+	@classmethod
+	def auto(cls, *, ox0, oz0, ox1, oz1, max_cells=PHYS_GRID_AUTO_MAX_CELLS):
+		# Pick the divisions with the fewest objects in the worst cell,
+		# preferring the coarsest grid that achieves it.
+		if len(ox0) == 0:
+			return cls(ox0=ox0, oz0=oz0, ox1=ox1, oz1=oz1, gdivx=1, gdivz=1)
+		xspan = int(ox1.max()-ox0.min())+2*0x20000
+		zspan = int(oz1.max()-oz0.min())+2*0x20000
+		span = max(xspan, zspan)
+		best = None
+		d = 1
+		while True:
+			clen = (span+d-1)//d
+			gdivx = (xspan+clen-1)//clen
+			gdivz = (zspan+clen-1)//clen
+			if gdivx*gdivz > max_cells or max(gdivx, gdivz) > PHYS_GRID_MAX_DIVS:
+				break
+			grid = cls(ox0=ox0, oz0=oz0, ox1=ox1, oz1=oz1, gdivx=gdivx, gdivz=gdivz)
+			score = (int(grid.occupancy().max()), gdivx*gdivz,)
+			if best is None or score < best[0]:
+				best = (score, grid,)
+			d = (d+1 if d < 64 else d+(d>>3))
+
+		if best is None:
+			return cls(ox0=ox0, oz0=oz0, ox1=ox1, oz1=oz1, gdivx=1, gdivz=1)
+		return best[1]
 
 #
 # PSX class
@@ -319,7 +984,7 @@ class PSX(object):
 			self.ty = ty
 
 		def write(self, *, fp):
-			fp.write(struct.pack("<IiiiIHHhhII"
+			fp.write(struct.pack("<IiiiIHHhhI"
 				, self.flags1
 				, self.px
 				, self.py
@@ -330,115 +995,179 @@ class PSX(object):
 				, self.tx
 				, self.ty
 				, 0
-				, 0 #self.ptr_paldata
 				))
-			self.ptr_paldata_ptr = fp.tell() - 4
+			fp.pointer("paldata")
 
 	class PModel(object):
-		class PFace(object):
-			def __init__(self, *, idx, rflags, vidxs, cmd, sflags, tidx=0, tpoints=[]):
-				self.idx = idx
-				self.rflags = rflags
-				self.vidxs = list(vidxs)
-				self.cmd = list(cmd)
-				self.sflags = sflags
-				self.tidx = tidx
-				self.tpoints = list(tpoints)
-
-		def __init__(self, *, idx, unk1=8, gunkl2=0xFFFF7FFF):
+		# Vertices and faces are kept as flat typed columns rather than one
+		# Python object per face, see describe() for how they get packed
+		def __init__(self, *, idx, unk1=8, gunkl2=0xFFFF7FFF, share_planes=True):
 			self.unk1 = unk1
+			self.share_planes = share_planes
 
-			self.vertices = []
-			self.faces = []
+			self.verts = array.array("i") # x, y, z
+			self.f_rflags = array.array("i")
+			self.f_vidxs = array.array("i") # 4 per face
+			self.f_cmd = array.array("i") # 4 per face
+			self.f_sflags = array.array("i")
+			self.f_tidx = array.array("q")
+			self.f_tpoints = array.array("i") # 4 (u, v) pairs per face
 
 			self.gunkl2 = gunkl2
 
+		def vertex_count(self):
+			return len(self.verts)//3
+
+		def face_count(self):
+			return len(self.f_rflags)
+
 		def vertex(self, x,y,z):
-			idx = len(self.vertices)
-			p = (x,y,z,0,)
-			self.vertices.append(p)
+			idx = self.vertex_count()
+			self.verts.extend((x,y,z,))
 			return idx
 
 		def face(self, *, rflags, vidxs, cmd, sflags, tidx=0, tpoints=[]):
-			idx = len(self.faces)
-			self.faces.append(PSX.PModel.PFace(
-				idx=idx,
-				rflags=rflags,
-				vidxs=vidxs,
-				cmd=cmd,
-				sflags=sflags,
-				tidx=tidx,
-				tpoints=tpoints))
+			idx = self.face_count()
+			tpoints = list(tpoints)[:4]
+			tpoints += [(0, 0,)]*(4-len(tpoints))
+			self.f_rflags.append(rflags)
+			self.f_vidxs.extend(vidxs)
+			self.f_cmd.extend(cmd)
+			self.f_sflags.append(sflags)
+			self.f_tidx.append(tidx)
+			for (u, v,) in tpoints:
+				self.f_tpoints.extend((u, v,))
+			assert len(self.f_vidxs) == len(self.f_cmd) == 4*(idx+1)
+
+			return idx
+
+		def add_vertices(self, verts):
+			# Bulk version of vertex(), takes an (N, 3) array
+			verts = numpy.asarray(verts, dtype=numpy.int32).reshape((-1, 3))
+			idx = self.vertex_count()
+			self.verts.frombytes(verts.tobytes())
+			return idx
 
+		def add_faces(self, *, rflags, vidxs, cmd, sflags, tidx=0, tpoints=0):
+			# Bulk version of face(), takes one array per column
+			rflags = numpy.asarray(rflags, dtype=numpy.int32).reshape(-1)
+			count = len(rflags)
+			def column(a, shape, dtype):
+				return numpy.broadcast_to(numpy.asarray(a, dtype=dtype), shape).tobytes()
+			idx = self.face_count()
+			self.f_rflags.frombytes(rflags.tobytes())
+			self.f_vidxs.frombytes(column(vidxs, (count, 4,), numpy.int32))
+			self.f_cmd.frombytes(column(cmd, (count, 4,), numpy.int32))
+			self.f_sflags.frombytes(column(sflags, (count,), numpy.int32))
+			self.f_tidx.frombytes(column(tidx, (count,), numpy.int64))
+			self.f_tpoints.frombytes(column(tpoints, (count, 4, 2,), numpy.int32))
 			return idx
 
+		def remap_textures(self, tmap):
+			# Same as PEncodedModel.remap_textures, on the columns
+			textured = (numpy.asarray(self.f_rflags) & 0x0003) != 0
+			if not textured.any():
+				return
+			tidx = numpy.array(self.f_tidx, dtype=numpy.int64)
+			tpoints = numpy.array(self.f_tpoints, dtype=numpy.int32).reshape((-1, 4, 2))
+			for old_idx in numpy.unique(tidx[textured]).tolist():
+				ntidx, ou, ov, = tmap[old_idx]
+				sel = numpy.flatnonzero(textured & (tidx == old_idx))
+				tidx[sel] = ntidx
+				tpoints[sel] += (ou, ov,)
+			self.f_tidx = array.array("q", tidx.tobytes())
+			self.f_tpoints = array.array("i", tpoints.tobytes())
+
+		def describe(self):
+			# Plain picklable description for encode_pmodel()
+			verts = numpy.zeros((self.vertex_count(), 4,), dtype=numpy.int64)
+			verts[:, :3] = numpy.asarray(self.verts).reshape((-1, 3))
+			recs = numpy.zeros(self.face_count(), dtype=PSX_FACE_DTYPE)
+			recs["rflags"] = numpy.asarray(self.f_rflags)
+			recs["sflags"] = numpy.asarray(self.f_sflags)
+			vidxs = numpy.asarray(self.f_vidxs).reshape((-1, 4))
+			cmd = numpy.asarray(self.f_cmd).reshape((-1, 4))
+			if vidxs.size != 0 and (vidxs.min() < 0 or vidxs.max() > 0xFF):
+				raise Exception("face vertex index does not fit in 8 bits")
+			if cmd.size != 0 and (cmd.min() < 0 or cmd.max() > 0xFF):
+				raise Exception("face colour index does not fit in 8 bits")
+			recs["vidxs"] = vidxs
+			recs["cmd"] = cmd
+			tsel = numpy.flatnonzero((recs["rflags"] & 0x0003) != 0)
+			if len(tsel) != 0:
+				recs["tidx"][tsel] = numpy.asarray(self.f_tidx)[tsel]
+				recs["tpoints"][tsel] = numpy.asarray(self.f_tpoints).reshape((-1, 4, 2))[tsel]
+
+			return (self.unk1, self.gunkl2, verts, recs, self.share_planes,)
+
+		def encode(self):
+			blob, bounds, = encode_pmodel(self.describe())
+			(self.radius,
+				self.xmin, self.xmax,
+				self.ymin, self.ymax,
+				self.zmin, self.zmax,) = bounds
+			return blob
+
 		def write(self, *, fp):
-			fp.write(struct.pack("<H", self.unk1))
-			fp.write(struct.pack("<H", len(self.vertices)))
-			fp.write(struct.pack("<H", len(self.faces))) # planes!
-			fp.write(struct.pack("<H", len(self.faces)))
-
-			self.radius = max(*map(
-				lambda x: int(math.ceil(math.sqrt(
-					(x[0]**2+x[1]**2+x[2]**2)<<24
-				)))&~0xFFF,
-				self.vertices))
-			fp.write(struct.pack("<I", self.radius))
-			self.xmin = min(*map(lambda x: x[0], self.vertices))
-			self.xmax = max(*map(lambda x: x[0], self.vertices))
-			self.ymin = min(*map(lambda x: x[1], self.vertices))
-			self.ymax = max(*map(lambda x: x[1], self.vertices))
-			self.zmin = min(*map(lambda x: x[2], self.vertices))
-			self.zmax = max(*map(lambda x: x[2], self.vertices))
-			fp.write(struct.pack("<hh", self.xmax, self.xmin))
-			fp.write(struct.pack("<hh", self.ymax, self.ymin))
-			fp.write(struct.pack("<hh", self.zmax, self.zmin))
-			fp.write(struct.pack("<I", self.gunkl2))
-
-			for vtx in self.vertices:
-				fp.write(struct.pack("<hhhh", *vtx))
-
-			# Planes
-			for face in self.faces:
-				v0 = self.vertices[face.vidxs[0]]
-				v1 = self.vertices[face.vidxs[1]]
-				v2 = self.vertices[face.vidxs[2]]
-				x0,y0,z0,_, = v0
-				x1,y1,z1,_, = v1
-				x2,y2,z2,_, = v2
-				dx1,dy1,dz1 = x1-x0,y1-y0,z1-z0
-				dx2,dy2,dz2 = x2-x0,y2-y0,z2-z0
-				fx = float((dy2*dz1)-(dz2*dy1))
-				fy = float((dz2*dx1)-(dx2*dz1))
-				fz = float((dx2*dy1)-(dy2*dx1))
-				fx /= 4096.0
-				fy /= 4096.0
-				fz /= 4096.0
-				norm = 1.0/max((fx*fx+fy*fy+fz*fz)**0.5, 0.0001)
-				# BOUNCY SHIT
-				#norm *= (1.0/0.84 if (face_data[j]["f_surf_flags"] & 0x0100) == 0 else 1.0*0.84)
-				fx *= norm
-				fy *= norm
-				fz *= norm
-				x = int(round(fx*4096))
-				y = int(round(fy*4096))
-				z = int(round(fz*4096))
-				fp.write(struct.pack("<hhhh", x, y, z, 0))
-
-			# Actually the faces this time
-			for face in self.faces:
-				is_gouraud = ((face.rflags & 0x0800) != 0)
-				is_textured = ((face.rflags & 0x0003) != 0)
-				is_triangle = ((face.rflags & 0x0010) != 0)
-				length = (0x001C if is_textured else 0x0010)
-				fp.write(struct.pack("<HH", face.rflags, length))
-				fp.write(struct.pack("<BBBB", *face.vidxs))
-				fp.write(struct.pack("<BBBB", *face.cmd))
-				fp.write(struct.pack("<HH", face.idx, face.sflags))
-				if is_textured:
-					fp.write(struct.pack("<I", face.tidx))
-					for i in range(4):
-						fp.write(struct.pack("<BB", *face.tpoints[i]))
+			fp.write(self.encode())
+
+		def bounds(self):
+			# Only valid after encode()
+			return (self.radius,
+				self.xmin, self.xmax,
+				self.ymin, self.ymax,
+				self.zmin, self.zmax,)
+
+	class PEncodedModel(object):
+		def __init__(self, *, idx, blob, bounds):
+			self.idx = idx
+			self.blob = bytes(blob)
+			(self.radius,
+				self.xmin, self.xmax,
+				self.ymin, self.ymax,
+				self.zmin, self.zmax,) = bounds
+
+		def encode(self):
+			return self.blob
+
+		def write(self, *, fp):
+			fp.write(self.blob)
+
+		def bounds(self):
+			return (self.radius,
+				self.xmin, self.xmax,
+				self.ymin, self.ymax,
+				self.zmin, self.zmax,)
+
+		def remap_textures(self, tmap):
+			self.blob = pmodel_blob_remap_textures(self.blob, tmap)
+
+	class PSpooledModel(PEncodedModel):
+		# Encoded model that lives in the PSX spool file, see PSX.store_model
+		def __init__(self, *, idx, spool, offs, length, bounds):
+			self.idx = idx
+			self.spool = spool
+			self.offs = offs
+			self.length = length
+			(self.radius,
+				self.xmin, self.xmax,
+				self.ymin, self.ymax,
+				self.zmin, self.zmax,) = bounds
+
+		@property
+		def blob(self):
+			self.spool.seek(self.offs)
+			blob = self.spool.read(self.length)
+			assert len(blob) == self.length
+			return blob
+
+		def remap_textures(self, tmap):
+			# Face records keep their size, so this can go back in place
+			blob = self.blob
+			nblob = pmodel_blob_remap_textures(blob, tmap)
+			if nblob is not blob:
+				self.spool.seek(self.offs)
+				self.spool.write(nblob)
 
 	class PTexture(object):
 		def __init__(self, *, idx, name, iw, ih, unk1=0x0000, bpp, pal, data):
@@ -455,13 +1184,15 @@ class PSX(object):
 			self.pal = list(pal)
 			if len(self.pal) != (1<<self.bpp):
 				raise Exception("palette size invalid for bpp")
-			self.data = list(data)
+			self.data = bytes(data)
+			# Name of the CLUT this texture uses, see PSX.intern_palettes
+			self.palname = name
 
 		def write_palette_4bpp(self, *, fp):
 			if self.bpp != 4:
 				raise Exception("bpp must be 4 for this function")
 
-			fp.write(struct.pack("<I", self.name))
+			fp.write(struct.pack("<I", self.palname))
 			for i in range(16):
 				fp.write(struct.pack("<H", self.pal[i]))
 
@@ -469,7 +1200,7 @@ class PSX(object):
 			if self.bpp != 8:
 				raise Exception("bpp must be 8 for this function")
 
-			fp.write(struct.pack("<I", self.name))
+			fp.write(struct.pack("<I", self.palname))
 			for i in range(256):
 				fp.write(struct.pack("<H", self.pal[i]))
 
@@ -478,24 +1209,44 @@ class PSX(object):
 			fp.write(struct.pack("<IIIIHH"
 				, self.unk1
 				, 1<<self.bpp
-				, self.name
+				, self.palname
 				, self.idx
 				, self.iw
 				, self.ih))
-			fp.write(bytes(self.data))
+			fp.write(self.data)
 			pad32(fp)
 
-	def __init__(self):
+	def __init__(self, *, streaming=False, spool_dir=None, share_planes=True, name_base=0xFEED0000,
+			model_name_base=0xBEEF0000):
 		self.objs = []
 		self.mdls = []
 		self.texs = []
 		self.palents = [[random.randint(0,255) for i in range(3)]+[0] for j in range(256)]
 
+		# When streaming, encoded models are moved out to a spool file
+		# and write() goes straight to disk, so memory use does not grow
+		# with the size of the level
+		self.streaming = streaming
+		self.spool = (tempfile.TemporaryFile(dir=spool_dir) if streaming else None)
+
+		# Without this, every face gets its own plane like the old writer
+		self.share_planes = share_planes
+
+		# Texture and model names are numbered from these, so files
+		# that are loaded at the same time can be kept apart
+		self.name_base = name_base
+		self.model_name_base = model_name_base
+
+	def close(self):
+		if self.spool is not None:
+			self.spool.close()
+			self.spool = None
+
 	def texture(self, *, iw, ih, unk1=0x0000, bpp, pal, data):
 		idx = len(self.texs)
 		tex = PSX.PTexture(
 			idx=idx,
-			name=0xFEED0000+idx,
+			name=self.name_base+idx,
 			iw=iw,
 			ih=ih,
 			unk1=unk1,
@@ -507,6 +1258,128 @@ class PSX(object):
 
 		return tex.idx, tex.name
 
+	def intern_palettes(self):
+		# Textures with identical CLUTs share the first one's palette.
+		# Returns the textures whose palettes need writing.
+		owners = {}
+		for tex in self.texs:
+			owner = owners.setdefault((tex.bpp, tuple(tex.pal),), tex)
+			tex.palname = owner.name
+		return list(owners.values())
+
+	def merge_palettes(self, *, tolerance):
+		# Snap each CLUT onto an earlier one of the same depth if no entry
+		# is off by more than tolerance in any 5-bit channel.
+		# Transparent (0x0000) and semi-transparent entries must match exactly.
+		# Returns the number of textures that changed palette.
+		merged = 0
+		for bpp in (4, 8,):
+			texs = [tex for tex in self.texs if tex.bpp == bpp]
+			if len(texs) < 2:
+				continue
+			pals = numpy.array([tex.pal for tex in texs], dtype=numpy.int64)
+			chans = numpy.stack([(pals>>sh)&0x1F for sh in (0, 5, 10,)], axis=-1)
+			flags = (pals == 0)*2 + (pals>>15)
+			reps = []
+			for i in range(len(texs)):
+				for j in reps:
+					if (flags[i] == flags[j]).all() and (abs(chans[i]-chans[j]) <= tolerance).all():
+						if texs[i].pal != texs[j].pal:
+							texs[i].pal = list(texs[j].pal)
+							merged += 1
+						break
+				else:
+					reps.append(i)
+		return merged
+
+	def build_texture_set(self, *, atlas=True):
+		# Drops duplicate textures and packs textures that share a palette
+		# into page-sized atlases, then points every face at the result.
+		# Returns a report with one entry per output texture.
+
+		# Deduplicate by content
+		canon = {}
+		uniq = []
+		dup_of = {}
+		for tex in self.texs:
+			key = hashlib.sha1(repr((tex.bpp, tex.iw, tex.ih, tex.unk1, list(tex.pal),)).encode("utf-8")
+				+ bytes(tex.data)).digest()
+			if key not in canon:
+				canon[key] = tex
+				uniq.append(tex)
+			dup_of[tex.idx] = canon[key]
+
+		# Group by depth and palette; a texture can only have one CLUT
+		groups = {}
+		for tex in uniq:
+			groups.setdefault((tex.bpp, tex.unk1, tuple(tex.pal),), []).append(tex)
+
+		out = []
+		placement = {} # id(tex) -> (output texture, u offset, v offset)
+		report = []
+		for tex in uniq:
+			(bpp, unk1, pal,) = gkey = (tex.bpp, tex.unk1, tuple(tex.pal),)
+			group = groups.pop(gkey, None)
+			if group is None:
+				continue
+			if not atlas or len(group) < 2:
+				for member in group:
+					out.append(member)
+					placement[id(member)] = (member, 0, 0,)
+					report.append({"bpp": bpp, "iw": member.iw, "ih": member.ih,
+						"textures": 1, "used": member.iw*member.ih,})
+				continue
+
+			places = shelf_pack([(m.iw, m.ih,) for m in group])
+			for pi in range(max(p[0] for p in places)+1):
+				members = [(m, x, y,) for (m, (mp, x, y,),) in zip(group, places) if mp == pi]
+				if len(members) == 1:
+					m, x, y, = members[0]
+					out.append(m)
+					placement[id(m)] = (m, 0, 0,)
+					report.append({"bpp": bpp, "iw": m.iw, "ih": m.ih,
+						"textures": 1, "used": m.iw*m.ih,})
+					continue
+				aw = max(x+m.iw for (m, x, y,) in members)
+				ah = max(y+m.ih for (m, x, y,) in members)
+				pixels = numpy.zeros((ah, aw,), dtype=numpy.uint8)
+				for (m, x, y,) in members:
+					pixels[y:y+m.ih, x:x+m.iw] = texture_unpack(m.data, iw=m.iw, ih=m.ih, bpp=bpp)
+				atex = PSX.PTexture(
+					idx=0,
+					name=0,
+					iw=aw,
+					ih=ah,
+					unk1=unk1,
+					bpp=bpp,
+					pal=pal,
+					data=texture_pack(pixels, bpp=bpp))
+				out.append(atex)
+				for (m, x, y,) in members:
+					placement[id(m)] = (atex, x, y,)
+				report.append({"bpp": bpp, "iw": aw, "ih": ah,
+					"textures": len(members),
+					"used": sum(m.iw*m.ih for (m, x, y,) in members),})
+
+		for (i, tex,) in enumerate(out):
+			tex.idx = i
+			tex.name = self.name_base+i
+		for (entry, tex,) in zip(report, out):
+			entry["fill"] = entry["used"]/float(TEXTURE_PAGE_SIZE*TEXTURE_PAGE_SIZE)
+
+		tmap = {}
+		for (old_idx, tex,) in dup_of.items():
+			ntex, ou, ov, = placement[id(tex)]
+			tmap[old_idx] = (ntex.idx, ou, ov,)
+		self.texs = out
+
+		# Point the faces at the new textures, unless none of them moved
+		if any(v != (k, 0, 0,) for (k, v,) in tmap.items()):
+			for mdl in self.mdls:
+				mdl.remap_textures(tmap)
+
+		return report
+
 	def thing(self, *, flags1=0, px,py,pz, tx=0,ty=0, unk1=8, gunkl2=0xFFFF7FFF):
 		idx = len(self.objs)
 		assert idx == len(self.mdls)
@@ -522,159 +1395,503 @@ class PSX(object):
 		mdl = PSX.PModel(
 			idx=idx,
 			unk1=unk1,
-			gunkl2=gunkl2)
+			gunkl2=gunkl2,
+			share_planes=self.share_planes)
 		self.objs.append(obj)
 		self.mdls.append(mdl)
 		return mdl
 
-	def write(self, *, fname):
-		fp = open(fname, "wb")
+	def encoded_thing(self, *, flags1=0, px,py,pz, tx=0,ty=0, blob, bounds):
+		idx = len(self.objs)
+		assert idx == len(self.mdls)
+		obj = PSX.PObject(
+			idx=idx,
+			flags1=flags1,
+			px=px,
+			py=py,
+			pz=pz,
+			model_idx=idx,
+			tx=tx,
+			ty=ty)
+		self.objs.append(obj)
+		self.mdls.append(None)
+		return self.store_model(idx, blob=blob, bounds=bounds)
+
+	def store_model(self, idx, *, blob, bounds):
+		# Keep an encoded model, in the spool file if streaming
+		if self.spool is not None:
+			offs = self.spool.seek(0, 2)
+			self.spool.write(blob)
+			mdl = PSX.PSpooledModel(
+				idx=idx,
+				spool=self.spool,
+				offs=offs,
+				length=len(blob),
+				bounds=bounds)
+		else:
+			mdl = PSX.PEncodedModel(
+				idx=idx,
+				blob=blob,
+				bounds=bounds)
+		self.mdls[idx] = mdl
+		return mdl
 
+	def encode_models(self, *, workers=1, pool=None):
+		# Encode every model that is still in editable form, on pool if
+		# given (it has workers processes), else on a pool made for the call.
+		# Returns the indices that were encoded.
+		todo = [i for (i, mdl,) in enumerate(self.mdls)
+			if not isinstance(mdl, PSX.PEncodedModel)]
+		if workers <= 1 or len(todo) <= 1:
+			for i in todo:
+				self.freeze_model(i)
+			return todo
+		if pool is None:
+			with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
+				return self.encode_models(workers=workers, pool=pool)
+
+		descs = [self.mdls[i].describe() for i in todo]
+		chunksize = max(1, len(todo)//(workers*4))
+		results = pool.map(encode_pmodel, descs, chunksize=chunksize)
+		for (i, (blob, bounds,),) in zip(todo, results):
+			self.store_model(i, blob=blob, bounds=bounds)
+		return todo
+
+	def freeze_model(self, idx):
+		# Encode a finished model now and keep only its bytes
+		mdl = self.mdls[idx]
+		blob = mdl.encode()
+		return self.store_model(idx, blob=blob, bounds=mdl.bounds())
+
+	def write(self, *, fname, gdivs=PHYS_GRID_DEFAULT_DIVS, workers=1, stats=None):
+		if stats is None:
+			stats = ExportStats()
+		self.encode_models(workers=workers)
+		fp = (StreamSectionWriter(fname) if self.streaming else SectionWriter())
+		try:
+			self.write_sections(fp=fp, gdivs=gdivs, stats=stats)
+		except BaseException:
+			fp.abort()
+			raise
+		fp.commit(fname)
+
+	def write_sections(self, *, fp, gdivs, stats):
 		# Header
 		fp.write(b"\x04\x00\x02\x00")
-		metaptr_ptr = fp.tell() # how meta
-		fp.write(struct.pack("<I", 0))
+		fp.pointer("meta") # how meta
 
 		# Objects
-		palptrs = []
 		fp.write(struct.pack("<I", len(self.objs)))
 		for obj in self.objs:
 			obj.write(fp=fp)
-			palptrs.append(obj.ptr_paldata_ptr)
+		stats.section("psx_objects", fp.tell())
 
 		# Models
-		mdlptrs = []
+		mark = fp.tell()
 		fp.write(struct.pack("<I", len(self.mdls)))
-		mdlptrs_ptr = fp.tell()
-		for mdl in self.mdls:
-			fp.write(struct.pack("<I", 0))
-		for mdl in self.mdls:
+		for (i, mdl,) in enumerate(self.mdls):
+			fp.pointer(("mdl", i,))
+		for (i, mdl,) in enumerate(self.mdls):
 			pad32(fp)
-			mdlptrs.append(fp.tell())
+			fp.label(("mdl", i,))
 			mdl.write(fp=fp)
 		pad32(fp)
-		tmp = fp.tell()
-		fp.seek(mdlptrs_ptr)
-		for p in mdlptrs:
-			fp.write(struct.pack("<I", p))
-		fp.seek(tmp)
+		stats.section("psx_models", fp.tell()-mark)
 
 		# Palette
-		tmp = fp.tell()
-		fp.seek(metaptr_ptr)
-		fp.write(struct.pack("<I", tmp))
-		fp.seek(tmp)
+		mark = fp.tell()
+		fp.label("meta")
 		fp.write(b"RGBs")
 		while len(self.palents) < 256:
 			self.palents.append([random.randint(0,255) for i in range(3)]+[0])
 		assert len(self.palents) == 256
 		fp.write(struct.pack("<I", len(self.palents)*4))
-		paldata_ptr = fp.tell()
+		fp.label("paldata")
 		for rgbs in self.palents:
 			fp.write(struct.pack("<BBBB", *rgbs))
 
-		# Patchup
-		tmp = fp.tell()
-		for p in palptrs:
-			fp.seek(p)
-			fp.write(struct.pack("<I", paldata_ptr))
-		fp.seek(tmp)
+		stats.section("psx_palette", fp.tell()-mark)
 
 		# Physdata
+		mark = fp.tell()
 		fp.write(struct.pack("<I", 10))
-		phys_len_ptr = fp.tell()
-		fp.write(struct.pack("<I", 0))
-		phys_beg = fp.tell()
-
-		GDIVX = 20
-		GDIVZ = 20
-		#print(repr(self.objs))
-		#print(repr(self.mdls))
-		g_xmin = min(map(lambda o,m: o.px + (m.xmin<<12), self.objs, self.mdls))-0x20000
-		g_zmin = min(map(lambda o,m: o.pz + (m.zmin<<12), self.objs, self.mdls))-0x20000
-		g_xmax = max(map(lambda o,m: o.px + (m.xmax<<12), self.objs, self.mdls))+0x20000
-		g_zmax = max(map(lambda o,m: o.pz + (m.zmax<<12), self.objs, self.mdls))+0x20000
-		g_xlen = (g_xmax-g_xmin+GDIVX-1)//GDIVX
-		g_zlen = (g_zmax-g_zmin+GDIVZ-1)//GDIVZ
-		g_xlen = g_zlen = max(g_xlen, g_zlen) # grid must be regular!
-		g_xmax = g_xmin + g_xlen*GDIVX
-		g_zmax = g_zmin + g_zlen*GDIVZ
-		fp.write(struct.pack("<i", g_xmin))
-		fp.write(struct.pack("<i", g_zmin))
-		fp.write(struct.pack("<i", g_xmax))
-		fp.write(struct.pack("<i", g_zmax))
-		fp.write(struct.pack("<HH", GDIVX, GDIVZ))
-
-		for z in range(GDIVZ):
-			for x in range(GDIVX):
-				xmin = g_xmin + (x+0)*g_xlen
-				xmax = g_xmin + (x+1)*g_xlen
-				zmin = g_zmin + (z+0)*g_zlen
-				zmax = g_zmin + (z+1)*g_zlen
-
-				L = []
-				for (i, (o, m,),) in enumerate(zip(self.objs, self.mdls)):
-					if o.px+(m.xmax<<12) < xmin: continue
-					if o.pz+(m.zmax<<12) < zmin: continue
-					if o.px+(m.xmin<<12) > xmax: continue
-					if o.pz+(m.zmin<<12) > zmax: continue
-					L.append(i)
-
-				fp.write(struct.pack("<II", 0, 0))
-				fp.write(struct.pack("<I", len(L)))
-				for n in L:
-					fp.write(struct.pack("<I", n))
-				fp.write(struct.pack("<I", 0))
-
-		# Patchup for Physdata
-		phys_end = fp.tell()
-		fp.seek(phys_len_ptr)
-		fp.write(struct.pack("<I", phys_end-phys_beg))
-		fp.seek(phys_end)
+		fp.pointer("phys_end", base="phys_beg")
+		fp.label("phys_beg")
+
+		with stats.phase("physgrid"):
+			ox0 = numpy.array([o.px + (m.xmin<<12) for (o, m,) in zip(self.objs, self.mdls)], dtype=numpy.int64)
+			oz0 = numpy.array([o.pz + (m.zmin<<12) for (o, m,) in zip(self.objs, self.mdls)], dtype=numpy.int64)
+			ox1 = numpy.array([o.px + (m.xmax<<12) for (o, m,) in zip(self.objs, self.mdls)], dtype=numpy.int64)
+			oz1 = numpy.array([o.pz + (m.zmax<<12) for (o, m,) in zip(self.objs, self.mdls)], dtype=numpy.int64)
+			if gdivs is None:
+				grid = PhysGrid.auto(ox0=ox0, oz0=oz0, ox1=ox1, oz1=oz1)
+			else:
+				grid = PhysGrid(ox0=ox0, oz0=oz0, ox1=ox1, oz1=oz1,
+					gdivx=gdivs[0], gdivz=gdivs[1])
+			self.physgrid = grid
+			fp.write(grid.encode())
+
+		fp.label("phys_end")
+		stats.section("psx_physdata", fp.tell()-mark)
+		stats.grid_occupancy = grid.occupancy()
 
 		# End of chunk list
 		fp.write(struct.pack("<i", -1))
+		mark = fp.tell()
 
 		# Model names
 		for (i, mdl,) in enumerate(self.mdls):
-			fp.write(struct.pack("<I", 0xBEEF0000+i))
+			fp.write(struct.pack("<I", self.model_name_base+i))
 
 		# Texture names
 		fp.write(struct.pack("<I", len(self.texs)))
 		for tex in self.texs:
 			fp.write(struct.pack("<I", tex.name))
 
+		stats.section("psx_names", fp.tell()-mark)
+
 		# 4bpp palettes
-		p4list = list(filter(lambda x: x.bpp == 4, self.texs))
+		mark = fp.tell()
+		pallist = self.intern_palettes()
+		p4list = list(filter(lambda x: x.bpp == 4, pallist))
 		fp.write(struct.pack("<I", len(p4list)))
 		for tex in p4list:
 			tex.write_palette_4bpp(fp=fp)
 
 		# 8bpp palettes
-		p8list = list(filter(lambda x: x.bpp == 8, self.texs))
+		p8list = list(filter(lambda x: x.bpp == 8, pallist))
 		fp.write(struct.pack("<I", len(p8list)))
 		for tex in p8list:
 			tex.write_palette_8bpp(fp=fp)
 
+		stats.section("psx_cluts", fp.tell()-mark)
+
 		# Actual texture data
+		mark = fp.tell()
 		fp.write(struct.pack("<I", len(self.texs)))
-		texlist_ptrs = []
-		texlist_ptrs_ptr = fp.tell()
-		for tex in self.texs:
-			fp.write(struct.pack("<I", 0))
+		for (i, tex,) in enumerate(self.texs):
+			fp.pointer(("tex", i,))
 
-		for tex in self.texs:
-			texlist_ptrs.append(fp.tell())
+		for (i, tex,) in enumerate(self.texs):
+			fp.label(("tex", i,))
 			tex.write_data(fp=fp)
+		stats.section("psx_textures", fp.tell()-mark)
 
-		tmp_texlist_ptrs = fp.tell()
-		fp.seek(texlist_ptrs_ptr)
-		for p in texlist_ptrs:
-			fp.write(struct.pack("<I", p))
-		fp.seek(tmp_texlist_ptrs)
+#
+# Readers
+#
 
-		# Done
-		fp.close()
+PSX_OBJECT_DTYPE = numpy.dtype([
+	("flags1", "<u4"),
+	("px", "<i4"),
+	("py", "<i4"),
+	("pz", "<i4"),
+	("unk1", "<u4"),
+	("unk2", "<u2"),
+	("model_idx", "<u2"),
+	("tx", "<i2"),
+	("ty", "<i2"),
+	("unk3", "<u4"),
+	("paldata", "<u4"),
+])
+
+PSX_MODEL_HEADER_DTYPE = numpy.dtype([
+	("unk1", "<u2"),
+	("nverts", "<u2"),
+	("nplanes", "<u2"),
+	("nfaces", "<u2"),
+	("radius", "<u4"),
+	("xmax", "<i2"),
+	("xmin", "<i2"),
+	("ymax", "<i2"),
+	("ymin", "<i2"),
+	("zmax", "<i2"),
+	("zmin", "<i2"),
+	("gunkl2", "<u4"),
+])
+
+PSX_TEXTURE_HEADER_DTYPE = numpy.dtype([
+	("unk1", "<u4"),
+	("palsize", "<u4"),
+	("palname", "<u4"),
+	("idx", "<u4"),
+	("iw", "<u2"),
+	("ih", "<u2"),
+])
+
+PSX_PALETTE_4BPP_DTYPE = numpy.dtype([
+	("name", "<u4"),
+	("pal", "<u2", (16,)),
+])
+
+PSX_PALETTE_8BPP_DTYPE = numpy.dtype([
+	("name", "<u4"),
+	("pal", "<u2", (256,)),
+])
+
+def chain_offsets(step, start, count):
+	# Offsets of count records laid end to end from start, where step[i]
+	# is the length of a record starting at i. This is pointer doubling,
+	# so it stays vectorised however long the chain is.
+	size = len(step)
+	jump = numpy.empty(size+1, dtype=numpy.int64)
+	jump[:size] = numpy.minimum(numpy.arange(size)+numpy.maximum(step, 1), size)
+	jump[size] = size
+	offs = numpy.array([min(start, size)], dtype=numpy.int64)
+	while len(offs) < count:
+		offs = numpy.concatenate([offs, jump[offs]])
+		jump = jump[jump]
+	offs = offs[:count]
+	if len(offs) != 0 and offs.max() >= size:
+		raise Exception("record chain runs off the end of its region")
+	return offs
+
+def face_chain_offsets(raw, beg, end, nfaces):
+	# Byte offsets of nfaces face records laid end to end in raw[beg:end].
+	# Records are a whole number of halfwords, length in the second one.
+	nhalves = (end-beg)>>1
+	lengths = numpy.zeros(nhalves, dtype=numpy.int64)
+	if nhalves >= 2:
+		lengths[:-1] = numpy.frombuffer(raw, dtype="<u2",
+			count=nhalves-1, offset=beg+2)>>1
+	return beg + 2*chain_offsets(lengths, 0, nfaces)
+
+def gather_records(raw, offs, dtype):
+	# Copy fixed-size records at arbitrary byte offsets into one array
+	offs = numpy.asarray(offs, dtype=numpy.int64)
+	if len(offs) != 0 and (offs.min() < 0 or offs.max()+dtype.itemsize > len(raw)):
+		raise ValueError("record runs past the end of the buffer")
+	idx = offs[:, None] + numpy.arange(dtype.itemsize)
+	return raw[idx].reshape(-1).view(dtype)
+
+def release_mapping(buf):
+	# Close a file mapping handed out as numpy views
+	try:
+		buf.close()
+	except BufferError:
+		# A caller still holds a view; the map goes once that does
+		pass
+
+class PSXReader(object):
+	# Read-only view of a .psx file.
+	# Sections are located on first use and handed out as numpy views
+	# over the mapped file wherever the records are fixed size.
+	class PModelView(object):
+		def __init__(self, *, reader, offs, end):
+			raw = reader.raw
+			self.offs = offs
+			self.end = end
+			self.header = numpy.frombuffer(reader.buf, dtype=PSX_MODEL_HEADER_DTYPE,
+				count=1, offset=offs)[0]
+			voffs = offs+PSX_MODEL_HEADER_DTYPE.itemsize
+			self.vertices = numpy.frombuffer(reader.buf, dtype=PSX_VERTEX_DTYPE,
+				count=int(self.header["nverts"]), offset=voffs)
+			poffs = voffs+self.vertices.nbytes
+			self.planes = numpy.frombuffer(reader.buf, dtype=PSX_PLANE_DTYPE,
+				count=int(self.header["nplanes"]), offset=poffs)
+			self.faces_offs = poffs+self.planes.nbytes
+			self.raw = raw
+			self._face_offsets = None
+
+		def face_offsets(self):
+			# File offsets of each face record
+			if self._face_offsets is None:
+				self._face_offsets = face_chain_offsets(self.raw, self.faces_offs,
+					self.end, int(self.header["nfaces"]))
+			return self._face_offsets
+
+		def faces(self):
+			# (F,) PSX_FACE_DTYPE, with the texture fields of untextured faces zeroed
+			recs = gather_records(self.raw, self.face_offsets(), PSX_FACE_DTYPE)
+			untextured = (recs["length"] < PSX_FACE_TEXTURED_LEN)
+			recs["tidx"][untextured] = 0
+			recs["tpoints"][untextured] = 0
+			return recs
+
+		def bounds(self):
+			h = self.header
+			return (int(h["radius"]),
+				int(h["xmin"]), int(h["xmax"]),
+				int(h["ymin"]), int(h["ymax"]),
+				int(h["zmin"]), int(h["zmax"]),)
+
+	def __init__(self, fname):
+		with open(fname, "rb") as fp:
+			self.buf = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+		self.raw = numpy.frombuffer(self.buf, dtype=numpy.uint8)
+
+		magic, self.meta_offs, = struct.unpack_from("<4sI", self.buf, 0)
+		if magic != b"\x04\x00\x02\x00":
+			raise Exception("not a supported PSX file: %s" % (repr(magic),))
+
+		offs = 8
+		nobjs, = struct.unpack_from("<I", self.buf, offs)
+		self.objs = numpy.frombuffer(self.buf, dtype=PSX_OBJECT_DTYPE,
+			count=nobjs, offset=offs+4)
+		offs += 4+self.objs.nbytes
+		nmdls, = struct.unpack_from("<I", self.buf, offs)
+		self.mdl_offsets = numpy.frombuffer(self.buf, dtype="<u4",
+			count=nmdls, offset=offs+4)
+
+		self._mdls = {}
+		self._chunks = None
+		self._tail = None
+
+	def close(self):
+		self.objs = self.mdl_offsets = self.raw = None
+		self._mdls = {}
+		self._chunks = self._tail = None
+		release_mapping(self.buf)
+		self.buf = None
+
+	def model(self, idx):
+		if idx not in self._mdls:
+			offs = int(self.mdl_offsets[idx])
+			# A model ends where the next thing in the file starts
+			later = self.mdl_offsets[self.mdl_offsets > offs]
+			end = int(later.min()) if len(later) != 0 else self.meta_offs
+			self._mdls[idx] = PSXReader.PModelView(reader=self, offs=offs, end=end)
+		return self._mdls[idx]
+
+	def chunks(self):
+		# {tag: (offset, length)} for the tagged chunks after the model data
+		if self._chunks is None:
+			self._chunks = {}
+			offs = self.meta_offs
+			while True:
+				tag, = struct.unpack_from("<i", self.buf, offs)
+				if tag == -1:
+					break
+				length, = struct.unpack_from("<I", self.buf, offs+4)
+				self._chunks[tag] = (offs+8, length,)
+				offs += 8+length
+			self._chunks_end = offs+4
+		return self._chunks
+
+	def palents(self):
+		# (256,4) view of the RGBs chunk
+		offs, length, = self.chunks()[struct.unpack("<i", b"RGBs")[0]]
+		return numpy.frombuffer(self.buf, dtype=numpy.uint8,
+			count=length, offset=offs).reshape((-1, 4))
+
+	def physgrid(self):
+		# Returns (header, cell object lists) from the Physdata chunk
+		offs, length, = self.chunks()[10]
+		head = struct.unpack_from("<iiiiHH", self.buf, offs)
+		g_xmin, g_zmin, g_xmax, g_zmax, gdivx, gdivz, = head
+		words = numpy.frombuffer(self.buf, dtype="<u4",
+			count=(length-20)>>2, offset=offs+20)
+
+		# Each cell is 0, 0, count, objects..., 0
+		steps = numpy.zeros(len(words), dtype=numpy.int64)
+		steps[:-2] = words[2:].astype(numpy.int64)+4
+		cellpos = chain_offsets(steps, 0, gdivx*gdivz)
+		counts = words[cellpos+2].astype(numpy.int64)
+		cells = numpy.split(words, numpy.stack([cellpos+3, cellpos+3+counts], axis=1).reshape(-1))[1::2]
+		return head, cells
+
+	def tail(self):
+		# Name, palette and texture tables that follow the chunk list
+		if self._tail is None:
+			self.chunks()
+			offs = self._chunks_end
+			tail = {}
+			tail["model_names"] = numpy.frombuffer(self.buf, dtype="<u4",
+				count=len(self.mdl_offsets), offset=offs)
+			offs += tail["model_names"].nbytes
+			for (key, dtype,) in (
+					("texture_names", numpy.dtype("<u4"),),
+					("palettes_4bpp", PSX_PALETTE_4BPP_DTYPE,),
+					("palettes_8bpp", PSX_PALETTE_8BPP_DTYPE,),
+					("texture_offsets", numpy.dtype("<u4"),),):
+				count, = struct.unpack_from("<I", self.buf, offs)
+				tail[key] = numpy.frombuffer(self.buf, dtype=dtype,
+					count=count, offset=offs+4)
+				offs += 4+tail[key].nbytes
+			tail["textures"] = gather_records(self.raw, tail["texture_offsets"],
+				PSX_TEXTURE_HEADER_DTYPE)
+			self._tail = tail
+		return self._tail
+
+	def textures(self):
+		# (T,) PSX_TEXTURE_HEADER_DTYPE
+		return self.tail()["textures"]
+
+	def texture_data(self, idx):
+		tex = self.textures()[idx]
+		bpp = (4 if tex["palsize"] == 16 else 8)
+		return numpy.frombuffer(self.buf, dtype=numpy.uint8,
+			count=int(tex["iw"])*int(tex["ih"])*bpp//8,
+			offset=int(self.tail()["texture_offsets"][idx])+PSX_TEXTURE_HEADER_DTYPE.itemsize)
+
+	def palette(self, name):
+		# CLUT view for a palette name, searching both depths
+		for key in ("palettes_4bpp", "palettes_8bpp",):
+			pals = self.tail()[key]
+			sel = numpy.flatnonzero(pals["name"] == name)
+			if len(sel) != 0:
+				return pals["pal"][sel[0]]
+		raise KeyError(name)
+
+class TRGReader(object):
+	# Read-only view of a .trg file.
+	# Node types and link lists come straight out of the mapped file.
+	def __init__(self, fname):
+		with open(fname, "rb") as fp:
+			self.buf = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+		self.raw = numpy.frombuffer(self.buf, dtype=numpy.uint8)
+
+		magic, version, nchunks, = struct.unpack_from("<4sII", self.buf, 0)
+		if magic != b"_TRG":
+			raise Exception("not a TRG file: %s" % (repr(magic),))
+		self.version = version
+		self.offsets = numpy.frombuffer(self.buf, dtype="<u4", count=nchunks, offset=12)
+		self.types = gather_records(self.raw, self.offsets, numpy.dtype("<u2"))
+
+	def close(self):
+		self.offsets = self.types = self.raw = None
+		release_mapping(self.buf)
+		self.buf = None
+
+	def links_offset(self, idx):
+		# Offset of the link count, or None if this node type has no links
+		typ = int(self.types[idx])
+		offs = int(self.offsets[idx])
+		if typ == 5:
+			return offs+4
+		if typ in (6, 8, 10,):
+			return offs+2
+		return None
+
+	def links(self, idx):
+		offs = self.links_offset(idx)
+		if offs is None:
+			return numpy.zeros(0, dtype="<u2")
+		count, = struct.unpack_from("<H", self.buf, offs)
+		return numpy.frombuffer(self.buf, dtype="<u2", count=count, offset=offs+2)
+
+	def node(self, idx):
+		# Dict of the fields this module knows how to write
+		typ = int(self.types[idx])
+		node = {"typ": typ, "offs": int(self.offsets[idx]),}
+		offs = self.links_offset(idx)
+		if offs is None:
+			return node
+		links = self.links(idx)
+		node["links"] = links
+		offs += 2+2*len(links)
+		offs += (0x4-offs)&0x3
+		if typ == 5:
+			node["powrup"], = struct.unpack_from("<H", self.buf, node["offs"]+2)
+		if typ in (5, 8, 10,):
+			node["pos"] = struct.unpack_from("<iii", self.buf, offs)
+		if typ == 6:
+			node["name"], = struct.unpack_from("<I", self.buf, offs)
+		if typ == 8:
+			offs += 12+6
+			end = self.buf.find(b"\x00", offs)
+			node["name"] = self.buf[offs:end].decode("utf-8")
+		return node
 
 #
 # Blender specifics
@@ -688,7 +1905,1596 @@ def fix24(v):
 def fix12(v):
 	return int(round(v*4096.0))
 
-def export_trg(trg_fname):
+#
+# Mesh extraction
+#
+
+class MeshArrays(object):
+	def __init__(self, *, co, poly_normals, loop_start, loop_total, loop_vidxs,
+			poly_materials=None, loop_uvs=None):
+		self.co = co
+		self.poly_normals = poly_normals
+		self.loop_start = loop_start
+		self.loop_total = loop_total
+		self.loop_vidxs = loop_vidxs
+		if poly_materials is None:
+			poly_materials = numpy.zeros(len(loop_start), dtype=numpy.int64)
+		self.poly_materials = poly_materials
+		self.loop_uvs = loop_uvs
+
+	def loop_polys(self):
+		lpolys = numpy.empty(len(self.loop_vidxs), dtype=numpy.int64)
+		k = numpy.arange(len(lpolys)) - numpy.repeat(numpy.cumsum(self.loop_total)-self.loop_total, self.loop_total)
+		lpolys[numpy.repeat(self.loop_start, self.loop_total)+k] = numpy.repeat(numpy.arange(len(self.loop_start)), self.loop_total)
+		return lpolys
+
+def mesh_extract(mesh):
+	co = numpy.empty(len(mesh.vertices)*3, dtype=numpy.float32)
+	mesh.vertices.foreach_get("co", co)
+	poly_normals = numpy.empty(len(mesh.polygons)*3, dtype=numpy.float32)
+	mesh.polygons.foreach_get("normal", poly_normals)
+	loop_start = numpy.empty(len(mesh.polygons), dtype=numpy.int32)
+	mesh.polygons.foreach_get("loop_start", loop_start)
+	loop_total = numpy.empty(len(mesh.polygons), dtype=numpy.int32)
+	mesh.polygons.foreach_get("loop_total", loop_total)
+	loop_vidxs = numpy.empty(len(mesh.loops), dtype=numpy.int32)
+	mesh.loops.foreach_get("vertex_index", loop_vidxs)
+	poly_materials = numpy.empty(len(mesh.polygons), dtype=numpy.int32)
+	mesh.polygons.foreach_get("material_index", poly_materials)
+	loop_uvs = None
+	if mesh.uv_layers.active is not None:
+		loop_uvs = numpy.empty(len(mesh.loops)*2, dtype=numpy.float32)
+		mesh.uv_layers.active.data.foreach_get("uv", loop_uvs)
+		loop_uvs = loop_uvs.reshape((-1, 2)).astype(numpy.float64)
+
+	return MeshArrays(
+		co=co.reshape((-1, 3)).astype(numpy.float64),
+		poly_normals=poly_normals.reshape((-1, 3)).astype(numpy.float64),
+		loop_start=loop_start.astype(numpy.int64),
+		loop_total=loop_total.astype(numpy.int64),
+		loop_vidxs=loop_vidxs.astype(numpy.int64),
+		poly_materials=poly_materials.astype(numpy.int64),
+		loop_uvs=loop_uvs)
+
+def blender_to_model(pos):
+	# Blender world (x, y, z) -> THPS (x, -z, y) in model units, as floats.
+	# Model units are what mesh_fix12_vertices() gives; TRG positions are
+	# fix12 of them.
+	x, y, z, = pos
+	return numpy.array([x, -z, y], dtype=numpy.float64)*(4096.0/BLEND_PER_THPS)
+
+def mesh_fix12_vertices(co, *, scale, location):
+	# Blender (x, y, z) -> THPS (x, -z, y), as fix12 of THPS units
+	sx, sy, sz, = scale
+	lx, ly, lz, = location
+	verts = numpy.empty((len(co), 3), dtype=numpy.int64)
+	verts[:, 0] = numpy.rint((( co[:, 0]*sx+lx)/BLEND_PER_THPS)*4096.0)
+	verts[:, 1] = numpy.rint(((-co[:, 2]*sz-lz)/BLEND_PER_THPS)*4096.0)
+	verts[:, 2] = numpy.rint((( co[:, 1]*sy+ly)/BLEND_PER_THPS)*4096.0)
+	return verts
+
+def mesh_fan_faces(marr, verts):
+	# Returns ((F,4) loop indices, (F,) triangle mask).
+	# Unused 4th corners of triangles get a loop index of -1.
+	ls = marr.loop_start
+	lt = marr.loop_total
+
+	# Perform norm correction
+	v0 = verts[marr.loop_vidxs[ls+0]]
+	dva = verts[marr.loop_vidxs[ls+1]] - v0
+	dvb = verts[marr.loop_vidxs[ls+2]] - v0
+	fnx = (dva[:, 1]*dvb[:, 2] - dva[:, 2]*dvb[:, 1])
+	fny = (dva[:, 2]*dvb[:, 0] - dva[:, 0]*dvb[:, 2])
+	fnz = (dva[:, 0]*dvb[:, 1] - dva[:, 1]*dvb[:, 0])
+	pnx =  marr.poly_normals[:, 0]
+	pny = -marr.poly_normals[:, 2]
+	pnz =  marr.poly_normals[:, 1]
+	normdot = (0.0
+		+ fnx*pnx
+		+ fny*pny
+		+ fnz*pnz)
+	flip = (normdot > 0.0)
+
+	# Triangulate and/or Quadrilaterate
+	# An n-gon becomes (n-1)//2 faces, all fanned out from its first corner
+	nfaces = (lt-1)//2
+	fpoly = numpy.repeat(numpy.arange(len(lt)), nfaces)
+	fstep = 2*(numpy.arange(len(fpoly)) - numpy.repeat(numpy.cumsum(nfaces)-nfaces, nfaces))
+	fn = lt[fpoly]
+	is_tri = (fstep+3 >= fn)
+
+	pos = numpy.empty((len(fpoly), 4), dtype=numpy.int64)
+	pos[:, 0] = 0
+	pos[:, 1] = fstep+1
+	pos[:, 2] = numpy.where(is_tri, fstep+2, fstep+3)
+	pos[:, 3] = numpy.where(is_tri, 0, fstep+2)
+	pos = numpy.where(flip[fpoly, None], fn[:, None]-1-pos, pos)
+	floops = ls[fpoly, None] + pos
+	floops[is_tri, 3] = -1
+
+	return floops, is_tri
+
+#
+# Mesh cleanup
+#
+
+def unique_rows(a):
+	# Returns (first, inverse) such that a[first] lists the distinct
+	# rows of a in order of first appearance, and a[first][inverse] == a
+	order = numpy.lexsort(a.T[::-1])
+	srt = a[order]
+	is_new = numpy.ones(len(a), dtype=bool)
+	is_new[1:] = (srt[1:] != srt[:-1]).any(axis=1)
+	grp = numpy.cumsum(is_new)-1
+	first = order[is_new] # lexsort is stable, so these are the earliest
+	rank = numpy.argsort(first, kind="mergesort")
+	remap = numpy.empty(len(rank), dtype=numpy.int64)
+	remap[rank] = numpy.arange(len(rank))
+	inverse = numpy.empty(len(a), dtype=numpy.int64)
+	inverse[order] = remap[grp]
+	return first[rank], inverse
+
+def mesh_weld(verts, *, tolerance=0):
+	# Merge vertices that share a quantised grid cell.
+	# A tolerance of 0 only merges exact duplicates.
+	# Returns (first, inverse) as per unique_rows().
+	cells = verts if tolerance <= 0 else verts//(tolerance+1)
+	return unique_rows(cells)
+
+def face_cross_is_zero(verts, i0, i1, i2):
+	d1 = verts[i1]-verts[i0]
+	d2 = verts[i2]-verts[i0]
+	return ((d1[:, 1]*d2[:, 2] == d1[:, 2]*d2[:, 1])
+		& (d1[:, 2]*d2[:, 0] == d1[:, 0]*d2[:, 2])
+		& (d1[:, 0]*d2[:, 1] == d1[:, 1]*d2[:, 0]))
+
+def mesh_clean_faces(verts, fvidxs):
+	# Drop faces with no area and reduce half-degenerate quads to triangles.
+	# Returns (fsel, corners): output face j takes its corners from
+	# input face fsel[j], slots corners[j] (-1 for an unused corner).
+	# A PSX quad (v0,v1,v2,v3) is drawn as (v0,v1,v2) + (v1,v3,v2).
+	is_tri = (fvidxs[:, 3] < 0)
+	fv = fvidxs.copy()
+	fv[is_tri, 3] = fv[is_tri, 0]
+	za = face_cross_is_zero(verts, fv[:, 0], fv[:, 1], fv[:, 2])
+	zb = face_cross_is_zero(verts, fv[:, 1], fv[:, 3], fv[:, 2])
+	folded = (fv[:, 0] == fv[:, 3]) # both halves cover the same triangle
+
+	corners = numpy.empty((len(fv), 4), dtype=numpy.int64)
+	corners[:] = (0, 1, 2, 3,)
+	corners[is_tri] = (0, 1, 2, -1,)
+	to_b = (~is_tri) & za & ~zb
+	corners[to_b] = (1, 3, 2, -1,)
+	to_a = (~is_tri) & ((zb & ~za) | folded)
+	corners[to_a] = (0, 1, 2, -1,)
+
+	keep = numpy.where(is_tri, ~za, ~(za & zb))
+	fsel = numpy.flatnonzero(keep)
+	return fsel, corners[fsel]
+
+def mesh_take_corners(a, fsel, corners):
+	# Apply mesh_clean_faces() output to an (F,4) per-corner array
+	out = a[fsel[:, None], numpy.maximum(corners, 0)]
+	out[corners < 0] = -1
+	return out
+
+# Triangles only pair up when their normals are at most this far apart
+QUAD_MERGE_COS = math.cos(math.radians(1.0))
+
+def mesh_pair_triangles(verts, fvidxs, *, fkeys, ckeys=None):
+	# Greedily pair triangles that share an edge into planar, convex quads.
+	# Partners need the same fkeys entry and, at the shared corners,
+	# the same ckeys values (e.g. UVs).
+	# Returns (fsel, corners, partner): output face j takes corners 0-2
+	# from input face fsel[j], slots corners[j, :3], and its 4th corner
+	# from slot corners[j, 3] of face partner[j] (-1 if not merged).
+	# Triangle (a,b,c) + (c,b,d) become the PSX quad (a,b,c,d), which is
+	# drawn as the same two triangles.
+	nfaces = len(fvidxs)
+	tris = numpy.flatnonzero(fvidxs[:, 3] < 0)
+	corners = numpy.empty((nfaces, 4), dtype=numpy.int64)
+	corners[:] = (0, 1, 2, 3,)
+	corners[tris] = (0, 1, 2, -1,)
+	partner = numpy.full(nfaces, -1, dtype=numpy.int64)
+	if len(tris) < 2:
+		return numpy.arange(nfaces), corners, partner
+
+	# Half-edges (corner r+1 -> corner r+2) with corner r opposite
+	rot = numpy.array([[0, 1, 2], [1, 2, 0], [2, 0, 1]])
+	hface = numpy.repeat(tris, 3)
+	hrot = numpy.tile(numpy.arange(3), len(tris))
+	hu = fvidxs[hface, rot[hrot, 1]]
+	hv = fvidxs[hface, rot[hrot, 2]]
+
+	# Match each half-edge with its reverse, skipping non-manifold edges
+	nv = max(len(verts), 1)
+	key = hu*nv+hv
+	order = numpy.argsort(key, kind="stable")
+	skey = key[order]
+	single = numpy.ones(len(skey), dtype=bool)
+	single[1:] &= (skey[1:] != skey[:-1])
+	single[:-1] &= (skey[:-1] != skey[1:])
+	rkey = hv*nv+hu
+	pos = numpy.minimum(numpy.searchsorted(skey, rkey), len(skey)-1)
+	found = (skey[pos] == rkey) & single[pos]
+	found &= single[numpy.argsort(order)]
+	h1 = numpy.flatnonzero(found)
+	h2 = order[pos[h1]]
+	keep = (hface[h1] < hface[h2])
+	h1 = h1[keep]
+	h2 = h2[keep]
+	f1 = hface[h1]
+	f2 = hface[h2]
+	keep = (fkeys[f1] == fkeys[f2])
+
+	# Corners of f1 as (a,b,c) and the far corner d of f2
+	ca = rot[hrot[h1], 0]
+	cb = rot[hrot[h1], 1]
+	cc = rot[hrot[h1], 2]
+	cd = rot[hrot[h2], 0]
+	cb2 = rot[hrot[h2], 2]
+	cc2 = rot[hrot[h2], 1]
+	if ckeys is not None:
+		width = int(numpy.prod(ckeys.shape[2:]))
+		keep &= (ckeys[f1, cb] == ckeys[f2, cb2]).reshape((len(f1), width)).all(axis=1)
+		keep &= (ckeys[f1, cc] == ckeys[f2, cc2]).reshape((len(f1), width)).all(axis=1)
+
+	# Planar and convex
+	a = verts[fvidxs[f1, ca]].astype(numpy.float64)
+	b = verts[fvidxs[f1, cb]].astype(numpy.float64)
+	c = verts[fvidxs[f1, cc]].astype(numpy.float64)
+	d = verts[fvidxs[f2, cd]].astype(numpy.float64)
+	n1 = numpy.cross(b-a, c-a)
+	n2 = numpy.cross(b-c, d-c)
+	l1 = numpy.sqrt((n1*n1).sum(axis=1))
+	l2 = numpy.sqrt((n2*n2).sum(axis=1))
+	cos = (n1*n2).sum(axis=1)/numpy.maximum(l1*l2, 1e-30)
+	keep &= (cos >= QUAD_MERGE_COS)
+	n = n1/numpy.maximum(l1, 1e-30)[:, None]+n2/numpy.maximum(l2, 1e-30)[:, None]
+	for (p, q, r,) in ((a, b, d,), (b, d, c,), (d, c, a,), (c, a, b,)):
+		keep &= ((numpy.cross(q-p, r-q)*n).sum(axis=1) > 0.0)
+
+	# Longest shared edge first, as that is usually the diagonal of a
+	# quad that was triangulated, then the flattest.
+	# Each round takes the pairs that come first for both of their triangles.
+	cand = numpy.flatnonzero(keep)
+	shared = ((c-b)**2).sum(axis=1)
+	cand = cand[numpy.lexsort((-cos[cand], -shared[cand],))]
+	taken = numpy.zeros(nfaces, dtype=bool)
+	chosen = []
+	while len(cand) != 0:
+		rank = numpy.arange(len(cand))
+		best = numpy.full(nfaces, len(cand))
+		numpy.minimum.at(best, f1[cand], rank)
+		numpy.minimum.at(best, f2[cand], rank)
+		win = (best[f1[cand]] == rank) & (best[f2[cand]] == rank)
+		chosen.append(cand[win])
+		taken[f1[cand[win]]] = True
+		taken[f2[cand[win]]] = True
+		cand = cand[~(taken[f1[cand]] | taken[f2[cand]])]
+	chosen = (numpy.concatenate(chosen) if len(chosen) != 0 else numpy.zeros(0, dtype=numpy.int64))
+
+	# Every face keeps its corners, except the merged pairs
+	corners[f1[chosen]] = numpy.stack([ca[chosen], cb[chosen], cc[chosen], cd[chosen]], axis=1)
+	partner[f1[chosen]] = f2[chosen]
+	gone = numpy.zeros(nfaces, dtype=bool)
+	gone[f2[chosen]] = True
+	fsel = numpy.flatnonzero(~gone)
+	return fsel, corners[fsel], partner[fsel]
+
+def mesh_take_pairs(a, fsel, corners, partner):
+	# Apply mesh_pair_triangles() output to an (F,4) per-corner array
+	face = numpy.repeat(fsel[:, None], 4, axis=1)
+	face[:, 3] = numpy.where(partner >= 0, partner, fsel)
+	out = a[face, numpy.maximum(corners, 0)]
+	out[corners < 0] = -1
+	return out
+
+#
+# Vertex lighting
+#
+
+LAMP_POINT = 0
+LAMP_SPOT = 1
+LAMP_SUN = 2
+LAMP_HEMI = 3
+
+LAMP_KINDS = {
+	"POINT": LAMP_POINT,
+	"SPOT": LAMP_SPOT,
+	"AREA": LAMP_POINT,
+	"SUN": LAMP_SUN,
+	"HEMI": LAMP_HEMI,
+}
+
+# Lamps that would cover more grid cells than this are lit everywhere
+LAMP_GRID_MAX_CELLS_PER_LAMP = 0x1000
+
+# Light level 1.0 maps to this colour index, which is unshaded
+LIGHT_NEUTRAL_CIDX = 128
+
+def mesh_vertex_normals(verts, fvidxs):
+	# Area-weighted vertex normals, facing outwards.
+	# The exporter's winding leaves cross(v1-v0, v2-v0) facing inwards.
+	verts = verts.astype(numpy.float64)
+	is_quad = (fvidxs[:, 3] >= 0)
+	fv = fvidxs.copy()
+	fv[~is_quad, 3] = fv[~is_quad, 0]
+	fna = -numpy.cross(verts[fv[:, 1]]-verts[fv[:, 0]], verts[fv[:, 2]]-verts[fv[:, 0]])
+	fnb = -numpy.cross(verts[fv[:, 3]]-verts[fv[:, 1]], verts[fv[:, 2]]-verts[fv[:, 1]])
+	fnb[~is_quad] = 0.0
+
+	normals = numpy.zeros((len(verts), 3), dtype=numpy.float64)
+	for (i, fn,) in ((0, fna,), (1, fna,), (2, fna,), (1, fnb,), (3, fnb,), (2, fnb,),):
+		for axis in range(3):
+			normals[:, axis] += numpy.bincount(fv[:, i], weights=fn[:, axis], minlength=len(verts))
+	length = numpy.sqrt((normals*normals).sum(axis=1))
+	normals /= numpy.maximum(length, 1e-12)[:, None]
+	return normals
+
+class LampGrid(object):
+	# Local lamps are binned into a uniform grid by their falloff sphere,
+	# so each vertex only evaluates the lamps that can reach its cell.
+	# Positions and radii are in THPS fix12 units.
+	def __init__(self, *, kinds, pos, direction, radius, intensity, spot_cos):
+		self.kinds = kinds
+		self.pos = pos
+		self.direction = direction
+		self.radius = radius
+		self.intensity = intensity
+		self.spot_cos = spot_cos
+
+		# A local lamp with no distance has no falloff and reaches everything
+		local = ((kinds == LAMP_POINT) | (kinds == LAMP_SPOT))
+		self.directional = numpy.flatnonzero((kinds == LAMP_SUN) | (kinds == LAMP_HEMI))
+		self.everywhere = numpy.flatnonzero(local & (radius <= 0.0))
+		local &= (radius > 0.0)
+		self.keys = numpy.zeros(0, dtype=numpy.int64)
+		self.key_lamps = numpy.zeros(0, dtype=numpy.int64)
+
+		lidx = numpy.flatnonzero(local)
+		if len(lidx) == 0:
+			return
+
+		lo = (pos[lidx]-radius[lidx, None]).min(axis=0)
+		hi = (pos[lidx]+radius[lidx, None]).max(axis=0)
+		self.cell = max(float(numpy.median(radius[lidx])), float((hi-lo).max())/(1<<19), 1.0)
+		c0 = self.cell_coords(pos[lidx]-radius[lidx, None])
+		c1 = self.cell_coords(pos[lidx]+radius[lidx, None])
+		ncells = (c1-c0+1).prod(axis=1)
+		big = (ncells > LAMP_GRID_MAX_CELLS_PER_LAMP)
+		self.everywhere = numpy.concatenate([self.everywhere, lidx[big]])
+		lidx = lidx[~big]
+		c0 = c0[~big]
+		c1 = c1[~big]
+		ncells = ncells[~big]
+
+		# One (cell, lamp) pair per cell each lamp's box touches
+		plamp = numpy.repeat(numpy.arange(len(lidx)), ncells)
+		k = numpy.arange(len(plamp)) - numpy.repeat(numpy.cumsum(ncells)-ncells, ncells)
+		span = c1-c0+1
+		cx = c0[plamp, 0] + k%span[plamp, 0]
+		cy = c0[plamp, 1] + (k//span[plamp, 0])%span[plamp, 1]
+		cz = c0[plamp, 2] + k//(span[plamp, 0]*span[plamp, 1])
+		keys = self.cell_keys(numpy.stack([cx, cy, cz], axis=1))
+		order = numpy.argsort(keys, kind="mergesort")
+		self.keys = keys[order]
+		self.key_lamps = lidx[plamp[order]]
+
+	def cell_coords(self, p):
+		return numpy.floor(p/self.cell).astype(numpy.int64)
+
+	def cell_keys(self, c):
+		c = c + (1<<20)
+		return (c[:, 0]<<42) | (c[:, 1]<<21) | c[:, 2]
+
+	@classmethod
+	def from_lamps(cls, lamps):
+		# lamps is a list of dicts in Blender space, as in Scene.lamps
+		n = len(lamps)
+		kinds = numpy.array([LAMP_KINDS.get(l["type"], LAMP_POINT) for l in lamps], dtype=numpy.int64)
+		pos = numpy.array([l["pos"] for l in lamps], dtype=numpy.float64).reshape((n, 3))
+		direction = numpy.array([l["dir"] for l in lamps], dtype=numpy.float64).reshape((n, 3))
+		pos = pos[:, (0, 2, 1,)]*(1.0, -1.0, 1.0)*(4096.0/BLEND_PER_THPS)
+		direction = direction[:, (0, 2, 1,)]*(1.0, -1.0, 1.0)
+		direction /= numpy.maximum(numpy.sqrt((direction*direction).sum(axis=1)), 1e-12)[:, None]
+		return cls(
+			kinds=kinds,
+			pos=pos,
+			direction=direction,
+			radius=numpy.array([l["distance"] for l in lamps], dtype=numpy.float64)*(4096.0/BLEND_PER_THPS),
+			intensity=numpy.array([l["energy"] for l in lamps], dtype=numpy.float64),
+			spot_cos=numpy.array([math.cos(l["spot_size"]*0.5) for l in lamps], dtype=numpy.float64))
+
+	def digest(self):
+		return cache_key(self.kinds, self.pos, self.direction,
+			self.radius, self.intensity, self.spot_cos)
+
+	def illuminate(self, verts, normals):
+		# Returns the light level at each vertex, excluding ambient
+		verts = verts.astype(numpy.float64)
+		light = numpy.zeros(len(verts), dtype=numpy.float64)
+
+		for i in self.directional.tolist():
+			ndl = -(normals*self.direction[i]).sum(axis=1)
+			if self.kinds[i] == LAMP_HEMI:
+				light += self.intensity[i]*(0.5+0.5*ndl)
+			else:
+				light += self.intensity[i]*numpy.maximum(ndl, 0.0)
+
+		# Gather (vertex, lamp) pairs from the grid
+		vkeys = self.cell_keys(self.cell_coords(verts)) if len(self.keys) != 0 else numpy.zeros(len(verts), dtype=numpy.int64)
+		starts = numpy.searchsorted(self.keys, vkeys, side="left")
+		counts = numpy.searchsorted(self.keys, vkeys, side="right")-starts
+		pv = numpy.repeat(numpy.arange(len(verts)), counts)
+		k = numpy.arange(len(pv)) - numpy.repeat(numpy.cumsum(counts)-counts, counts)
+		pl = self.key_lamps[numpy.repeat(starts, counts)+k]
+		if len(self.everywhere) != 0:
+			pv = numpy.concatenate([pv, numpy.repeat(numpy.arange(len(verts)), len(self.everywhere))])
+			pl = numpy.concatenate([pl, numpy.tile(self.everywhere, len(verts))])
+
+		# Linear falloff to zero at the lamp's distance, if it has one
+		d = self.pos[pl]-verts[pv]
+		dist = numpy.maximum(numpy.sqrt((d*d).sum(axis=1)), 1e-12)
+		radius = self.radius[pl]
+		bounded = (radius > 0.0)
+		att = numpy.where(bounded, numpy.maximum(1.0-dist/numpy.where(bounded, radius, 1.0), 0.0), 1.0)
+		ndl = numpy.maximum((normals[pv]*d).sum(axis=1)/dist, 0.0)
+		cone = numpy.where(self.kinds[pl] == LAMP_SPOT,
+			-(self.direction[pl]*d).sum(axis=1)/dist >= self.spot_cos[pl],
+			True)
+		light += numpy.bincount(pv, weights=self.intensity[pl]*att*ndl*cone, minlength=len(verts))
+
+		return light
+
+def light_to_cidxs(light, *, ambient):
+	return numpy.clip(numpy.rint((light+ambient)*LIGHT_NEUTRAL_CIDX), 0, 255).astype(numpy.int64)
+
+#
+# Ambient occlusion
+#
+
+# Bump this whenever the bake's output changes
+AO_CACHE_VERSION = 1
+
+# Triangles per BVH leaf
+AO_LEAF_SIZE = 8
+
+# Rays traced at once, which bounds the memory of a traversal
+AO_RAY_BATCH = 1<<14
+
+def mesh_triangles(verts, fvidxs):
+	# (T,3,3) triangles as the PS1 draws the faces:
+	# (v0,v1,v2), plus (v1,v3,v2) for quads
+	quad = (fvidxs[:, 3] >= 0)
+	tris = numpy.concatenate([fvidxs[:, [0, 1, 2]], fvidxs[quad][:, [1, 3, 2]]])
+	return verts[tris]
+
+def morton_codes(points):
+	# 30-bit Morton codes of points scaled into their bounding box
+	lo = points.min(axis=0)
+	size = numpy.maximum(points.max(axis=0)-lo, 1e-9)
+	q = numpy.clip(((points-lo)/size*1023.0).astype(numpy.int64), 0, 1023)
+	codes = numpy.zeros(len(points), dtype=numpy.int64)
+	for bit in range(10):
+		for axis in range(3):
+			codes |= ((q[:, axis]>>bit)&1)<<(3*bit+axis)
+	return codes
+
+def hemisphere_dirs(count):
+	# Cosine-weighted directions around +Z on a Fibonacci spiral
+	i = numpy.arange(count, dtype=numpy.float64)+0.5
+	r = numpy.sqrt(i/count)
+	phi = i*math.pi*(3.0-math.sqrt(5.0))
+	return numpy.stack([r*numpy.cos(phi), r*numpy.sin(phi), numpy.sqrt(1.0-r*r)], axis=1)
+
+def normal_frames(normals):
+	# (V,3,3) rotations taking +Z to each normal
+	n = normals
+	other = numpy.where((numpy.abs(n[:, 0]) < 0.9)[:, None], (1.0, 0.0, 0.0,), (0.0, 1.0, 0.0,))
+	t = numpy.cross(other, n)
+	t /= numpy.maximum(numpy.sqrt((t*t).sum(axis=1)), 1e-12)[:, None]
+	b = numpy.cross(n, t)
+	return numpy.stack([t, b, n], axis=2)
+
+class TriangleBVH(object):
+	# Bounding volume hierarchy over triangles for occlusion rays.
+	# Triangles are sorted along a Morton curve and cut into leaves of
+	# AO_LEAF_SIZE, and the tree above the leaves is a complete binary tree
+	# stored level by level, so building and walking it are array operations.
+	# Coordinates are THPS fix12 units.
+	def __init__(self, tris):
+		tris = numpy.asarray(tris, dtype=numpy.float64).reshape((-1, 3, 3))
+		self.count = len(tris)
+		if self.count == 0:
+			return
+		tris = tris[numpy.argsort(morton_codes(tris.mean(axis=1)), kind="stable")]
+
+		# Pad the last leaf with copies, which cannot change an any-hit test
+		nleaves = -(-len(tris)//AO_LEAF_SIZE)
+		pad = nleaves*AO_LEAF_SIZE-len(tris)
+		tris = numpy.concatenate([tris, numpy.repeat(tris[-1:], pad, axis=0)])
+		self.v0 = tris[:, 0].astype(numpy.float32)
+		self.e1 = (tris[:, 1]-tris[:, 0]).astype(numpy.float32)
+		self.e2 = (tris[:, 2]-tris[:, 0]).astype(numpy.float32)
+
+		# Leaf boxes, then empty boxes up to a power of two. Boxes are stored
+		# axis-major, (3,W), so the slab test works on whole rows.
+		leaves = tris.reshape((nleaves, AO_LEAF_SIZE*3, 3))
+		width = 1<<(nleaves-1).bit_length()
+		lo = numpy.full((3, width), numpy.inf)
+		hi = numpy.full((3, width), -numpy.inf)
+		lo[:, :nleaves] = leaves.min(axis=1).T
+		hi[:, :nleaves] = leaves.max(axis=1).T
+		self.los = [lo]
+		self.his = [hi]
+		while lo.shape[1] > 1:
+			lo = numpy.minimum(lo[:, 0::2], lo[:, 1::2])
+			hi = numpy.maximum(hi[:, 0::2], hi[:, 1::2])
+			self.los.insert(0, lo)
+			self.his.insert(0, hi)
+
+	def occluded(self, origins, dirs, *, max_dist):
+		# (R,) bool, True where a ray hits a triangle within max_dist
+		hit = numpy.zeros(len(origins), dtype=bool)
+		if self.count == 0:
+			return hit
+		for beg in range(0, len(origins), AO_RAY_BATCH):
+			hit[beg:beg+AO_RAY_BATCH] = self.occluded_batch(
+				origins[beg:beg+AO_RAY_BATCH], dirs[beg:beg+AO_RAY_BATCH], max_dist=max_dist)
+		return hit
+
+	def occluded_batch(self, origins, dirs, *, max_dist):
+		safe = numpy.where(numpy.abs(dirs) < 1e-12, 1e-12, dirs)
+		o_t = numpy.ascontiguousarray(origins.T)
+		inv_t = numpy.ascontiguousarray((1.0/safe).T)
+
+		# Walk down the levels, keeping the (ray, node) pairs whose boxes get hit
+		rays = numpy.arange(len(origins))
+		nodes = numpy.zeros(len(origins), dtype=numpy.int64)
+		for (depth, (lo, hi,),) in enumerate(zip(self.los, self.his)):
+			if depth != 0:
+				rays = numpy.repeat(rays, 2)
+				nodes = numpy.repeat(nodes<<1, 2)
+				nodes[1::2] |= 1
+			tnear = numpy.zeros(len(rays))
+			tfar = numpy.full(len(rays), float(max_dist))
+			for axis in range(3):
+				o = o_t[axis][rays]
+				ri = inv_t[axis][rays]
+				t1 = (lo[axis][nodes]-o)*ri
+				t2 = (hi[axis][nodes]-o)*ri
+				numpy.maximum(tnear, numpy.minimum(t1, t2), out=tnear)
+				numpy.minimum(tfar, numpy.maximum(t1, t2), out=tfar)
+			keep = tfar >= tnear
+			keep &= lo[0][nodes] <= hi[0][nodes] # Padding boxes are empty
+			rays = rays[keep]
+			nodes = nodes[keep]
+
+		# Then test the triangles in each leaf that is left
+		hit = numpy.zeros(len(origins), dtype=bool)
+		for k in range(AO_LEAF_SIZE):
+			live = ~hit[rays]
+			rays = rays[live]
+			nodes = nodes[live]
+			if len(rays) == 0:
+				break
+			tri = nodes*AO_LEAF_SIZE+k
+			hit[rays[ray_triangle_hits(origins[rays], dirs[rays],
+				self.v0[tri], self.e1[tri], self.e2[tri], max_dist=max_dist)]] = True
+		return hit
+
+def ray_triangle_hits(o, d, v0, e1, e2, *, max_dist):
+	# Moller-Trumbore, both sides; returns a bool per ray.
+	# Written per component, which is much quicker than cross() on (N,3).
+	(dx, dy, dz,) = d.T
+	(ax, ay, az,) = e1.T
+	(bx, by, bz,) = e2.T
+	(sx, sy, sz,) = (o-v0).T
+	with numpy.errstate(divide="ignore", invalid="ignore"):
+		px = dy*bz-dz*by
+		py = dz*bx-dx*bz
+		pz = dx*by-dy*bx
+		det = ax*px+ay*py+az*pz
+		inv = 1.0/det
+		u = (sx*px+sy*py+sz*pz)*inv
+		qx = sy*az-sz*ay
+		qy = sz*ax-sx*az
+		qz = sx*ay-sy*ax
+		v = (dx*qx+dy*qy+dz*qz)*inv
+		t = (bx*qx+by*qy+bz*qz)*inv
+		return ((numpy.abs(det) > 1e-9)
+			& (u >= 0.0) & (v >= 0.0) & (u+v <= 1.0)
+			& (t > 0.0) & (t <= max_dist))
+
+def bake_occlusion(bvh, verts, normals, *, distance, rays):
+	# Fraction of each vertex's hemisphere that is open, as (V,) floats.
+	# Rays start a little off the surface so that they miss their own faces.
+	if len(verts) == 0:
+		return numpy.ones(0, dtype=numpy.float64)
+	dirs = numpy.einsum("vij,kj->vki", normal_frames(normals), hemisphere_dirs(rays)).reshape((-1, 3))
+	origins = numpy.repeat(verts.astype(numpy.float64)+normals*(distance*(1.0/256.0)), rays, axis=0)
+	hit = bvh.occluded(origins, dirs, max_dist=distance)
+	return 1.0-hit.reshape((-1, rays)).mean(axis=1)
+
+def occlusion_shade(openness, *, strength):
+	# Scale factor for a vertex's shade
+	return 1.0-strength*(1.0-openness)
+
+def pack_cached_occlusion(openness):
+	return numpy.rint(openness*255.0).astype(numpy.uint8).tobytes()
+
+def unpack_cached_occlusion(data, count):
+	if len(data) != count:
+		return None
+	return numpy.frombuffer(data, dtype=numpy.uint8).astype(numpy.float64)/255.0
+
+#
+# Texture conversion
+#
+
+TEXTURE_MAX_SIZE = 256
+
+# Bump this whenever the quantiser's output changes
+TEXTURE_CACHE_VERSION = 1
+
+def rgb15_array(rgb8):
+	# rgb15() over an (...,3) array of 8-bit channels
+	rgb8 = rgb8.astype(numpy.int64)
+	r = rgb8[..., 0]>>3
+	g = rgb8[..., 1]>>3
+	b = rgb8[..., 2]>>3
+	b = numpy.where((r|g|b) == 0, 1, b)
+	return (b<<10)|(g<<5)|(r)
+
+def texture_fit(rgba):
+	# Nearest-neighbour resample to a multiple of 8 no larger than a texture page
+	h, w, = rgba.shape[:2]
+	nw = min(TEXTURE_MAX_SIZE, max(8, (w+4)&~7))
+	nh = min(TEXTURE_MAX_SIZE, max(8, (h+4)&~7))
+	if (nw, nh,) == (w, h,):
+		return rgba
+	ys = ((numpy.arange(nh)+0.5)*h/nh).astype(numpy.int64)
+	xs = ((numpy.arange(nw)+0.5)*w/nw).astype(numpy.int64)
+	return rgba[ys[:, None], xs[None, :]]
+
+def median_cut(cols, weights, ncolours):
+	# cols is (U,3) distinct colours, weights their pixel counts.
+	# Returns (palette (K,3) float, label per colour).
+	# Always splits the box with the largest squared error,
+	# at the weighted median of its widest channel.
+	def box_stats(members):
+		c = cols[members].astype(numpy.float64)
+		w = weights[members].astype(numpy.float64)
+		mean = (c*w[:, None]).sum(axis=0)/w.sum()
+		var = ((c-mean)**2*w[:, None]).sum(axis=0)
+		return (var.sum(), int(numpy.argmax(var)), mean,)
+
+	boxes = [numpy.arange(len(cols))]
+	stats = [box_stats(boxes[0])]
+	while len(boxes) < ncolours:
+		bi = max(range(len(boxes)), key=lambda i: stats[i][0])
+		sse, axis, _, = stats[bi]
+		if sse <= 0.0:
+			break
+		members = boxes[bi]
+		order = members[numpy.argsort(cols[members, axis], kind="mergesort")]
+		cum = numpy.cumsum(weights[order])
+		split = int(numpy.searchsorted(cum, cum[-1]*0.5, side="right"))
+		split = min(max(split, 1), len(order)-1)
+		boxes[bi] = order[:split]
+		stats[bi] = box_stats(boxes[bi])
+		boxes.append(order[split:])
+		stats.append(box_stats(boxes[-1]))
+
+	labels = numpy.empty(len(cols), dtype=numpy.int64)
+	for (i, members,) in enumerate(boxes):
+		labels[members] = i
+	return numpy.array([st[2] for st in stats]), labels
+
+def texture_quantise(rgba, *, bpp=None):
+	# Returns (bpp, palette of rgb15 values, (h,w) palette indices).
+	# Pixels under half alpha use index 0, which is transparent black.
+	# With bpp=None the depth is 4 if the image fits in 16 colours.
+	rgb8 = numpy.clip(numpy.rint(rgba[..., :3]*255.0), 0, 255).astype(numpy.int64)
+	keys = (rgb8[..., 0]>>3) | ((rgb8[..., 1]>>3)<<5) | ((rgb8[..., 2]>>3)<<10)
+	clear = (rgba[..., 3] < 0.5)
+
+	counts = numpy.bincount(keys[~clear], minlength=1<<15)
+	ukeys = numpy.flatnonzero(counts)
+	nreserved = (1 if clear.any() else 0)
+	if bpp is None:
+		bpp = (4 if len(ukeys)+nreserved <= 16 else 8)
+	ncolours = (1<<bpp)-nreserved
+
+	pal = [0x0000]*(1<<bpp)
+	lut = numpy.zeros(1<<15, dtype=numpy.int64)
+	if len(ukeys) != 0:
+		cols = numpy.stack([ukeys&0x1F, (ukeys>>5)&0x1F, (ukeys>>10)&0x1F], axis=1)
+		means, labels, = median_cut(cols, counts[ukeys], ncolours)
+		means = numpy.clip(numpy.rint(means), 0, 31).astype(numpy.int64)
+		entries = rgb15_array(means<<3)
+		for (i, v,) in enumerate(entries.tolist()):
+			pal[nreserved+i] = v
+		lut[ukeys] = labels+nreserved
+
+	idx = numpy.where(clear, 0, lut[keys])
+	return bpp, pal, idx
+
+def texture_pack(idx, *, bpp):
+	# 4bpp puts the left pixel in the low nibble
+	idx = idx.astype(numpy.uint8)
+	if bpp == 4:
+		idx = idx[:, 0::2] | (idx[:, 1::2]<<4)
+	return idx.tobytes()
+
+def face_tpoints(uvs, valid, *, iw, ih):
+	# uvs is (F,4,2) per corner, valid is (F,4).
+	# Each face is shifted back into the first tile as the PS1 cannot wrap.
+	us = numpy.where(valid, uvs[..., 0], numpy.inf)
+	vs = numpy.where(valid, uvs[..., 1], numpy.inf)
+	u = uvs[..., 0]-numpy.floor(us.min(axis=1))[:, None]
+	v = uvs[..., 1]-numpy.floor(vs.min(axis=1))[:, None]
+	tp = numpy.empty(uvs.shape, dtype=numpy.int64)
+	tp[..., 0] = numpy.clip(numpy.rint(u*(iw-1)), 0, iw-1)
+	tp[..., 1] = numpy.clip(numpy.rint((1.0-v)*(ih-1)), 0, ih-1)
+	tp[~valid] = 0
+	return tp
+
+def pack_cached_texture(bpp, pal, idx):
+	ih, iw, = idx.shape
+	return (struct.pack("<HHB", iw, ih, bpp)
+		+ numpy.array(pal, dtype="<u2").tobytes()
+		+ texture_pack(idx, bpp=bpp))
+
+def unpack_cached_texture(data):
+	try:
+		iw, ih, bpp, = struct.unpack_from("<HHB", data, 0)
+	except struct.error:
+		return None
+	npal = 1<<bpp
+	pal = numpy.frombuffer(data, dtype="<u2", count=npal, offset=5).tolist()
+	tdata = data[5+npal*2:]
+	if len(tdata) != iw*ih*bpp//8:
+		return None
+	return iw, ih, bpp, pal, tdata
+
+#
+# Model splitting
+#
+
+# Extents are measured from the re-centred model, which has to fit in s16.
+# Faces store their vertex indices as u8, and the model header counts
+# faces and planes as u16.
+MODEL_MAX_EXTENT = 0xFFFE
+MODEL_MAX_VERTICES = 0x100
+MODEL_MAX_FACES = 0xFFFF
+
+def mesh_subset(fvidxs):
+	# Returns (used vertex indices, fvidxs remapped to them).
+	# Unused triangle corners (-1) stay as -1.
+	used = (fvidxs >= 0)
+	vsel, inv, = numpy.unique(fvidxs[used], return_inverse=True)
+	sub = numpy.full(fvidxs.shape, -1, dtype=numpy.int64)
+	sub[used] = inv.reshape(-1)
+	return vsel, sub
+
+def mesh_split_faces(verts, fvidxs, *, max_extent=MODEL_MAX_EXTENT, max_verts=MODEL_MAX_VERTICES,
+		max_faces=MODEL_MAX_FACES):
+	# Partition the faces so that each part fits in one model.
+	# Returns a list of face index arrays, empty when there are no faces.
+	if len(fvidxs) == 0:
+		return []
+	fv = numpy.where(fvidxs >= 0, fvidxs, fvidxs[:, :1])
+	fpts = verts[fv]
+	fmin = fpts.min(axis=1)
+	fmax = fpts.max(axis=1)
+	if len(fv) != 0 and (fmax-fmin).max() > max_extent:
+		raise Exception("face too large to fit in any model")
+	fcen = (fmin+fmax)
+
+	parts = []
+	stack = [numpy.arange(len(fv))]
+	while len(stack) != 0:
+		fsel = stack.pop()
+		nverts = len(numpy.unique(fv[fsel]))
+		extent = (fmax[fsel].max(axis=0)-fmin[fsel].min(axis=0)).max()
+		if nverts <= max_verts and extent <= max_extent and len(fsel) <= max_faces:
+			parts.append(fsel)
+			continue
+
+		# Split along whichever axis gives the tightest boxes.
+		# Only cuts in the middle half are considered so that this
+		# does not degenerate into peeling off one face at a time.
+		n = len(fsel)
+		lo = max(1, n//4)
+		hi = max(lo+1, n-n//4)
+		best = None
+		for axis in range(3):
+			order = fsel[numpy.argsort(fcen[fsel, axis], kind="mergesort")]
+			lmin = numpy.minimum.accumulate(fmin[order], axis=0)
+			lmax = numpy.maximum.accumulate(fmax[order], axis=0)
+			rmin = numpy.minimum.accumulate(fmin[order][::-1], axis=0)[::-1]
+			rmax = numpy.maximum.accumulate(fmax[order][::-1], axis=0)[::-1]
+			ld = (lmax-lmin).astype(numpy.float64)
+			rd = (rmax-rmin).astype(numpy.float64)
+			larea = ld[:, 0]*ld[:, 1] + ld[:, 1]*ld[:, 2] + ld[:, 2]*ld[:, 0]
+			rarea = rd[:, 0]*rd[:, 1] + rd[:, 1]*rd[:, 2] + rd[:, 2]*rd[:, 0]
+			# cut k puts order[:k] on the left
+			k = numpy.arange(lo, hi)
+			cost = larea[k-1]*k + rarea[k]*(n-k)
+			i = int(numpy.argmin(cost))
+			if best is None or cost[i] < best[0]:
+				best = (cost[i], order, int(k[i]),)
+
+		_, order, k, = best
+		stack.append(order[k:])
+		stack.append(order[:k])
+
+	return parts
+
+#
+# Model cache
+#
+
+# Bump this whenever the encoded output for a given mesh changes
+MODEL_CACHE_VERSION = 5
+
+def mesh_cache_key(marr, *, scale, location, settings):
+	return cache_key(
+		"model", MODEL_CACHE_VERSION, BLEND_PER_THPS, settings,
+		tuple(scale), tuple(location),
+		marr.co,
+		marr.poly_normals,
+		marr.loop_start,
+		marr.loop_total,
+		marr.loop_vidxs,
+		marr.poly_materials,
+		marr.loop_uvs if marr.loop_uvs is not None else "no UVs")
+
+def pack_cached_models(pieces):
+	# pieces is a list of (px, py, pz, bounds, blob)
+	L = [struct.pack("<I", len(pieces))]
+	for (px, py, pz, bounds, blob,) in pieces:
+		L.append(struct.pack("<iiiIhhhhhhI", px, py, pz, *(tuple(bounds)+(len(blob),))))
+		L.append(blob)
+	return b"".join(L)
+
+def unpack_cached_models(data):
+	try:
+		pieces = []
+		count, = struct.unpack_from("<I", data, 0)
+		offs = 4
+		for i in range(count):
+			px, py, pz, *bounds, bloblen, = struct.unpack_from("<iiiIhhhhhhI", data, offs)
+			offs += struct.calcsize("<iiiIhhhhhhI")
+			blob = data[offs:offs+bloblen]
+			if len(blob) != bloblen:
+				return None
+			offs += bloblen
+			pieces.append((px, py, pz, tuple(bounds), blob,))
+		return pieces
+	except struct.error:
+		# Corrupt entries count as misses
+		return None
+
+#
+# Mesh import
+#
+
+def pmodel_mesh_arrays(mdl, *, textures=None):
+	# Inverse of the export path for one PSXReader model view.
+	# Returns a MeshArrays in model space; loop_uvs is None without textures.
+	verts = mdl.vertices
+	co = numpy.empty((len(verts), 3), dtype=numpy.float64)
+	co[:, 0] =  verts["x"]*(BLEND_PER_THPS/4096.0)
+	co[:, 1] =  verts["z"]*(BLEND_PER_THPS/4096.0)
+	co[:, 2] = -verts["y"]*(BLEND_PER_THPS/4096.0)
+
+	# PSX quads are (v0, v1, v3, v2) around the edge, and wound the other way
+	recs = mdl.faces()
+	is_tri = ((recs["rflags"] & 0x0010) != 0)
+	corners = numpy.where(is_tri[:, None],
+		numpy.array([[2, 1, 0, -1]]),
+		numpy.array([[2, 3, 1, 0]]))
+	valid = (corners >= 0)
+	fsel, csel, = numpy.nonzero(valid)
+	csel = corners[fsel, csel]
+	loop_total = valid.sum(axis=1).astype(numpy.int64)
+	loop_start = numpy.cumsum(loop_total)-loop_total
+	loop_vidxs = recs["vidxs"][fsel, csel].astype(numpy.int64)
+
+	loop_uvs = None
+	if textures is not None and len(textures) != 0:
+		tidx = numpy.minimum(recs["tidx"].astype(numpy.int64), len(textures)-1)
+		iw = numpy.maximum(textures["iw"][tidx].astype(numpy.float64)-1, 1)
+		ih = numpy.maximum(textures["ih"][tidx].astype(numpy.float64)-1, 1)
+		tp = recs["tpoints"][fsel, csel].astype(numpy.float64)
+		loop_uvs = numpy.empty((len(fsel), 2), dtype=numpy.float64)
+		loop_uvs[:, 0] = tp[:, 0]/iw[fsel]
+		loop_uvs[:, 1] = 1.0-tp[:, 1]/ih[fsel]
+
+	return MeshArrays(
+		co=co,
+		poly_normals=None,
+		loop_start=loop_start,
+		loop_total=loop_total,
+		loop_vidxs=loop_vidxs,
+		loop_uvs=loop_uvs)
+
+def mesh_from_arrays(name, marr):
+	mesh = bpy.data.meshes.new(name)
+	mesh.vertices.add(len(marr.co))
+	mesh.vertices.foreach_set("co", marr.co.astype(numpy.float32).reshape(-1))
+	mesh.loops.add(len(marr.loop_vidxs))
+	mesh.loops.foreach_set("vertex_index", marr.loop_vidxs.astype(numpy.int32))
+	mesh.polygons.add(len(marr.loop_start))
+	mesh.polygons.foreach_set("loop_start", marr.loop_start.astype(numpy.int32))
+	mesh.polygons.foreach_set("loop_total", marr.loop_total.astype(numpy.int32))
+	if marr.loop_uvs is not None:
+		if hasattr(mesh, "uv_textures"):
+			mesh.uv_textures.new()
+		else:
+			mesh.uv_layers.new()
+		mesh.uv_layers.active.data.foreach_set("uv",
+			marr.loop_uvs.astype(numpy.float32).reshape(-1))
+	mesh.validate()
+	mesh.update(calc_edges=True)
+	return mesh
+
+def import_psx(psx_fname):
+	reader = PSXReader(psx_fname)
+	try:
+		textures = reader.textures()
+		refname_base = os.path.splitext(os.path.basename(psx_fname))[0]
+		# Plain ints, so that no view of the file outlives the reader
+		places = reader.objs[["model_idx", "px", "py", "pz"]].tolist()
+		meshes = {}
+		for (i, (midx, px, py, pz,),) in enumerate(places):
+			if midx not in meshes:
+				marr = pmodel_mesh_arrays(reader.model(midx), textures=textures)
+				meshes[midx] = mesh_from_arrays("%s_%d" % (refname_base, midx,), marr)
+			bobj = bpy.data.objects.new("%s_%d" % (refname_base, i,), meshes[midx])
+			bobj.location = (
+				 px*(BLEND_PER_THPS/4096.0/4096.0),
+				 pz*(BLEND_PER_THPS/4096.0/4096.0),
+				-py*(BLEND_PER_THPS/4096.0/4096.0),)
+			bpy.context.scene.objects.link(bobj)
+		return len(places)
+	finally:
+		textures = None
+		reader.close()
+
+#
+# Blender images
+#
+
+def material_image(mat):
+	if mat is None:
+		return None
+	if getattr(mat, "use_nodes", False) and mat.node_tree is not None:
+		for node in mat.node_tree.nodes:
+			if node.type == "TEX_IMAGE" and node.image is not None:
+				return node.image
+	for slot in getattr(mat, "texture_slots", []):
+		if slot is None or slot.texture is None:
+			continue
+		if slot.texture.type == "IMAGE" and slot.texture.image is not None:
+			return slot.texture.image
+	return None
+
+def image_rgba(image):
+	# Returns (h,w,4) floats, top row first
+	w, h, = image.size
+	pixels = numpy.empty(w*h*4, dtype=numpy.float32)
+	if hasattr(image.pixels, "foreach_get"):
+		image.pixels.foreach_get(pixels)
+	else:
+		pixels[:] = image.pixels[:]
+	return pixels.reshape((h, w, 4))[::-1]
+
+#
+# Rails
+#
+
+def bezier_sample(co, left, right, *, cyclic, resolution):
+	# Returns (N,3) points along a Bezier spline, resolution per span.
+	# The last point is only repeated at the end of an open spline.
+	if len(co) < 2:
+		return co.copy()
+	nxt = numpy.arange(1, len(co)+1)
+	if cyclic:
+		nxt[-1] = 0
+	else:
+		nxt = nxt[:-1]
+	cur = numpy.arange(len(nxt))
+	ctrl = numpy.stack([co[cur], right[cur], left[nxt], co[nxt]], axis=1)
+	t = numpy.arange(resolution, dtype=numpy.float64)/resolution
+	s = 1.0-t
+	basis = numpy.stack([s*s*s, 3.0*s*s*t, 3.0*s*t*t, t*t*t], axis=1)
+	pts = numpy.einsum("rk,skc->src", basis, ctrl).reshape((-1, 3))
+	if not cyclic:
+		pts = numpy.concatenate([pts, co[-1:]])
+	return pts
+
+def rail_weld_ends(ends, *, tolerance=0):
+	# ends is (2R,3), the first and last points of R open rails.
+	# Returns the end each one welds to: ends within tolerance of each
+	# other join up, closest first, except that a rail's own two ends
+	# never end up as one point.
+	# Sort by x and sweep, so only pairs within tolerance on x are measured
+	order = numpy.argsort(ends[:, 0], kind="stable")
+	sends = ends[order]
+	found = []
+	for lag in range(1, len(sends)):
+		near = numpy.flatnonzero((sends[lag:, 0]-sends[:-lag, 0]) <= tolerance)
+		if len(near) == 0:
+			break
+		dist2 = ((sends[near+lag]-sends[near])**2).sum(axis=1)
+		ok = (dist2 <= tolerance*tolerance)
+		found.append(numpy.stack([dist2[ok], order[near[ok]], order[near[ok]+lag]], axis=1))
+	pairs = (numpy.concatenate(found) if len(found) != 0 else numpy.zeros((0, 3), dtype=numpy.int64))
+	pairs[:, 1:].sort(axis=1)
+	pairs = pairs[numpy.lexsort(pairs.T[::-1])]
+
+	# Join groups, lowest end first, keeping the rails in each group apart
+	group = list(range(len(ends)))
+	members = [[i] for i in range(len(ends))]
+	for (dist2, a, b,) in pairs.tolist():
+		ga = group[a]
+		gb = group[b]
+		if ga == gb:
+			continue
+		if {i>>1 for i in members[ga]} & {i>>1 for i in members[gb]}:
+			continue
+		if gb < ga:
+			(ga, gb,) = (gb, ga,)
+		for i in members[gb]:
+			group[i] = ga
+		members[ga] += members[gb]
+		members[gb] = []
+	return numpy.array(group, dtype=numpy.int64)
+
+def rail_network(rails, *, tolerance=0):
+	# Returns ((N,3) fix12 rail points, (L,2) links from -> to).
+	# Open rail ends within tolerance of each other become one point,
+	# so rails that meet form one network.
+	points = []
+	links = []
+	ends = []
+	base = 0
+	for rail in rails:
+		verts = mesh_fix12_vertices(rail.points, scale=(1.0, 1.0, 1.0,), location=(0.0, 0.0, 0.0,))
+		# Skip points that quantise onto the one before
+		keep = numpy.ones(len(verts), dtype=bool)
+		keep[1:] = (verts[1:] != verts[:-1]).any(axis=1)
+		verts = verts[keep]
+		if rail.cyclic and len(verts) >= 2 and (verts[0] == verts[-1]).all():
+			verts = verts[:-1]
+		if len(verts) < 2:
+			continue
+		idxs = numpy.arange(base, base+len(verts))
+		links.append(numpy.stack([idxs[:-1], idxs[1:]], axis=1))
+		if rail.cyclic:
+			links.append(numpy.array([[idxs[-1], idxs[0]]], dtype=numpy.int64))
+		else:
+			ends.append(idxs[[0, -1]])
+		points.append(verts)
+		base += len(verts)
+	if len(points) == 0:
+		return numpy.zeros((0, 3), dtype=numpy.int64), numpy.zeros((0, 2), dtype=numpy.int64)
+	points = numpy.concatenate(points)
+	links = numpy.concatenate(links)
+
+	# Weld the ends, then drop the points that went away
+	remap = numpy.arange(len(points))
+	if len(ends) != 0:
+		ends = numpy.concatenate(ends)
+		remap[ends] = ends[rail_weld_ends(points[ends], tolerance=tolerance)]
+	used, remap, = numpy.unique(remap, return_inverse=True)
+	links = remap.reshape(-1)[links]
+	links = links[links[:, 0] != links[:, 1]]
+	if len(links) != 0:
+		first, inv, = unique_rows(links)
+		links = links[numpy.sort(first)]
+	return points[used], links
+
+#
+# Scene description
+#
+
+SCENE_FORMAT_VERSION = 1
+
+class Scene(object):
+	# Everything export_scene() needs, with no Blender objects in it.
+	# Saved as a .npz holding the arrays and a JSON manifest.
+	class SceneMesh(object):
+		def __init__(self, *, name, marr, scale, location, slots, group=None):
+			self.name = name
+			self.marr = marr
+			self.scale = tuple(scale)
+			self.location = tuple(location)
+			# Image name per material slot, None for untextured
+			self.slots = list(slots)
+			# Blender group, used to split the level into spooled regions
+			self.group = group
+
+	class SceneRail(object):
+		def __init__(self, *, name, points, cyclic):
+			self.name = name
+			# (N,3) world space Blender coordinates
+			self.points = points
+			self.cyclic = cyclic
+
+	def __init__(self):
+		self.meshes = []
+		self.lamps = []
+		# Image name -> (h,w,4) floats, top row first
+		self.images = {}
+		# {"name", "pos"}, with pos in world space Blender coordinates
+		self.restarts = [{"name": "Start", "pos": (0.0, 0.0, 0.0,)}]
+		self.rails = []
+
+	def mesh(self, *, name, marr, scale, location, slots, group=None):
+		mesh = Scene.SceneMesh(
+			name=name,
+			marr=marr,
+			scale=scale,
+			location=location,
+			slots=slots,
+			group=group)
+		self.meshes.append(mesh)
+		return mesh
+
+	def rail(self, *, name, points, cyclic=False):
+		rail = Scene.SceneRail(
+			name=name,
+			points=numpy.asarray(points, dtype=numpy.float64).reshape((-1, 3)),
+			cyclic=cyclic)
+		self.rails.append(rail)
+		return rail
+
+	def save(self, fname):
+		arrays = {}
+		manifest = {
+			"version": SCENE_FORMAT_VERSION,
+			"meshes": [],
+			"lamps": self.lamps,
+			"images": sorted(self.images.keys()),
+			"restarts": self.restarts,
+			"rails": [{"name": rail.name, "cyclic": rail.cyclic} for rail in self.rails],
+		}
+		for (i, mesh,) in enumerate(self.meshes):
+			marr = mesh.marr
+			# Blender hands out 32-bit values, so these round-trip exactly
+			arrays["mesh%d_co" % (i,)] = marr.co.astype(numpy.float32)
+			arrays["mesh%d_poly_normals" % (i,)] = marr.poly_normals.astype(numpy.float32)
+			arrays["mesh%d_loop_start" % (i,)] = marr.loop_start.astype(numpy.int32)
+			arrays["mesh%d_loop_total" % (i,)] = marr.loop_total.astype(numpy.int32)
+			arrays["mesh%d_loop_vidxs" % (i,)] = marr.loop_vidxs.astype(numpy.int32)
+			arrays["mesh%d_poly_materials" % (i,)] = marr.poly_materials.astype(numpy.int32)
+			if marr.loop_uvs is not None:
+				arrays["mesh%d_loop_uvs" % (i,)] = marr.loop_uvs.astype(numpy.float32)
+			manifest["meshes"].append({
+				"name": mesh.name,
+				"scale": mesh.scale,
+				"location": mesh.location,
+				"slots": mesh.slots,
+				"group": mesh.group,
+				"uvs": marr.loop_uvs is not None,
+			})
+		for (i, name,) in enumerate(manifest["images"]):
+			arrays["image%d" % (i,)] = self.images[name]
+		for (i, rail,) in enumerate(self.rails):
+			arrays["rail%d_points" % (i,)] = rail.points
+		arrays["manifest"] = numpy.frombuffer(
+			json.dumps(manifest, sort_keys=True).encode("utf-8"), dtype=numpy.uint8)
+
+		fp = io.BytesIO()
+		numpy.savez(fp, **arrays)
+		write_file_atomic(fname, fp.getvalue())
+
+	@classmethod
+	def load(cls, fname):
+		scene = cls()
+		with numpy.load(fname, allow_pickle=False) as arrays:
+			manifest = json.loads(arrays["manifest"].tobytes().decode("utf-8"))
+			if manifest["version"] != SCENE_FORMAT_VERSION:
+				raise Exception("unsupported scene version: %s" % (repr(manifest["version"]),))
+			scene.lamps = manifest["lamps"]
+			scene.restarts = manifest["restarts"]
+			for (i, name,) in enumerate(manifest["images"]):
+				scene.images[name] = arrays["image%d" % (i,)]
+			for (i, rail,) in enumerate(manifest["rails"]):
+				scene.rail(
+					name=rail["name"],
+					points=arrays["rail%d_points" % (i,)],
+					cyclic=rail["cyclic"])
+			for (i, mesh,) in enumerate(manifest["meshes"]):
+				marr = MeshArrays(
+					co=arrays["mesh%d_co" % (i,)].astype(numpy.float64),
+					poly_normals=arrays["mesh%d_poly_normals" % (i,)].astype(numpy.float64),
+					loop_start=arrays["mesh%d_loop_start" % (i,)].astype(numpy.int64),
+					loop_total=arrays["mesh%d_loop_total" % (i,)].astype(numpy.int64),
+					loop_vidxs=arrays["mesh%d_loop_vidxs" % (i,)].astype(numpy.int64),
+					poly_materials=arrays["mesh%d_poly_materials" % (i,)].astype(numpy.int64),
+					loop_uvs=(arrays["mesh%d_loop_uvs" % (i,)].astype(numpy.float64)
+						if mesh["uvs"] else None))
+				scene.mesh(
+					name=mesh["name"],
+					marr=marr,
+					scale=mesh["scale"],
+					location=mesh["location"],
+					slots=mesh["slots"],
+					group=mesh["group"])
+		return scene
+
+def scene_from_blender(*, stats=None):
+	if stats is None:
+		stats = ExportStats()
+	scene = Scene()
+
+	# Go through all of the lamps
+	with stats.phase("lamp_scan"):
+		for obj in bpy.data.objects:
+			# Ensure that this is a lamp
+			if not isinstance(obj.data, bpy.types.Lamp):
+				continue
+
+			# Get location
+			locationx = obj.location.x
+			locationy = obj.location.y
+			locationz = obj.location.z
+
+			# Lamps point down their local -Z
+			mtx = obj.matrix_world
+			dirx = -mtx[0][2]
+			diry = -mtx[1][2]
+			dirz = -mtx[2][2]
+
+			# Get lamp
+			lamp = obj.data
+
+			# Only greyscale lighting for now
+			r, g, b, = lamp.color
+			grey = 0.299*r + 0.587*g + 0.114*b
+
+			scene.lamps.append({
+				"pos": (locationx, locationy, locationz,),
+				"dir": (dirx, diry, dirz,),
+				"type": lamp.type,
+				"energy": lamp.energy*grey,
+				"distance": lamp.distance,
+				"spot_size": getattr(lamp, "spot_size", math.pi),
+			})
+
+	# Go through the meshes
+	for obj in bpy.data.objects:
+		# Ensure that this is a mesh
+		if not isinstance(obj.data, bpy.types.Mesh):
+			continue
+
+		# Get mesh
+		with stats.phase("mesh_extract"):
+			marr = mesh_extract(obj.data)
+
+		# Find the images used by this object's materials
+		slots = []
+		for slot in obj.material_slots:
+			image = material_image(slot.material)
+			if image is None or image.size[0] == 0 or image.size[1] == 0:
+				slots.append(None)
+				continue
+			if image.name not in scene.images:
+				with stats.phase("images"):
+					scene.images[image.name] = texture_fit(image_rgba(image))
+			slots.append(image.name)
+
+		groups = getattr(obj, "users_group", ())
+		scene.mesh(
+			name=obj.name,
+			marr=marr,
+			scale=obj.scale,
+			location=obj.location,
+			slots=slots,
+			group=(groups[0].name if len(groups) != 0 else None))
+
+	# Curves become rails
+	with stats.phase("rail_scan"):
+		for obj in bpy.data.objects:
+			if not isinstance(obj.data, bpy.types.Curve):
+				continue
+
+			mtx = numpy.array([list(row) for row in obj.matrix_world], dtype=numpy.float64)
+			for (i, spline,) in enumerate(obj.data.splines):
+				if spline.type == "BEZIER":
+					n = len(spline.bezier_points)
+					co, left, right, = (numpy.empty(n*3, dtype=numpy.float32) for j in range(3))
+					spline.bezier_points.foreach_get("co", co)
+					spline.bezier_points.foreach_get("handle_left", left)
+					spline.bezier_points.foreach_get("handle_right", right)
+					points = bezier_sample(
+						co.reshape((-1, 3)).astype(numpy.float64),
+						left.reshape((-1, 3)).astype(numpy.float64),
+						right.reshape((-1, 3)).astype(numpy.float64),
+						cyclic=spline.use_cyclic_u,
+						resolution=max(1, spline.resolution_u))
+				else:
+					# Poly and NURBS splines go through their control points
+					co = numpy.empty(len(spline.points)*4, dtype=numpy.float32)
+					spline.points.foreach_get("co", co)
+					points = co.reshape((-1, 4))[:, :3].astype(numpy.float64)
+
+				scene.rail(
+					name="%s.%d" % (obj.name, i,),
+					points=points.dot(mtx[:3, :3].T)+mtx[:3, 3],
+					cyclic=spline.use_cyclic_u)
+
+	return scene
+
+# With stream, models are encoded and spooled whenever this many faces build up
+STREAM_FLUSH_FACES = 0x4000
+
+#
+# Level spooling
+#
+
+SPOOL_MODES = ("NONE", "GROUPS", "CLUSTER",)
+
+def cluster_points(points, *, count, iterations=32):
+	# k-means, starting from points spread along the widest axis.
+	# Returns a cluster index per point.
+	count = max(1, min(count, len(points)))
+	axis = int(numpy.argmax(points.max(axis=0)-points.min(axis=0)))
+	order = numpy.argsort(points[:, axis], kind="stable")
+	centres = points[order[((2*numpy.arange(count)+1)*len(points))//(2*count)]]
+	for i in range(iterations):
+		dist = ((points[:, None, :]-centres[None, :, :])**2).sum(axis=2)
+		labels = dist.argmin(axis=1)
+		sums = numpy.zeros(centres.shape, dtype=numpy.float64)
+		numpy.add.at(sums, labels, points)
+		sizes = numpy.bincount(labels, minlength=count)
+		moved = numpy.where(sizes[:, None] > 0, sums/numpy.maximum(sizes, 1)[:, None], centres)
+		if (moved == centres).all():
+			break
+		centres = moved
+	return labels
+
+def spool_parts(scene, *, mode, regions, bounds):
+	# Returns a part index per scene mesh.
+	# Part 0 is the main file; the rest are regions that get spooled in and out.
+	if mode == "NONE" or len(scene.meshes) == 0:
+		return numpy.zeros(len(scene.meshes), dtype=numpy.int64)
+
+	if mode == "GROUPS":
+		# Ungrouped meshes stay in the main file
+		names = sorted(set(mesh.group for mesh in scene.meshes if mesh.group is not None))
+		index = {name: i+1 for (i, name,) in enumerate(names)}
+		labels = numpy.array([index.get(mesh.group, 0) for mesh in scene.meshes], dtype=numpy.int64)
+
+	elif mode == "CLUSTER":
+		# The cluster nearest the first restart is the main file
+		centres = numpy.array([(lo+hi)*0.5 for (lo, hi,) in bounds], dtype=numpy.float64)
+		labels = cluster_points(centres, count=regions)
+		start = blender_to_model(scene.restarts[0]["pos"] if scene.restarts else (0.0, 0.0, 0.0,))
+		main = labels[numpy.argmin(((centres-start)**2).sum(axis=1))]
+		labels = numpy.where(labels == main, -1, labels)+1
+
+	else:
+		raise Exception("unknown spool mode: %s" % (repr(mode),))
+
+	# Meshes without faces add nothing, so they go in the main file and
+	# regions left with nothing are dropped. The main file always stays.
+	faced = numpy.array([len(mesh.marr.loop_start) != 0 for mesh in scene.meshes], dtype=bool)
+	labels = numpy.where(faced, labels, 0)
+	used, labels, = numpy.unique(numpy.concatenate([[0], labels]), return_inverse=True)
+	return labels.reshape(-1)[1:]
+
+def box_distance(pos, lo, hi):
+	# Distance from a point to an axis-aligned box, 0 inside it
+	return float(numpy.sqrt((numpy.maximum(numpy.maximum(lo-pos, pos-hi), 0.0)**2).sum()))
+
+class LevelPart(object):
+	# One .psx of the level and the export state that goes with it
+	def __init__(self, *, fname, refname, psx):
+		self.fname = fname
+		self.refname = refname
+		self.psx = psx
+		# Image name -> (tidx, iw, ih)
+		self.textures = {}
+		self.cache_todo = []
+		# Faces in models that have not been encoded yet
+		self.pending_faces = 0
+		# Extent in model units, for deciding what to spool
+		self.lo = None
+		self.hi = None
+
+	def extend(self, lo, hi):
+		self.lo = (lo if self.lo is None else numpy.minimum(self.lo, lo))
+		self.hi = (hi if self.hi is None else numpy.maximum(self.hi, hi))
+
+#
+# Pre-flight checks
+#
+
+# Object, rail and restart positions are s32 fix12, so the level has to
+# stay within this many model units of the origin on every axis
+PREFLIGHT_MAX_COORD = 0x7FFFF
+# Objects point at their model with a u16
+PREFLIGHT_MAX_MODELS = 0x10000
+# Spooled files number their textures 0x1000 apart
+PREFLIGHT_MAX_PART_TEXTURES = 0x1000
+# A fan face whose normal leans this far towards the wrong side is folded
+PREFLIGHT_FOLD_COS = 0.01
+
+def preflight_problem(level, where, message):
+	return {"level": level, "where": where, "message": message}
+
+def preflight_mesh(mesh, *, images):
+	# Returns (problems, lo, hi, fewest models) for one scene mesh.
+	# lo and hi are None when the mesh is empty or too broken to measure.
+	where = "mesh %s" % (repr(mesh.name),)
+	problems = []
+	marr = mesh.marr
+
+	missing = sorted(set(name for name in mesh.slots if name is not None and name not in images))
+	for name in missing:
+		problems.append(preflight_problem("error", where, "uses image %s, which is not in the scene" % (repr(name),)))
+	if len(marr.co) == 0:
+		return problems, None, None, 0
+
+	if not (numpy.isfinite(marr.co).all()
+			and numpy.isfinite(mesh.scale).all() and numpy.isfinite(mesh.location).all()):
+		problems.append(preflight_problem("error", where, "has coordinates that are not finite"))
+		return problems, None, None, 1
+
+	# Anything wrong here would make the fan below read the wrong loops
+	ls = marr.loop_start
+	lt = marr.loop_total
+	nshort = int((lt < 3).sum())
+	if nshort != 0:
+		problems.append(preflight_problem("error", where, "has %d faces with fewer than 3 corners" % (nshort,)))
+	if ((ls < 0) | (ls+lt > len(marr.loop_vidxs))).any() or (len(marr.loop_vidxs) != 0
+			and (marr.loop_vidxs.min() < 0 or marr.loop_vidxs.max() >= len(marr.co))):
+		problems.append(preflight_problem("error", where, "has face corners that point outside its vertex list"))
+	if len(problems) != len(missing):
+		return problems, None, None, 1
+
+	verts = mesh_fix12_vertices(marr.co, scale=mesh.scale, location=mesh.location)
+	lo = verts.min(axis=0)
+	hi = verts.max(axis=0)
+	if lo.min() < -PREFLIGHT_MAX_COORD or hi.max() > PREFLIGHT_MAX_COORD:
+		problems.append(preflight_problem("error", where,
+			"reaches %.1f from the origin, past the %.1f that positions can hold" % (
+				max(-lo.min(), hi.max())*BLEND_PER_THPS/4096.0,
+				PREFLIGHT_MAX_COORD*BLEND_PER_THPS/4096.0,)))
+
+	# Every corner of a face has to be in one model
+	floops, is_tri, = mesh_fan_faces(marr, verts)
+	fpts = verts[marr.loop_vidxs[numpy.where(floops >= 0, floops, floops[:, :1])]]
+	nbig = int(((fpts.max(axis=1)-fpts.min(axis=1)).max(axis=1) > MODEL_MAX_EXTENT).sum())
+	if nbig != 0:
+		problems.append(preflight_problem("error", where,
+			"has %d faces too large to fit in any model" % (nbig,)))
+
+	# Each fan face should face the same way as its polygon. Concave,
+	# twisted or badly wound n-gons end up with folded faces.
+	fpoly = marr.loop_polys()[floops[:, 0]]
+	pn = marr.poly_normals[fpoly][:, (0, 2, 1,)]*(1.0, -1.0, 1.0,)
+	c = fpts.astype(numpy.float64)
+	folded = numpy.zeros(len(floops), dtype=bool)
+	flat = numpy.ones(len(floops), dtype=bool)
+	for (a, b, d, sel,) in ((0, 1, 2, None,), (1, 3, 2, ~is_tri,),):
+		n = numpy.cross(c[:, b]-c[:, a], c[:, d]-c[:, a])
+		n2 = (n*n).sum(axis=1)
+		lean = (n*pn).sum(axis=1) > PREFLIGHT_FOLD_COS*numpy.sqrt(n2)
+		folded |= (lean if sel is None else lean & sel)
+		flat &= ((n2 == 0) if sel is None else (n2 == 0) | ~sel)
+	nfolded = len(numpy.unique(fpoly[folded & (lt[fpoly] >= 4)]))
+	if nfolded != 0:
+		problems.append(preflight_problem("warning", where,
+			"has %d n-gons that are concave or twisted and will render folded" % (nfolded,)))
+
+	# These export fine, as nothing
+	if len(floops) == 0:
+		problems.append(preflight_problem("warning", where, "has no faces and will be left out"))
+		return problems, lo, hi, 0
+	if flat.all():
+		problems.append(preflight_problem("warning", where, "has only zero-area faces and will be left out"))
+		return problems, lo, hi, 0
+
+	# Models hold at most MODEL_MAX_VERTICES vertices and MODEL_MAX_FACES
+	# faces, though triangles may yet pair up into quads
+	nused = len(numpy.unique(marr.loop_vidxs))
+	return problems, lo, hi, max(1, -(-nused//MODEL_MAX_VERTICES), -(-len(floops)//(2*MODEL_MAX_FACES)))
+
+def preflight_scene(scene, *, mesh_parts, rail_tolerance=0):
+	# Checks everything that would otherwise fail halfway through an export;
+	# a scene with no errors here should encode without throwing.
+	# Returns a list of problems, each a dict with level ("error" or
+	# "warning"), where and message. Only the cheap array work is done here;
+	# nothing gets welded, encoded or written.
+	problems = []
+	nparts = (int(mesh_parts.max())+1 if len(mesh_parts) != 0 else 1)
+	part_models = [0]*nparts
+	part_lo = [None]*nparts
+	part_hi = [None]*nparts
+	part_images = [set() for i in range(nparts)]
+
+	for (mesh, part,) in zip(scene.meshes, mesh_parts.tolist()):
+		mproblems, lo, hi, nmodels, = preflight_mesh(mesh, images=scene.images)
+		problems.extend(mproblems)
+		part_models[part] += nmodels
+		part_images[part].update(name for name in mesh.slots if name is not None)
+		if lo is not None:
+			part_lo[part] = (lo if part_lo[part] is None else numpy.minimum(part_lo[part], lo))
+			part_hi[part] = (hi if part_hi[part] is None else numpy.maximum(part_hi[part], hi))
+
+	for i in range(nparts):
+		where = ("main file" if i == 0 else "region %d" % (i,))
+		if part_models[i] == 0:
+			problems.append(preflight_problem("warning", where,
+				"has no models and will be written empty" if i == 0 else
+				"has nothing to draw and will not be written"))
+		if part_models[i] > PREFLIGHT_MAX_MODELS:
+			problems.append(preflight_problem("error", where,
+				"needs at least %d models, more than the %d a file can hold" % (
+					part_models[i], PREFLIGHT_MAX_MODELS,)))
+		# Plus the dummy texture
+		if nparts > 1 and len(part_images[i])+1 > PREFLIGHT_MAX_PART_TEXTURES:
+			problems.append(preflight_problem("error", where,
+				"uses %d images, more than the %d a spooled file can name" % (
+					len(part_images[i]), PREFLIGHT_MAX_PART_TEXTURES-1,)))
+		# The physics grid adds a margin and rounds up to whole cells
+		if part_lo[i] is not None:
+			lo = (part_lo[i][(0, 2,),]<<12)-0x20000
+			span = int((part_hi[i][(0, 2,),]-part_lo[i][(0, 2,),]).max()<<12)+0x40000+PHYS_GRID_MAX_DIVS
+			if lo.min() < -0x80000000 or lo.max()+span > 0x7FFFFFFF:
+				problems.append(preflight_problem("error", where,
+					"is too wide for the physics grid"))
+
+	if len(scene.restarts) == 0:
+		problems.append(preflight_problem("error", "scene", "has no restarts"))
+	for restart in scene.restarts:
+		where = "restart %s" % (repr(restart["name"]),)
+		pos = blender_to_model(restart["pos"])
+		if not numpy.isfinite(pos).all():
+			problems.append(preflight_problem("error", where, "has a position that is not finite"))
+		elif numpy.abs(pos).max() > PREFLIGHT_MAX_COORD:
+			problems.append(preflight_problem("error", where, "is too far from the origin"))
+
+	rails_ok = True
+	for rail in scene.rails:
+		if not numpy.isfinite(rail.points).all():
+			problems.append(preflight_problem("error", "rail %s" % (repr(rail.name),),
+				"has points that are not finite"))
+			rails_ok = False
+	if rails_ok:
+		points, links, = rail_network(scene.rails, tolerance=rail_tolerance)
+		if len(points) != 0 and numpy.abs(points).max() > PREFLIGHT_MAX_COORD:
+			problems.append(preflight_problem("error", "rails", "reach too far from the origin"))
+		# Autoexec, restarts and rail points
+		nnodes = 1+len(scene.restarts)+len(points)
+		if nnodes > 0xFFFF:
+			problems.append(preflight_problem("error", "rails",
+				"need %d TRG nodes, more than the %d a file can hold" % (nnodes, 0xFFFF,)))
+
+	return problems
+
+def preflight_report_lines(problems):
+	lines = ["%s: %s %s" % (problem["level"], problem["where"], problem["message"],)
+		for problem in problems]
+	nerrors = sum(1 for problem in problems if problem["level"] == "error")
+	lines.append("pre-flight: %d errors, %d warnings" % (nerrors, len(problems)-nerrors,))
+	return lines
+
+def export_scene(scene, trg_fname, *, auto_grid=False, cache_dir=None, workers=1, weld_tolerance=0,
+		bake_lighting=True, ambient=0.5, texture_bpp=None, pack_textures=True,
+		palette_tolerance=0, share_planes=True, merge_quads=True, bake_ao=False, ao_distance=1024, ao_rays=16,
+		ao_strength=0.75, rail_tolerance=0, spool_mode="NONE", spool_regions=4, spool_distance=0,
+		stream=False, check_only=False, stats=None):
+	if stats is None:
+		stats = ExportStats()
 	fname_base = ".".join(trg_fname.split(".")[:-1])
 	refname_base = fname_base.split("/")[-1].split("\\")[-1]
 	trg_refname = fname_base.split("/")[-1].split("\\")[-1]
@@ -713,187 +3519,375 @@ def export_trg(trg_fname):
 	print("ref-name PSX lib:  %s" % (repr(psx_lib_refname),))
 	print("ref-name PSX obj:  %s" % (repr(psx_obj_refname),))
 
+	# Split the level into the main file and spooled regions
+	bounds = None
+	if spool_mode != "NONE":
+		bounds = []
+		for mesh in scene.meshes:
+			verts = mesh_fix12_vertices(mesh.marr.co, scale=mesh.scale, location=mesh.location)
+			if len(verts) == 0:
+				verts = numpy.zeros((1, 3), dtype=numpy.int64)
+			bounds.append((verts.min(axis=0), verts.max(axis=0),))
+	mesh_parts = spool_parts(scene, mode=spool_mode, regions=spool_regions, bounds=bounds)
+	nparts = (int(mesh_parts.max())+1 if len(mesh_parts) != 0 else 1)
+
+	# Find everything that would stop the export before doing any of it
+	with stats.phase("preflight"):
+		problems = preflight_scene(scene, mesh_parts=mesh_parts, rail_tolerance=rail_tolerance)
+	report = preflight_report_lines(problems)
+	if any(problem["level"] == "error" for problem in problems):
+		stats.close()
+		raise Exception("\n".join(["pre-flight found problems, nothing was written:"]+report))
+	if len(problems) != 0 or check_only:
+		for line in report:
+			print(line)
+	if len(problems) != 0:
+		stats.count("preflight_warnings", len(problems))
+	if check_only:
+		stats.close()
+		return stats
+
 	# Create files
-	psx = PSX()
+	parts = []
+	for i in range(nparts):
+		part = LevelPart(
+			fname=(psx_main_fname if i == 0 else fname_base + "_r%d.psx" % (i,)),
+			refname=(psx_main_refname if i == 0 else refname_base + "_r%d" % (i,)),
+			psx=PSX(streaming=stream, share_planes=share_planes,
+				name_base=0xFEED0000+(i<<12), model_name_base=0xBEEF0000+(i<<16)))
+		if i != 0:
+			print("region %d:          %s" % (i, repr(part.fname),))
+		parts.append(part)
+	if bounds is not None:
+		for (part, (lo, hi,),) in zip(mesh_parts.tolist(), bounds):
+			parts[part].extend(lo, hi)
 	trg = TRG()
 
-	# Create a dummy texture
-	dummytex_idx, dummyname_idx, = psx.texture(
-		unk1=0,
-		iw=8, ih=8,
-		bpp=4,
-		pal=[rgb15(128,128,128)]*16,
-		data=[0x00]*(8*8//2))
-
-	# Light all the things
-	# TODO: handle non-greyscale lighting
-	# TODO: autocalculate this
-	palette = [[i,i,i,0] for i in range(256)]
-	psx.palents = palette
-
-	# Go through all of the lamps
-	lamps = []
-	for obj in bpy.data.objects:
-		# Ensure that this is a lamp
-		if not isinstance(obj.data, bpy.types.Lamp):
-			continue
-
-		# Get location
-		locationx = obj.location.x
-		locationy = obj.location.y
-		locationz = obj.location.z
-
-		# Get lamp
-		lamp = obj.data
-
-		lamps.append({
-			"pos": (locationx, locationy, locationz,),
-			"type": lamp.type,
-		})
-
-	# Go through the meshes and form objects
-	for obj in bpy.data.objects:
-		# Ensure that this is a mesh
-		if not isinstance(obj.data, bpy.types.Mesh):
-			continue
-
-		# Get object + suitable transformation
-		scalex = obj.scale.x
-		scaley = obj.scale.y
-		scalez = obj.scale.z
-		locationx = obj.location.x
-		locationy = obj.location.y
-		locationz = obj.location.z
-
-		# Get mesh
-		mesh = obj.data
-
-		# Get vertices
-		vertices = list(map(
-			lambda v:
-			(
-				fix12(( v.co.x*scalex+locationx)/BLEND_PER_THPS),
-				fix12((-v.co.z*scalez-locationz)/BLEND_PER_THPS),
-				fix12(( v.co.y*scaley+locationy)/BLEND_PER_THPS),
-			),
-			mesh.vertices))
-
-		# Get centre
-		xmin = min(map(lambda v: v[0], vertices))
-		ymin = min(map(lambda v: v[1], vertices))
-		zmin = min(map(lambda v: v[2], vertices))
-		xmax = max(map(lambda v: v[0], vertices))
-		ymax = max(map(lambda v: v[1], vertices))
-		zmax = max(map(lambda v: v[2], vertices))
-		lx = xmax-xmin
-		ly = ymax-ymin
-		lz = zmax-zmin
-		cx = (xmin+xmax+1)>>1
-		cy = (ymin+ymax+1)>>1
-		cz = (zmin+zmax+1)>>1
-
-		# Ensure it's not too big
-		# TODO: autosplit models
-		print(lx, ly, lz)
-		assert lx <= 0xFFFE
-		assert ly <= 0xFFFE
-		assert lz <= 0xFFFE
-
-		# Re-centre it
-		vertices = list(map(
-			lambda v:
-			(v[0]-cx, v[1]-cy, v[2]-cz,),
-			vertices))
-
-		# Create model object
-		mdl = psx.thing(
-			px=cx<<12,
-			py=cy<<12,
-			pz=cz<<12)
-
-		# Add vertices to model
-		vidxs = list(map(
-			lambda v:
-			mdl.vertex(*v),
-			vertices))
-		cidxs = []
-		for v in vertices:
-			# Get vertex normal
-			# TODO!
-			#v[0]
-			cidxs.append(random.randint(64,192))
-
-		for poly in mesh.polygons:
-			# Triangulate and/or Quadrilaterate
-			fvlist = list(poly.vertices)
-
-			# Perform norm correction
-			v0 = vertices[fvlist[0]]
-			v1 = vertices[fvlist[1]]
-			v2 = vertices[fvlist[2]]
-			dva = tuple(map(lambda b,a: b-a, v1, v0))
-			dvb = tuple(map(lambda b,a: b-a, v2, v0))
-			fnx = (dva[1]*dvb[2] - dva[2]*dvb[1])
-			fny = (dva[2]*dvb[0] - dva[0]*dvb[2])
-			fnz = (dva[0]*dvb[1] - dva[1]*dvb[0])
-			pnx =  poly.normal.x
-			pny = -poly.normal.z
-			pnz =  poly.normal.y
-
-			normdot = (0.0
-				+ fnx*pnx 
-				+ fny*pny 
-				+ fnz*pnz)
-
-			if normdot > 0.0:
-				fvlist = fvlist[::-1]
-
-			for i in range(0,len(fvlist)-2,2):
-				i0 = fvlist[0]
-				i1 = fvlist[i+1]
-				i2 = fvlist[i+2]
-				i3 = fvlist[i+3] if i+3 < len(fvlist) else None
-
-				if i3 != None:
-					i1, i2, i3 = i1, i3, i2
-
-				rflags = 0x1803
-				sflags = 0x0000
-
-				if i3 == None:
-					rflags |= 0x0010 # Triangle
-
-				mdl.face(
-					rflags = rflags,
-					sflags = sflags,
-					vidxs = [
-						vidxs[i0],
-						vidxs[i1],
-						vidxs[i2],
-						vidxs[i3] if i3 != None else 0,
-					],
-					#cmd = [random.randint(80,160) for i in range(3) ]+[0x24],
-					#cmd = [random.randint(0,255) for i in range(4)],
-					cmd = [
-						cidxs[i0],
-						cidxs[i1],
-						cidxs[i2],
-						cidxs[i3] if i3 != None else 0,
-					],
-					tidx = dummytex_idx,
-					tpoints = [
-						(0,0),
-						(0,0),
-						(0,0),
-						(0,0),
-					])
+	for part in parts:
+		# Create a dummy texture
+		dummytex_idx, dummyname_idx, = part.psx.texture(
+			unk1=0,
+			iw=8, ih=8,
+			bpp=4,
+			pal=[rgb15(128,128,128)]*16,
+			data=[0x00]*(8*8//2))
+
+		# Colour indices are greyscale brightness
+		# TODO: handle non-greyscale lighting
+		palette = [[i,i,i,0] for i in range(256)]
+		part.psx.palents = palette
+
+	with stats.phase("lamp_grid"):
+		lamp_grid = LampGrid.from_lamps(scene.lamps)
+
+	# Open the model cache
+	cache = None
+	if cache_dir is not None:
+		cache = BlobCache(path=cache_dir)
+	cache_settings = (dummytex_idx, weld_tolerance, share_planes, merge_quads,
+		(bake_lighting, ambient, lamp_grid.digest(),) if bake_lighting else None,
+		(ao_strength,) if bake_ao else None,)
+
+	# Occlusion can come from any mesh, so the BVH covers the whole level.
+	# A mesh's cached bake stays valid while neither it nor any mesh
+	# within reach of its rays changes.
+	ao_keys = [None]*len(scene.meshes)
+	ao_tris = []
+	ao_bvh = None
+	if bake_ao:
+		with stats.phase("occlusion"):
+			ao_lo = numpy.zeros((len(scene.meshes), 3), dtype=numpy.int64)
+			ao_hi = numpy.zeros((len(scene.meshes), 3), dtype=numpy.int64)
+			for (i, mesh,) in enumerate(scene.meshes):
+				if len(mesh.marr.co) == 0:
+					continue
+				verts = mesh_fix12_vertices(mesh.marr.co, scale=mesh.scale, location=mesh.location)
+				floops, is_tri, = mesh_fan_faces(mesh.marr, verts)
+				ao_tris.append(mesh_triangles(verts, numpy.where(floops >= 0, mesh.marr.loop_vidxs[floops], -1)))
+				ao_lo[i] = verts.min(axis=0)
+				ao_hi[i] = verts.max(axis=0)
+			if cache is not None:
+				content = [mesh_cache_key(mesh.marr, scale=mesh.scale, location=mesh.location, settings="occlusion")
+					for mesh in scene.meshes]
+				for i in range(len(scene.meshes)):
+					near = numpy.flatnonzero(
+						(ao_lo <= ao_hi[i]+ao_distance).all(axis=1)
+						& (ao_hi >= ao_lo[i]-ao_distance).all(axis=1))
+					ao_keys[i] = cache_key("occlusion", AO_CACHE_VERSION, BLEND_PER_THPS,
+						weld_tolerance, ao_distance, ao_rays, content[i],
+						[content[j] for j in near.tolist()])
+
+	# Vertices removed, faces removed, quads turned into triangles,
+	# meshes left with no faces
+	clean_stats = [0, 0, 0, 0]
+
+	# One pool of encoder processes serves every flush of every part
+	pool = None
+	if workers > 1:
+		pool = concurrent.futures.ProcessPoolExecutor(max_workers=workers)
+	try:
+		# Go through the meshes and form objects
+		for (mesh, part_idx, ao_key,) in zip(scene.meshes, mesh_parts.tolist(), ao_keys):
+			part = parts[part_idx]
+			psx = part.psx
+			textures = part.textures
+
+			# Get object + suitable transformation
+			scale = mesh.scale
+			location = mesh.location
+			marr = mesh.marr
+			if len(marr.co) == 0:
+				continue
+
+			# Convert the images used by this object's materials
+			slot_textures = []
+			for image_name in mesh.slots:
+				if image_name is None:
+					slot_textures.append((dummytex_idx, 8, 8,))
+					continue
+				if image_name not in textures:
+					with stats.phase("textures"):
+						rgba = texture_fit(scene.images[image_name])
+						tkey = cache_key("texture", TEXTURE_CACHE_VERSION, texture_bpp, rgba)
+						tex = None
+						if cache is not None:
+							tex = cache.get(tkey)
+							if tex is not None:
+								tex = unpack_cached_texture(tex)
+						if tex is None:
+							bpp, pal, idx, = texture_quantise(rgba, bpp=texture_bpp)
+							if cache is not None:
+								cache.put(tkey, pack_cached_texture(bpp, pal, idx))
+							tex = (idx.shape[1], idx.shape[0], bpp, pal, texture_pack(idx, bpp=bpp),)
+						iw, ih, bpp, pal, tdata, = tex
+						tidx, tname, = psx.texture(
+							iw=iw, ih=ih,
+							bpp=bpp,
+							pal=pal,
+							data=tdata)
+					textures[image_name] = (tidx, iw, ih,)
+				slot_textures.append(textures[image_name])
+			if len(slot_textures) == 0:
+				slot_textures.append((dummytex_idx, 8, 8,))
+
+			# Reuse the encoded model if nothing has changed
+			with stats.phase("cache"):
+				if cache is not None:
+					key = mesh_cache_key(marr, scale=scale, location=location,
+						settings=(cache_settings, slot_textures, ao_key,))
+					pieces = cache.get(key)
+					if pieces is not None:
+						pieces = unpack_cached_models(pieces)
+					if pieces is not None:
+						for (px, py, pz, bounds, blob,) in pieces:
+							psx.encoded_thing(px=px, py=py, pz=pz, blob=blob, bounds=bounds)
+							nverts, nplanes, nfaces, = struct.unpack_from("<HHH", blob, 2)
+							stats.count("models")
+							stats.count("vertices", nverts)
+							stats.count("faces", nfaces)
+						continue
+
+			# Get vertices
+			with stats.phase("triangulate"):
+				vertices = mesh_fix12_vertices(marr.co, scale=scale, location=location)
+				cidxs = None
+				if not bake_lighting:
+					cidxs = numpy.array([random.randint(64,192) for v in range(len(vertices))], dtype=numpy.int64)
+
+				floops, is_tri = mesh_fan_faces(marr, vertices)
+				fvidxs = numpy.where(floops >= 0, marr.loop_vidxs[floops], -1)
+
+				# Weld vertices and drop faces that quantised away to nothing
+				wfirst, winv, = mesh_weld(vertices, tolerance=weld_tolerance)
+				vertices = vertices[wfirst]
+				if cidxs is not None:
+					cidxs = cidxs[wfirst]
+				fvidxs = numpy.where(fvidxs >= 0, winv[fvidxs], -1)
+				fsel, corners, = mesh_clean_faces(vertices, fvidxs)
+				clean_stats[0] += len(winv)-len(numpy.unique(fvidxs[fsel][corners >= 0]))
+				clean_stats[1] += len(fvidxs)-len(fsel)
+				clean_stats[2] += int(((corners[:, 3] < 0) & ~is_tri[fsel]).sum())
+				fvidxs = mesh_take_corners(fvidxs, fsel, corners)
+				floops = mesh_take_corners(floops, fsel, corners)
+				is_tri = (corners[:, 3] < 0)
+
+				# Nothing left to export; cache that too
+				if len(fvidxs) == 0:
+					clean_stats[3] += 1
+					if cache is not None:
+						part.cache_todo.append((key, [],))
+					continue
+
+				# Pair up triangles that make a flat quad
+				if merge_quads:
+					fsel, corners, partner, = mesh_pair_triangles(vertices, fvidxs,
+						fkeys=marr.poly_materials[marr.loop_polys()[floops[:, 0]]],
+						ckeys=(marr.loop_uvs[floops] if marr.loop_uvs is not None else None))
+					stats.count("merged_quads", int((partner >= 0).sum()))
+					fvidxs = mesh_take_pairs(fvidxs, fsel, corners, partner)
+					floops = mesh_take_pairs(floops, fsel, corners, partner)
+					is_tri = (corners[:, 3] < 0)
+
+			# Texture all the things
+			with stats.phase("uvs"):
+				slot_tidx, slot_iw, slot_ih, = (numpy.array(a, dtype=numpy.int64) for a in zip(*slot_textures))
+				fslot = numpy.clip(marr.poly_materials[marr.loop_polys()[floops[:, 0]]], 0, len(slot_textures)-1)
+				ftidx = slot_tidx[fslot]
+				ftpoints = numpy.zeros((len(floops), 4, 2,), dtype=numpy.int64)
+				if marr.loop_uvs is not None:
+					for (tidx, iw, ih,) in set(slot_textures):
+						tsel = numpy.flatnonzero(ftidx == tidx)
+						ftpoints[tsel] = face_tpoints(marr.loop_uvs[floops[tsel]], floops[tsel] >= 0, iw=iw, ih=ih)
+
+			# Light all the things
+			with stats.phase("lighting"):
+				if bake_lighting or bake_ao:
+					normals = mesh_vertex_normals(vertices, fvidxs)
+
+			# Darken the corners
+			shade = None
+			if bake_ao:
+				with stats.phase("occlusion"):
+					openness = None
+					if cache is not None:
+						data = cache.get(ao_key)
+						if data is not None:
+							openness = unpack_cached_occlusion(data, len(vertices))
+					if openness is None:
+						if ao_bvh is None:
+							ao_bvh = TriangleBVH(numpy.concatenate(ao_tris))
+							stats.count("occlusion_triangles", ao_bvh.count)
+						data = pack_cached_occlusion(bake_occlusion(ao_bvh, vertices, normals,
+							distance=ao_distance, rays=ao_rays))
+						if cache is not None:
+							cache.put(ao_key, data)
+						# Always go through the cached form, so that cold and
+						# warm exports agree
+						openness = unpack_cached_occlusion(data, len(vertices))
+						stats.count("occlusion_rays", len(vertices)*ao_rays)
+					shade = occlusion_shade(openness, strength=ao_strength)
+
+			with stats.phase("lighting"):
+				if bake_lighting:
+					cidxs = light_to_cidxs(lamp_grid.illuminate(vertices, normals),
+						ambient=(ambient if shade is None else ambient*shade))
+				elif shade is not None:
+					cidxs = numpy.rint(cidxs*shade).astype(numpy.int64)
+
+			# Split it into models that fit the format
+			with stats.phase("models"):
+				midxs = []
+				for fsel in mesh_split_faces(vertices, fvidxs):
+					vsel, pfvidxs, = mesh_subset(fvidxs[fsel])
+					pverts = vertices[vsel]
+					pcidxs = cidxs[vsel]
+
+					# Get centre
+					xmin, ymin, zmin, = pverts.min(axis=0).tolist()
+					xmax, ymax, zmax, = pverts.max(axis=0).tolist()
+					cx = (xmin+xmax+1)>>1
+					cy = (ymin+ymax+1)>>1
+					cz = (zmin+zmax+1)>>1
+
+					# Re-centre it
+					pverts = pverts - (cx, cy, cz,)
+
+					# Create model object
+					mdl = psx.thing(
+						px=cx<<12,
+						py=cy<<12,
+						pz=cz<<12)
+					midxs.append(len(psx.mdls)-1)
+
+					# Add vertices and faces to model
+					mdl.add_vertices(pverts)
+					used = (pfvidxs >= 0) # Unused triangle corners get zeroes
+					mdl.add_faces(
+						rflags = numpy.where(is_tri[fsel], 0x1803|0x0010, 0x1803), # 0x0010: Triangle
+						sflags = 0x0000,
+						vidxs = numpy.where(used, pfvidxs, 0),
+						cmd = numpy.where(used, pcidxs[numpy.maximum(pfvidxs, 0)], 0),
+						tidx = ftidx[fsel],
+						tpoints = ftpoints[fsel])
+
+					stats.count("models")
+					stats.count("vertices", len(pverts))
+					stats.count("faces", len(pfvidxs))
+					stats.count("triangles", int(is_tri[fsel].sum()))
+
+			if cache is not None:
+				part.cache_todo.append((key, midxs,))
+
+			# Move finished models out of memory every so often
+			part.pending_faces += len(fvidxs)
+			if stream and part.pending_faces >= STREAM_FLUSH_FACES:
+				with stats.phase("encode"):
+					psx.encode_models(workers=workers, pool=pool)
+				part.pending_faces = 0
+
+		# Regions whose meshes all cleaned away are not written, and so
+		# never spooled. The main file is written even when it is empty.
+		for (i, part,) in enumerate(parts):
+			if i != 0 and len(part.psx.objs) == 0:
+				print("region %d:          nothing left to export, not written" % (i,))
+				part.lo = part.hi = None
+		written = [part for (i, part,) in enumerate(parts) if i == 0 or part.lo is not None]
+
+		print("cleanup: removed %d vertices and %d faces, %d quads became triangles, %d meshes left empty" % tuple(clean_stats))
+		stats.count("meshes", len(scene.meshes))
+		stats.count("welded_vertices", clean_stats[0])
+		stats.count("dropped_faces", clean_stats[1])
+		stats.count("empty_meshes", clean_stats[3])
+
+		# Encode the models and fill in the cache
+		with stats.phase("encode"):
+			for part in parts:
+				part.psx.encode_models(workers=workers, pool=pool)
+	finally:
+		if pool is not None:
+			pool.shutdown()
+	with stats.phase("cache"):
+		if cache is not None:
+			for part in parts:
+				psx = part.psx
+				for (key, midxs,) in part.cache_todo:
+					cache.put(key, pack_cached_models([
+						(psx.objs[i].px, psx.objs[i].py, psx.objs[i].pz,
+							psx.mdls[i].bounds(), psx.mdls[i].blob,)
+						for i in midxs]))
+			print("cache: %d hits, %d misses" % (cache.hits, cache.misses,))
+			cache.trim()
+			stats.count("cache_hits", cache.hits)
+			stats.count("cache_misses", cache.misses)
+
+	# Merge and pack textures; cached models hold the unpacked layout
+	with stats.phase("texture_set"):
+		for part in parts:
+			psx = part.psx
+			if nparts > 1:
+				print("%s:" % (part.refname,))
+			ntexs = len(psx.texs)
+			if palette_tolerance > 0:
+				print("palettes: merged %d near-duplicates" % (
+					psx.merge_palettes(tolerance=palette_tolerance),))
+			report = psx.build_texture_set(atlas=pack_textures)
+			vram = 0
+			for (i, entry,) in enumerate(report):
+				vram += entry["iw"]*entry["bpp"]//16*entry["ih"]
+				print("texture %d: %dbpp %dx%d, %d textures, %.1f%% of a page" % (
+					i, entry["bpp"], entry["iw"], entry["ih"], entry["textures"], entry["fill"]*100.0,))
+			print("textures: %d in, %d out, %.1f%% of VRAM" % (ntexs, len(psx.texs), vram*100.0/(1024*512),))
+			print("palettes: %d for %d textures" % (len(psx.intern_palettes()), len(psx.texs),))
+			stats.count("textures", len(psx.texs))
+			stats.count("palettes", len(psx.intern_palettes()))
 
 	# Add an autoexec node
+	restart_names = [restart["name"] for restart in scene.restarts]
 	res_autoexec = trg.new_autoexec(
 		ops=[
 			SetFadeColor(0x8000, 0x0000),
-			SetRestart("Start"),
-			SetRestart2("Start"),
+			SetRestart(restart_names[0]),
+			SetRestart2(restart_names[0]),
 			SetGameLevel(0),
 			#SpoolIn(psx_lib_refname),
 			#SpoolIn(psx_obj_refname),
@@ -901,61 +3895,430 @@ def export_trg(trg_fname):
 			EndCommandList(), 
 		])
 
-	# Add a restart
-	spawn_x = 0
-	spawn_y = 0
-	spawn_z = 0
-	res_start = trg.new_restart(
-		px=fix12(spawn_x), py=fix12(spawn_y), pz=fix12(spawn_z),
-		#sx=0, sy=0xFFF&int(round((270-wad.player1.angle)*0x1000/360.0)), sz=0,
-		sx=0, sy=0, sz=0,
-		name="Start",
-		ops=[
-			SetReverbType(1),
-			SetCheatRestarts("Start"),
-			SetFoggingParams(10, 5500, 1024),
-			SpoolEnv(psx_main_refname),
-			SetOTPushback(0x400),
-			SetOTPushback2(0x80),
-			SetInitialPulses(1),
-			SendPulse(),
-			#SendSuspend(),
-			#SetSkyColor(0x0004, 0x080A),
-			SetSkyColor(0x0020, 0x0040),
-			EndCommandList(),
-		])
-
-	# Write files
-	psx.write(fname=psx_main_fname)
-	trg.write(fname=trg_fname)
-
-class THPSMapExporter(bpy.types.Operator):
-	bl_idname = "export.thps_map"
-	bl_label = "Export THPS TRG+PSX map"
-
-	filepath = bpy.props.StringProperty(subtype="FILE_PATH")
-
-	#@classmethod
-	#def poll(cls, context):
-	#	return context.object is not None
+	# Which regions each restart loads. Restart positions are in Blender
+	# units; they and the part extents are compared in model units.
+	restart_pos = [blender_to_model(restart["pos"]) for restart in scene.restarts]
+	near = [[part.lo is not None and box_distance(pos, part.lo, part.hi) <= spool_distance
+		for part in parts] for pos in restart_pos]
+	for (i, part,) in enumerate(parts):
+		if i != 0 and part.lo is not None and not any(row[i] for row in near):
+			# Out of reach of every restart, so keep it loaded everywhere
+			print("region %d:          no restart within the spool distance, always loaded" % (i,))
+			for row in near:
+				row[i] = True
+
+	# Add the restarts
+	for (restart, pos, row,) in zip(scene.restarts, restart_pos, near):
+		spawn_x, spawn_y, spawn_z, = pos.tolist()
+
+		# Load the regions near this restart and drop the rest
+		spool_ops = []
+		for (part, load,) in list(zip(parts, row))[1:]:
+			if part.lo is None:
+				continue
+			if load:
+				spool_ops.append(SpoolIn(part.refname))
+			else:
+				spool_ops.insert(0, SpoolOut(part.refname))
+
+		res_start = trg.new_restart(
+			px=fix12(spawn_x), py=fix12(spawn_y), pz=fix12(spawn_z),
+			#sx=0, sy=0xFFF&int(round((270-wad.player1.angle)*0x1000/360.0)), sz=0,
+			sx=0, sy=0, sz=0,
+			name=restart["name"],
+			ops=[
+				SetReverbType(1),
+				SetCheatRestarts(*restart_names),
+				SetFoggingParams(10, 5500, 1024),
+				SpoolEnv(psx_main_refname),
+				*spool_ops,
+				SetOTPushback(0x400),
+				SetOTPushback2(0x80),
+				SetInitialPulses(1),
+				SendPulse(),
+				#SendSuspend(),
+				#SetSkyColor(0x0004, 0x080A),
+				SetSkyColor(0x0020, 0x0040),
+				EndCommandList(),
+			])
+
+	# Add the rails, at the same scale as object positions
+	with stats.phase("rails"):
+		rail_points, rail_links, = rail_network(scene.rails, tolerance=rail_tolerance)
+		rail_nodes = trg.new_railpoints(rail_points<<12)
+		trg.link_nodes(rail_nodes, rail_links)
+		stats.count("rail_points", len(rail_nodes))
+		stats.count("rail_links", len(rail_links))
+
+	# Write files, main last so that its grid is the one reported
+	with stats.phase("psx_write"):
+		for part in written[1:]+written[:1]:
+			part.psx.write(fname=part.fname,
+				gdivs=(None if auto_grid else PHYS_GRID_DEFAULT_DIVS),
+				stats=stats)
+	for part in parts:
+		part.psx.close()
+	if len(written) > 1:
+		stats.count("spool_regions", len(written)-1)
+	with stats.phase("trg_write"):
+		trg.write(fname=trg_fname)
+	stats.count("trg_nodes", len(trg.chunks))
+	stats.section("trg", os.stat(trg_fname).st_size)
+
+	stats.close()
+	for line in stats.report_lines():
+		print(line)
+	return stats
+
+def stats_fname(trg_fname):
+	return os.path.splitext(trg_fname)[0] + "_stats.json"
+
+def export_trg(trg_fname, *, stats=None, **kwargs):
+	if stats is None:
+		stats = ExportStats()
+	scene = scene_from_blender(stats=stats)
+	return export_scene(scene, trg_fname, stats=stats, **kwargs)
+
+if bpy is not None:
+	class THPSMapExporter(bpy.types.Operator):
+		bl_idname = "export.thps_map"
+		bl_label = "Export THPS TRG+PSX map"
+
+		filepath = bpy.props.StringProperty(subtype="FILE_PATH")
+		auto_grid = bpy.props.BoolProperty(
+			name="Auto physics grid",
+			description="Choose the Physdata grid divisions to minimise the objects per cell",
+			default=False)
+		use_cache = bpy.props.BoolProperty(
+			name="Cache models",
+			description="Reuse encoded models for meshes that have not changed",
+			default=True)
+		cache_dir = bpy.props.StringProperty(
+			name="Cache directory",
+			description="Where to keep the model cache (blank for the default)",
+			subtype="DIR_PATH",
+			default="")
+		weld_distance = bpy.props.FloatProperty(
+			name="Weld distance",
+			description="Merge vertices closer than this after quantisation",
+			default=0.0, min=0.0, max=1.0, precision=4)
+		bake_lighting = bpy.props.BoolProperty(
+			name="Bake lighting",
+			description="Shade vertices from the scene's lamps",
+			default=True)
+		ambient = bpy.props.FloatProperty(
+			name="Ambient light",
+			description="Light level added to every vertex (1.0 is unshaded)",
+			default=0.5, min=0.0, max=2.0)
+		texture_bpp = bpy.props.EnumProperty(
+			name="Texture depth",
+			description="Colour depth for exported textures",
+			items=[
+				("AUTO", "Auto", "4bpp when an image has at most 16 colours, otherwise 8bpp"),
+				("4", "4bpp", "16-colour palettes"),
+				("8", "8bpp", "256-colour palettes"),
+			],
+			default="AUTO")
+		pack_textures = bpy.props.BoolProperty(
+			name="Pack textures",
+			description="Merge textures that share a palette into page-sized atlases",
+			default=True)
+		palette_tolerance = bpy.props.IntProperty(
+			name="Palette tolerance",
+			description="Share palettes whose colours differ by at most this many 5-bit steps",
+			default=0, min=0, max=31)
+		share_planes = bpy.props.BoolProperty(
+			name="Share planes",
+			description="Let faces with the same normal use one plane entry",
+			default=True)
+		merge_quads = bpy.props.BoolProperty(
+			name="Merge triangles",
+			description="Join pairs of flat neighbouring triangles into quads",
+			default=True)
+		bake_ao = bpy.props.BoolProperty(
+			name="Ambient occlusion",
+			description="Darken vertices that nearby geometry hides from the sky",
+			default=False)
+		ao_distance = bpy.props.FloatProperty(
+			name="Occlusion distance",
+			description="How far occlusion rays reach",
+			default=4.0, min=0.0)
+		ao_rays = bpy.props.IntProperty(
+			name="Occlusion rays",
+			description="Rays per vertex",
+			default=16, min=1, max=256)
+		ao_strength = bpy.props.FloatProperty(
+			name="Occlusion strength",
+			description="How dark a fully hidden vertex gets (1.0 is black)",
+			default=0.75, min=0.0, max=1.0)
+		rail_weld_distance = bpy.props.FloatProperty(
+			name="Rail weld distance",
+			description="Join rail ends closer than this into one network",
+			default=0.01, min=0.0, max=1.0, precision=4)
+		spool_mode = bpy.props.EnumProperty(
+			name="Spooling",
+			description="Split the level into regions that get loaded near their restarts",
+			items=[
+				("NONE", "None", "Everything goes in the main .psx"),
+				("GROUPS", "Groups", "One region per group; ungrouped meshes stay in the main .psx"),
+				("CLUSTER", "Cluster", "Group meshes into regions by position"),
+			],
+			default="NONE")
+		spool_regions = bpy.props.IntProperty(
+			name="Regions",
+			description="How many position clusters to make",
+			default=4, min=1, max=64)
+		spool_distance = bpy.props.FloatProperty(
+			name="Spool distance",
+			description="Load the regions within this distance of a restart",
+			default=256.0, min=0.0)
+		workers = bpy.props.IntProperty(
+			name="Worker processes",
+			description="Encode models in parallel with this many processes",
+			default=1, min=1, max=64)
+		profile_memory = bpy.props.BoolProperty(
+			name="Profile memory",
+			description="Record the peak memory of each export phase (slower)",
+			default=False)
+		stream = bpy.props.BoolProperty(
+			name="Low memory",
+			description="Spool encoded models to disk instead of keeping the whole level in memory",
+			default=False)
+		check_only = bpy.props.BoolProperty(
+			name="Check only",
+			description="Run the pre-flight checks without writing anything",
+			default=False)
+		write_stats = bpy.props.BoolProperty(
+			name="Write statistics",
+			description="Save timings and counters next to the map as *_stats.json",
+			default=False)
+
+		#@classmethod
+		#def poll(cls, context):
+		#	return context.object is not None
+
+		def execute(self, context):
+			cache_dir = None
+			if self.use_cache:
+				cache_dir = (bpy.path.abspath(self.cache_dir)
+					if self.cache_dir else default_cache_dir())
+			stats = export_trg(self.filepath,
+				stats=ExportStats(trace_memory=self.profile_memory),
+				auto_grid=self.auto_grid,
+				cache_dir=cache_dir,
+				workers=self.workers,
+				weld_tolerance=fix12(self.weld_distance/BLEND_PER_THPS),
+				bake_lighting=self.bake_lighting,
+				ambient=self.ambient,
+				texture_bpp=(None if self.texture_bpp == "AUTO" else int(self.texture_bpp)),
+				pack_textures=self.pack_textures,
+				palette_tolerance=self.palette_tolerance,
+				share_planes=self.share_planes,
+				merge_quads=self.merge_quads,
+				bake_ao=self.bake_ao,
+				ao_distance=fix12(self.ao_distance/BLEND_PER_THPS),
+				ao_rays=self.ao_rays,
+				ao_strength=self.ao_strength,
+				rail_tolerance=fix12(self.rail_weld_distance/BLEND_PER_THPS),
+				spool_mode=self.spool_mode,
+				spool_regions=self.spool_regions,
+				spool_distance=fix12(self.spool_distance/BLEND_PER_THPS),
+				stream=self.stream,
+				check_only=self.check_only)
+			for line in stats.report_lines():
+				self.report({"INFO"}, line)
+			if self.write_stats:
+				stats.save(stats_fname(self.filepath))
+			return {"FINISHED"}
+
+		def invoke(self, context, event):
+			context.window_manager.fileselect_add(self)
+			return {"RUNNING_MODAL"}
+
+	class THPSSceneSaver(bpy.types.Operator):
+		bl_idname = "export.thps_scene"
+		bl_label = "Export THPS scene for the command line builder"
+
+		filepath = bpy.props.StringProperty(subtype="FILE_PATH")
+		filter_glob = bpy.props.StringProperty(default="*.npz", options={"HIDDEN"})
+
+		def execute(self, context):
+			scene_from_blender().save(self.filepath)
+			return {"FINISHED"}
+
+		def invoke(self, context, event):
+			context.window_manager.fileselect_add(self)
+			return {"RUNNING_MODAL"}
+
+	class THPSModelImporter(bpy.types.Operator):
+		bl_idname = "import.thps_psx"
+		bl_label = "Import THPS PSX models"
+
+		filepath = bpy.props.StringProperty(subtype="FILE_PATH")
+		filter_glob = bpy.props.StringProperty(default="*.psx", options={"HIDDEN"})
+
+		def execute(self, context):
+			count = import_psx(self.filepath)
+			self.report({"INFO"}, "Imported %d objects" % (count,))
+			return {"FINISHED"}
+
+		def invoke(self, context, event):
+			context.window_manager.fileselect_add(self)
+			return {"RUNNING_MODAL"}
+
+	def map_export_menu(self, context):
+		self.layout.operator_context = "INVOKE_DEFAULT"
+		self.layout.operator(THPSMapExporter.bl_idname, text="THPS map (*.trg)")
+
+	def scene_export_menu(self, context):
+		self.layout.operator_context = "INVOKE_DEFAULT"
+		self.layout.operator(THPSSceneSaver.bl_idname, text="THPS scene (*.npz)")
+
+	def model_import_menu(self, context):
+		self.layout.operator_context = "INVOKE_DEFAULT"
+		self.layout.operator(THPSModelImporter.bl_idname, text="THPS models (*.psx)")
+
+	def register():
+		bpy.utils.register_class(THPSMapExporter)
+		bpy.types.INFO_MT_file_export.append(map_export_menu)
+		bpy.utils.register_class(THPSSceneSaver)
+		bpy.types.INFO_MT_file_export.append(scene_export_menu)
+		bpy.utils.register_class(THPSModelImporter)
+		bpy.types.INFO_MT_file_import.append(model_import_menu)
+
+	def unregister():
+		bpy.types.INFO_MT_file_import.remove(model_import_menu)
+		bpy.utils.unregister_class(THPSModelImporter)
+		bpy.types.INFO_MT_file_export.remove(scene_export_menu)
+		bpy.utils.unregister_class(THPSSceneSaver)
+		bpy.types.INFO_MT_file_export.remove(map_export_menu)
+		bpy.utils.unregister_class(THPSMapExporter)
 
-	def execute(self, context):
-		export_trg(self.filepath)
-		return {"FINISHED"}
 
-	def invoke(self, context, event):
-		context.window_manager.fileselect_add(self)
-		return {"RUNNING_MODAL"}
-
-def map_export_menu(self, context):
-	self.layout.operator_context = "INVOKE_DEFAULT"
-	self.layout.operator(THPSMapExporter.bl_idname, text="THPS map (*.trg)")
-
-def register():
-	bpy.utils.register_class(THPSMapExporter)
-	bpy.types.INFO_MT_file_export.append(map_export_menu)
-
-def unregister():
-	bpy.types.INFO_MT_file_export.remove(map_export_menu)
-	bpy.utils.unregister_class(THPSMapExporter)
+#
+# Command line
+#
 
+def export_scene_file(job):
+	# One batch entry; a plain function so that it can run in a worker process
+	scene_fname, trg_fname, kwargs, write_stats, profile_memory, = job
+	stats = ExportStats(trace_memory=profile_memory)
+	export_scene(Scene.load(scene_fname), trg_fname, stats=stats, **kwargs)
+	if write_stats:
+		stats.save(stats_fname(trg_fname))
+	return trg_fname
+
+def main(argv=None):
+	import argparse
+
+	parser = argparse.ArgumentParser(
+		description="Build THPS PS1 levels from scenes saved by the Blender addon.")
+	parser.add_argument("scenes", metavar="SCENE", nargs="+",
+		help=".npz scene files")
+	parser.add_argument("-o", "--output-dir",
+		help="where to write each level (default: next to its scene)")
+	parser.add_argument("-j", "--jobs", type=int, default=1,
+		help="levels to build at once")
+	parser.add_argument("--workers", type=int, default=1,
+		help="model encoding processes per level")
+	parser.add_argument("--auto-grid", action="store_true",
+		help="choose the Physdata grid divisions automatically")
+	parser.add_argument("--no-cache", action="store_true",
+		help="do not reuse or store encoded models")
+	parser.add_argument("--cache-dir", default=default_cache_dir(),
+		help="where to keep the model cache")
+	parser.add_argument("--weld-distance", type=float, default=0.0,
+		help="merge vertices closer than this, in Blender units")
+	parser.add_argument("--no-lighting", action="store_true",
+		help="do not bake lighting from the scene's lamps")
+	parser.add_argument("--ambient", type=float, default=0.5,
+		help="light level added to every vertex")
+	parser.add_argument("--texture-bpp", choices=["auto", "4", "8"], default="auto",
+		help="colour depth for exported textures")
+	parser.add_argument("--no-pack-textures", action="store_true",
+		help="do not merge textures into atlases")
+	parser.add_argument("--palette-tolerance", type=int, default=0,
+		help="share palettes that differ by at most this many 5-bit steps")
+	parser.add_argument("--no-share-planes", action="store_true",
+		help="give every face its own plane entry")
+	parser.add_argument("--no-merge-quads", action="store_true",
+		help="keep triangles as they are instead of joining them into quads")
+	parser.add_argument("--ao", action="store_true",
+		help="bake ambient occlusion into the vertex shades")
+	parser.add_argument("--ao-distance", type=float, default=4.0,
+		help="how far occlusion rays reach, in Blender units")
+	parser.add_argument("--ao-rays", type=int, default=16,
+		help="occlusion rays per vertex")
+	parser.add_argument("--ao-strength", type=float, default=0.75,
+		help="how dark a fully hidden vertex gets (1.0 is black)")
+	parser.add_argument("--rail-weld-distance", type=float, default=0.01,
+		help="join rail ends closer than this, in Blender units")
+	parser.add_argument("--spool", choices=["none", "groups", "cluster"], default="none",
+		help="split the level into regions that get loaded near their restarts")
+	parser.add_argument("--spool-regions", type=int, default=4,
+		help="how many position clusters to make with --spool cluster")
+	parser.add_argument("--spool-distance", type=float, default=256.0,
+		help="load the regions within this distance of a restart, in Blender units")
+	parser.add_argument("--stream", action="store_true",
+		help="spool encoded models to disk to bound memory use")
+	parser.add_argument("--check", action="store_true",
+		help="only run the pre-flight checks, without writing anything")
+	parser.add_argument("--stats", action="store_true",
+		help="save timings and counters next to each level as *_stats.json")
+	parser.add_argument("--profile-memory", action="store_true",
+		help="record the peak memory of each export phase (slower)")
+	args = parser.parse_args(argv)
+
+	kwargs = {
+		"auto_grid": args.auto_grid,
+		"cache_dir": (None if args.no_cache else args.cache_dir),
+		"workers": args.workers,
+		"weld_tolerance": fix12(args.weld_distance/BLEND_PER_THPS),
+		"bake_lighting": not args.no_lighting,
+		"ambient": args.ambient,
+		"texture_bpp": (None if args.texture_bpp == "auto" else int(args.texture_bpp)),
+		"pack_textures": not args.no_pack_textures,
+		"palette_tolerance": args.palette_tolerance,
+		"share_planes": not args.no_share_planes,
+		"merge_quads": not args.no_merge_quads,
+		"bake_ao": args.ao,
+		"ao_distance": fix12(args.ao_distance/BLEND_PER_THPS),
+		"ao_rays": args.ao_rays,
+		"ao_strength": args.ao_strength,
+		"rail_tolerance": fix12(args.rail_weld_distance/BLEND_PER_THPS),
+		"spool_mode": args.spool.upper(),
+		"spool_regions": args.spool_regions,
+		"spool_distance": fix12(args.spool_distance/BLEND_PER_THPS),
+		"stream": args.stream,
+		"check_only": args.check,
+	}
+	jobs = []
+	for scene_fname in args.scenes:
+		out_dir = args.output_dir or os.path.dirname(os.path.abspath(scene_fname))
+		base = os.path.splitext(os.path.basename(scene_fname))[0]
+		jobs.append((scene_fname, os.path.join(out_dir, base+"_t.trg"), kwargs,
+			args.stats, args.profile_memory,))
+
+	failed = 0
+	if args.jobs <= 1 or len(jobs) <= 1:
+		for job in jobs:
+			try:
+				export_scene_file(job)
+			except Exception as e:
+				print("%s: %s" % (job[0], e,))
+				failed += 1
+	else:
+		with concurrent.futures.ProcessPoolExecutor(max_workers=args.jobs) as pool:
+			futures = {pool.submit(export_scene_file, job): job for job in jobs}
+			for future in concurrent.futures.as_completed(futures):
+				try:
+					print("built %s" % (future.result(),))
+				except Exception as e:
+					print("%s: %s" % (futures[future][0], e,))
+					failed += 1
+
+	return (1 if failed != 0 else 0)
+
+if __name__ == "__main__":
+	import sys
+	sys.exit(main())
@@ -0,0 +1,379 @@
+#!/usr/bin/env python3
+# vim: set sts=0 noet :
+#
+# Regression tests for the THPS PSX/TRG tools, run with pytest.
+# Runs without Blender, like the benchmarks.
+#
+
+import os
+import struct
+
+import numpy
+import pytest
+
+import io_thps_psx_tools as thps
+import bench_thps_psx as bench
+
+class ImportStub(object):
+	# Just enough of bpy for import_psx(), keeping what it is handed
+	class Namespace(object):
+		def __init__(self, **attrs):
+			self.__dict__.update(attrs)
+
+	class Collection(object):
+		def __init__(self):
+			self.count = 0
+			self.values = {}
+
+		def add(self, count):
+			self.count += count
+
+		def foreach_set(self, name, values):
+			self.values[name] = numpy.array(values)
+
+	class Mesh(object):
+		def __init__(self, name):
+			self.name = name
+			self.vertices = ImportStub.Collection()
+			self.loops = ImportStub.Collection()
+			self.polygons = ImportStub.Collection()
+			self.uv_layers = ImportStub.Namespace(
+				active=ImportStub.Namespace(data=ImportStub.Collection()),
+				new=lambda: None)
+
+		def validate(self):
+			pass
+
+		def update(self, calc_edges=False):
+			pass
+
+	def __init__(self):
+		self.meshes = []
+		self.objects = []
+		self.linked = []
+		self.data = ImportStub.Namespace(
+			meshes=ImportStub.Namespace(new=self.new_mesh),
+			objects=ImportStub.Namespace(new=self.new_object))
+		self.context = ImportStub.Namespace(scene=ImportStub.Namespace(
+			objects=ImportStub.Namespace(link=self.linked.append)))
+
+	def new_mesh(self, name):
+		self.meshes.append(ImportStub.Mesh(name))
+		return self.meshes[-1]
+
+	def new_object(self, name, mesh):
+		self.objects.append(ImportStub.Namespace(name=name, data=mesh, location=None))
+		return self.objects[-1]
+
+def test_import_psx(tmp_path, monkeypatch):
+	scene = bench.synth_scene(seed=1, objects=8, verts=25, textures=2, texture_size=16, lamps=1, rails=0)
+	trg_fname = str(tmp_path/"lvl_t.trg")
+	thps.export_scene(scene, trg_fname)
+
+	stub = ImportStub()
+	monkeypatch.setattr(thps, "bpy", stub)
+	count = thps.import_psx(str(tmp_path/"lvl.psx"))
+
+	assert count == len(stub.objects) == len(stub.linked)
+	assert count >= len(scene.meshes)
+	assert sum(mesh.polygons.count for mesh in stub.meshes) > 0
+	for obj in stub.objects:
+		assert len(obj.location) == 3
+
+def test_reader_close_with_live_views(tmp_path):
+	scene = bench.synth_scene(seed=1, objects=4, verts=25, textures=1, texture_size=16, lamps=0)
+	thps.export_scene(scene, str(tmp_path/"lvl_t.trg"))
+	reader = thps.PSXReader(str(tmp_path/"lvl.psx"))
+	mdl = reader.model(0)
+	head, cells, = reader.physgrid()
+	reader.close()
+	assert len(mdl.vertices) > 0
+
+def test_trg_reader_close_with_live_views(tmp_path):
+	scene = bench.synth_scene(seed=1, objects=4, verts=25, textures=1, texture_size=16, lamps=0, rails=1)
+	thps.export_scene(scene, str(tmp_path/"lvl_t.trg"))
+	reader = thps.TRGReader(str(tmp_path/"lvl_t.trg"))
+	linked = [reader.links(idx) for idx in range(len(reader.offsets))]
+	linked = [links for links in linked if len(links) != 0]
+	assert len(linked) > 0
+	reader.close()
+	assert int(linked[0][0]) >= 0
+
+def test_gather_records_bounds():
+	raw = numpy.arange(8, dtype=numpy.uint8)
+	recs = thps.gather_records(raw, [0, 4], numpy.dtype("<u4"))
+	assert recs.tolist() == [0x03020100, 0x07060504]
+	for offs in ([5], [-1],):
+		with pytest.raises(ValueError):
+			thps.gather_records(raw, offs, numpy.dtype("<u4"))
+
+def strip_faces(marr, *, keep=0):
+	# Same mesh with only its first keep faces
+	nloops = int(marr.loop_total[:keep].sum())
+	return thps.MeshArrays(
+		co=marr.co,
+		poly_normals=marr.poly_normals[:keep],
+		loop_start=marr.loop_start[:keep],
+		loop_total=marr.loop_total[:keep],
+		loop_vidxs=marr.loop_vidxs[:nloops],
+		poly_materials=marr.poly_materials[:keep],
+		loop_uvs=(marr.loop_uvs[:nloops] if marr.loop_uvs is not None else None))
+
+def test_export_faceless_mesh(tmp_path):
+	scene = bench.synth_scene(seed=1, objects=3, verts=25, textures=1, texture_size=16, lamps=1)
+	scene.meshes[0].marr = strip_faces(scene.meshes[0].marr)
+	assert thps.mesh_split_faces(numpy.zeros((4, 3), dtype=numpy.int64),
+		numpy.zeros((0, 4), dtype=numpy.int64)) == []
+	stats = thps.export_scene(scene, str(tmp_path/"lvl_t.trg"))
+	assert stats.counters["models"] == 2
+
+def test_export_degenerate_mesh(tmp_path):
+	# Every vertex in one place, so every face drops out in cleanup
+	scene = bench.synth_scene(seed=1, objects=3, verts=25, textures=1, texture_size=16, lamps=1)
+	scene.meshes[1].marr.co[:] = scene.meshes[1].marr.co[0]
+	cold = thps.export_scene(scene, str(tmp_path/"lvl_t.trg"), cache_dir=str(tmp_path/"cache"))
+	warm = thps.export_scene(scene, str(tmp_path/"lvl_t.trg"), cache_dir=str(tmp_path/"cache"))
+	assert cold.counters["models"] == warm.counters["models"] == 2
+	assert cold.counters["empty_meshes"] == 1
+	assert warm.counters["cache_misses"] == 0
+
+def test_preflight_empty_meshes(tmp_path):
+	# Faceless and fully degenerate meshes are warnings, and then export
+	scene = bench.synth_scene(seed=1, objects=3, verts=25, textures=1, texture_size=16, lamps=1)
+	scene.meshes[0].marr = strip_faces(scene.meshes[0].marr)
+	scene.meshes[1].marr.co[:] = scene.meshes[1].marr.co[0]
+	problems = thps.preflight_scene(scene, mesh_parts=numpy.zeros(3, dtype=numpy.int64))
+	assert [(problem["level"], problem["where"],) for problem in problems] == [
+		("warning", "mesh 'obj0'",),
+		("warning", "mesh 'obj1'",),
+	]
+	stats = thps.export_scene(scene, str(tmp_path/"lvl_t.trg"))
+	assert stats.counters["preflight_warnings"] == 2
+	assert stats.counters["models"] == 1
+
+def spool_ops(raw, refname):
+	# Opcodes of the spool commands naming refname; the opcode is right
+	# before the string, which starts on a 16-bit boundary
+	ops = []
+	beg = raw.find(refname+b"\x00")
+	while beg >= 0:
+		ops.append(struct.unpack_from("<H", raw, beg-2)[0])
+		beg = raw.find(refname+b"\x00", beg+1)
+	return ops
+
+def test_spool_far_region(tmp_path):
+	# A region out of reach of every restart stays loaded
+	scene = bench.synth_scene(seed=1, objects=4, verts=25, textures=1, texture_size=16, lamps=0)
+	scene.meshes[3].group = "far"
+	scene.meshes[3].location = (1000.0, 1000.0, 0.0)
+	scene.restarts.append({"name": "Other", "pos": (-10.0, 0.0, 0.0,)})
+	thps.export_scene(scene, str(tmp_path/"lvl_t.trg"), spool_mode="GROUPS", spool_distance=0)
+	with open(str(tmp_path/"lvl_t.trg"), "rb") as fp:
+		raw = fp.read()
+	assert spool_ops(raw, b"lvl_r1") == [126, 126]
+
+	names = []
+	for fname in ("lvl.psx", "lvl_r1.psx"):
+		reader = thps.PSXReader(str(tmp_path/fname))
+		names.extend(reader.tail()["model_names"].tolist())
+		reader.close()
+	assert len(set(names)) == len(names)
+
+def test_write_file_atomic_mode(tmp_path):
+	fname = str(tmp_path/"lvl.psx")
+	thps.write_file_atomic(fname, b"one")
+	umask = os.umask(0)
+	os.umask(umask)
+	assert os.stat(fname).st_mode & 0o777 == 0o666 & ~umask
+
+	# Replacing a file keeps its mode
+	os.chmod(fname, 0o640)
+	thps.write_file_atomic(fname, b"two")
+	assert os.stat(fname).st_mode & 0o777 == 0o640
+	with open(fname, "rb") as fp:
+		assert fp.read() == b"two"
+
+def test_lamp_without_distance():
+	# A point lamp with no distance lights everything, without falloff
+	lamp = {"type": "POINT", "pos": (0.0, 0.0, 16.0,), "dir": (0.0, 0.0, -1.0,),
+		"distance": 0.0, "energy": 1.0, "spot_size": 0.0}
+	grid = thps.LampGrid.from_lamps([lamp])
+	verts = numpy.array([[0, 0, 0], [4096*50, 0, 0]], dtype=numpy.int64)
+	normals = numpy.array([[0.0, -1.0, 0.0], [0.0, -1.0, 0.0]])
+	light = grid.illuminate(verts, normals)
+	assert light[0] == 1.0
+	assert 0.0 < light[1] < 1.0
+
+def test_physgrid_empty():
+	none = numpy.zeros(0, dtype=numpy.int64)
+	for grid in (thps.PhysGrid(ox0=none, oz0=none, ox1=none, oz1=none, gdivx=20, gdivz=20),
+			thps.PhysGrid.auto(ox0=none, oz0=none, ox1=none, oz1=none),):
+		assert grid.occupancy().max() == 0
+		blob = grid.encode()
+		assert len(blob) == 20+16*grid.gdivx*grid.gdivz
+
+def test_spool_empty_main(tmp_path):
+	# Every mesh is in a region, so the main file has no objects
+	scene = bench.synth_scene(seed=1, objects=4, verts=25, textures=1, texture_size=16, lamps=0)
+	for (i, mesh,) in enumerate(scene.meshes):
+		mesh.group = "g%d" % (i%2,)
+	stats = thps.export_scene(scene, str(tmp_path/"lvl_t.trg"), spool_mode="GROUPS")
+	assert stats.counters["spool_regions"] == 2
+	reader = thps.PSXReader(str(tmp_path/"lvl.psx"))
+	assert len(reader.objs) == 0
+	reader.close()
+
+def test_spool_empty_region(tmp_path):
+	# A region whose only mesh cleans away is not written or spooled,
+	# and a region of faceless meshes is dropped up front
+	scene = bench.synth_scene(seed=1, objects=4, verts=25, textures=1, texture_size=16, lamps=0)
+	scene.meshes[1].group = "flat"
+	scene.meshes[1].marr.co[:] = scene.meshes[1].marr.co[0]
+	scene.meshes[2].group = "bare"
+	scene.meshes[2].marr = strip_faces(scene.meshes[2].marr)
+	scene.meshes[3].group = "solid"
+	assert thps.spool_parts(scene, mode="GROUPS", regions=0, bounds=None).tolist() == [0, 1, 0, 2]
+	stats = thps.export_scene(scene, str(tmp_path/"lvl_t.trg"), spool_mode="GROUPS")
+	assert stats.counters["spool_regions"] == 1
+	assert sorted(os.listdir(str(tmp_path))) == ["lvl.psx", "lvl_r2.psx", "lvl_t.trg"]
+	with open(str(tmp_path/"lvl_t.trg"), "rb") as fp:
+		raw = fp.read()
+	assert spool_ops(raw, b"lvl_r1") == []
+	assert spool_ops(raw, b"lvl_r2") == [126]
+
+def test_preflight_empty_files(tmp_path):
+	# Files that end up with no models are warnings, and then export
+	scene = bench.synth_scene(seed=1, objects=2, verts=25, textures=1, texture_size=16, lamps=0)
+	scene.meshes[0].marr = strip_faces(scene.meshes[0].marr)
+	scene.meshes[1].group = "flat"
+	scene.meshes[1].marr.co[:] = scene.meshes[1].marr.co[0]
+	mesh_parts = thps.spool_parts(scene, mode="GROUPS", regions=0, bounds=None)
+	problems = thps.preflight_scene(scene, mesh_parts=mesh_parts)
+	assert set(problem["level"] for problem in problems) == set(["warning"])
+	assert [problem["where"] for problem in problems][-2:] == ["main file", "region 1"]
+	stats = thps.export_scene(scene, str(tmp_path/"lvl_t.trg"), spool_mode="GROUPS")
+	assert "spool_regions" not in stats.counters
+	assert sorted(os.listdir(str(tmp_path))) == ["lvl.psx", "lvl_t.trg"]
+
+def test_split_many_faces(tmp_path):
+	# More faces than a model header can count, over just 4 vertices
+	co = numpy.array([[0.0, 0.0, 0.0], [1.0, 0.0, 0.0], [1.0, 1.0, 0.0], [0.0, 1.0, 0.0]])
+	nfaces = 70000
+	marr = thps.MeshArrays(
+		co=co,
+		poly_normals=numpy.tile([[0.0, 0.0, 1.0]], (nfaces, 1)),
+		loop_start=numpy.arange(nfaces, dtype=numpy.int64)*4,
+		loop_total=numpy.full(nfaces, 4, dtype=numpy.int64),
+		loop_vidxs=numpy.tile(numpy.arange(4, dtype=numpy.int64), nfaces),
+		poly_materials=numpy.zeros(nfaces, dtype=numpy.int64),
+		loop_uvs=None)
+	scene = thps.Scene()
+	scene.mesh(name="many", marr=marr, scale=(1.0, 1.0, 1.0,), location=(0.0, 0.0, 0.0,), slots=[])
+	problems = thps.preflight_scene(scene, mesh_parts=numpy.zeros(1, dtype=numpy.int64))
+	assert problems == []
+	stats = thps.export_scene(scene, str(tmp_path/"lvl_t.trg"))
+	assert stats.counters["models"] == 2
+	assert stats.counters["faces"] == nfaces
+
+def blob_remap_reference(blob, tmap):
+	# The per-face loop pmodel_blob_remap_textures() replaced
+	blob = bytearray(blob)
+	nverts, nplanes, nfaces, = struct.unpack_from("<HHH", blob, 2)
+	offs = 28 + 8*nverts + 8*nplanes
+	for i in range(nfaces):
+		rflags, length, = struct.unpack_from("<HH", blob, offs)
+		if (rflags & 0x0003) != 0:
+			tidx, *tpoints, = struct.unpack_from("<I8B", blob, offs+16)
+			ntidx, ou, ov, = tmap[tidx]
+			tpoints[0::2] = [u+ou for u in tpoints[0::2]]
+			tpoints[1::2] = [v+ov for v in tpoints[1::2]]
+			struct.pack_into("<I8B", blob, offs+16, ntidx, *tpoints)
+		offs += length
+	return bytes(blob)
+
+def test_blob_remap_textures(tmp_path):
+	scene = bench.synth_scene(seed=3, objects=6, verts=25, textures=3, texture_size=16, lamps=0, rails=0)
+	thps.export_scene(scene, str(tmp_path/"lvl_t.trg"))
+	reader = thps.PSXReader(str(tmp_path/"lvl.psx"))
+	blobs = []
+	for idx in range(len(reader.mdl_offsets)):
+		mdl = reader.model(idx)
+		blobs.append(bytes(reader.buf[mdl.offs:mdl.end]))
+	reader.close()
+
+	tidxs = set()
+	for blob in blobs:
+		tidxs.update(struct.unpack_from("<I", blob, offs+16)[0]
+			for offs in thps.pmodel_blob_face_offsets(blob).tolist()
+			if (blob[offs] & 0x03) != 0)
+	assert len(tidxs) > 0
+	identity = {tidx: (tidx, 0, 0,) for tidx in tidxs}
+	moved = {tidx: (i+7, 8*i, 16*i+1,) for (i, tidx,) in enumerate(sorted(tidxs))}
+	for blob in blobs:
+		assert thps.pmodel_blob_remap_textures(blob, identity) is blob
+		assert thps.pmodel_blob_remap_textures(blob, moved) == blob_remap_reference(blob, moved)
+
+def test_one_encoder_pool_per_export(tmp_path, monkeypatch):
+	# Every stream flush of every part shares the one pool
+	import concurrent.futures
+	pools = []
+	class CountingPool(concurrent.futures.ThreadPoolExecutor):
+		def __init__(self, max_workers):
+			super().__init__(max_workers=max_workers)
+			pools.append(self)
+	monkeypatch.setattr(concurrent.futures, "ProcessPoolExecutor", CountingPool)
+	monkeypatch.setattr(thps, "STREAM_FLUSH_FACES", 50)
+
+	scene = bench.synth_scene(seed=2, objects=12, verts=25, textures=2, texture_size=16, lamps=0, rails=0)
+	thps.export_scene(scene, str(tmp_path/"a_t.trg"), stream=True, spool_mode="CLUSTER", spool_regions=2)
+	thps.export_scene(scene, str(tmp_path/"b_t.trg"), stream=True, spool_mode="CLUSTER", spool_regions=2,
+		workers=2)
+	assert len(pools) == 1
+	assert (tmp_path/"a.psx").read_bytes() == (tmp_path/"b.psx").read_bytes()
+
+def rail_from_fix12(name, points, *, cyclic=False):
+	# Rail through THPS fix12 points, given in Blender units
+	pts = numpy.array(points, dtype=numpy.float64)*(thps.BLEND_PER_THPS/4096.0)
+	return thps.Scene.SceneRail(name=name, points=pts[:, [0, 2, 1]]*(1.0, 1.0, -1.0), cyclic=cyclic)
+
+def test_rail_weld_across_cells():
+	# 1 apart, but either side of a tolerance+1 cell boundary
+	rails = [
+		rail_from_fix12("a", [(-3000, 0, 0), (2, 0, 0)]),
+		rail_from_fix12("b", [(3, 0, 0), (3000, 0, 0)]),]
+	points, links, = thps.rail_network(rails, tolerance=2)
+	assert len(points) == 3
+	assert links.tolist() == [[0, 1], [1, 2]]
+
+def test_rail_weld_distance():
+	# 3 apart inside one tolerance+1 cell, which is further than tolerance
+	rails = [
+		rail_from_fix12("a", [(-3000, 0, 0), (0, 0, 0)]),
+		rail_from_fix12("b", [(2, 2, 1), (3000, 0, 0)]),]
+	points, links, = thps.rail_network(rails, tolerance=2)
+	assert len(points) == 4
+	points, links, = thps.rail_network(rails, tolerance=3)
+	assert len(points) == 3
+
+def test_rail_weld_short_rail():
+	# A rail shorter than the tolerance keeps both its ends
+	rails = [
+		rail_from_fix12("short", [(0, 0, 0), (5, 0, 0)]),
+		rail_from_fix12("a", [(-3000, 0, 0), (-1, 0, 0)]),]
+	points, links, = thps.rail_network(rails, tolerance=10)
+	assert len(points) == 3
+	assert len(links) == 2
+	assert (points[links[:, 0]] != points[links[:, 1]]).any(axis=1).all()
+
+def test_scene_round_trip(tmp_path):
+	scene = bench.synth_scene(seed=4, objects=3, verts=9, textures=1, texture_size=16, lamps=1, rails=2)
+	scene.meshes[0].group = "far"
+	scene.restarts = [{"name": "Start", "pos": [1.5, -2.0, 0.25]}]
+	fname = str(tmp_path/"scene.npz")
+	scene.save(fname)
+	loaded = thps.Scene.load(fname)
+	assert loaded.restarts == scene.restarts
+	assert [mesh.group for mesh in loaded.meshes] == [mesh.group for mesh in scene.meshes]
+	assert [rail.name for rail in loaded.rails] == [rail.name for rail in scene.rails]
+	for (a, b,) in zip(loaded.rails, scene.rails):
+		assert (a.points == b.points).all()